@@ -0,0 +1,722 @@
+## The connector on an asyncio event loop - usage: python async_connector.py ##
+# One thread runs the MQTT connections, the device logic and all Ubirch requests, so thousands of requests can be
+# in flight without a thread each. Needs the optional packages of requirements-async.txt (aiohttp, gmqtt).
+
+import asyncio
+import base64
+import collections
+import json
+import signal
+import threading
+import time
+import ttn
+import circuit_breaker
+import connector_config
+import ingest
+import ttn_connector
+import ubirch_client
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import gmqtt
+    from gmqtt.mqtt.constants import MQTTv311
+except ImportError:
+    gmqtt = None
+
+# The part of a HTTP response used by the connector (like requests.Response)
+Response = collections.namedtuple("Response", ("status_code", "text", "reason"))
+
+
+class LoopTimer():
+    """ A callback scheduled on the loop, counted by its LoopScheduler until it fired or was cancelled """
+
+    __slots__ = ("scheduler", "handle", "callback", "args")
+
+    def __init__(self, scheduler, delay, callback, args):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.args = args
+        self.handle = scheduler.loop.call_later(max(0, delay), self.__fire)
+        scheduler.live += 1
+
+    # Cancel the timer - to be called on the loop
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.__done()
+
+    def __fire(self):
+        self.__done()
+        self.callback(*self.args)
+
+    def __done(self):
+        self.handle = None
+        self.scheduler.live -= 1
+
+
+class LoopScheduler():
+    """ Schedules the device timeouts as callbacks of the event loop (the interface of scheduler.TimerScheduler) """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.live = 0  # timers that did not fire and were not cancelled
+
+    # Number of scheduled timers
+    def __len__(self):
+        return self.live
+
+    # Call callback(*args) in delay seconds, returns a timer with cancel() - to be called on the loop
+    def call_later(self, delay, callback, *args):
+        return LoopTimer(self, delay, callback, args)
+
+    # Call callback(*args) on the loop, from any thread (the handles of call_later() must only be cancelled on the loop)
+    def call_soon_threadsafe(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    # The loop is run by AsyncConnector.run()
+    def stop(self):
+        pass
+
+
+class AsyncUbirchClient(ubirch_client.UbirchClient):
+    """ The Ubirch client with a shared aiohttp connection pool, a semaphore and the circuit breaker per endpoint """
+
+    # The requests session of UbirchClient is kept for the spool/batcher threads
+    def __init__(self, context):
+        super().__init__(context)
+
+        cfg = self.context.config.get("AsyncConfig", {})
+        self.connections = cfg.get("connections", 1000)
+        self.endpointConcurrency = cfg.get("endpointConcurrency", 1000)
+
+        self.asession = None
+        self.semaphores = {}
+
+        # Set whenever the circuit breaker of the endpoint releases a slot (also by the spool/batcher threads)
+        self.slotFreed = {}
+
+    # Set up the connection pool - has to be called on the loop
+    async def open(self):
+        self.asession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+
+        for endpoint in set(self.endpoints.values()) | {"other"}:
+            self.semaphores[endpoint] = asyncio.Semaphore(self.endpointConcurrency)
+
+        loop = asyncio.get_event_loop()
+
+        for endpoint, breaker in self.breakers.items():
+            self.slotFreed[endpoint] = asyncio.Event()
+            breaker.listeners.append(lambda event=self.slotFreed[endpoint]: loop.call_soon_threadsafe(event.set))
+
+    # The default max. concurrency limit of the circuit breakers (HTTPConcurrency is the size of a thread pool)
+    def concurrency(self):
+        return self.context.config.get("AsyncConfig", {}).get("endpointConcurrency", 1000)
+
+    async def aclose(self):
+        if self.asession:
+            await self.asession.close()
+            self.asession = None
+
+    async def averify(self, uuidstr, upp, attempts=None):
+        return await self.apost(self.niomonURL, self.device_headers(uuidstr), attempts, data=upp, ssl=False)
+
+    async def asend_data(self, uuidstr, data, attempts=None):
+        return await self.apost(self.dataURL, self.device_json_headers(uuidstr), attempts, json=data, ssl=False)
+
+    async def aregister_key(self, upp, attempts=None):
+        return await self.apost(self.keyURL, {"Content-Type": "application/octet-stream"}, attempts, data=upp)
+
+    # Like post() - returns the Response or None if all attempts failed (or the circuit of the endpoint is open)
+    async def apost(self, url, headers, attempts=None, **kwargs):
+        attempts_left = attempts or self.attempts
+        endpoint = self.endpoints.get(url, "other")
+        breaker = self.breakers.get(endpoint)
+        attempt = 0
+
+        while True:
+            async with self.semaphores[endpoint]:
+                admitted = await self.__acquire(endpoint, breaker) if breaker else True
+
+                if admitted is None:
+                    self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", "rejected")))
+                    return None
+
+                started = time.monotonic()
+
+                try:
+                    async with self.asession.post(url, headers=headers, **kwargs) as resp:
+                        r = Response(resp.status, await resp.text(), resp.reason)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if breaker:
+                        breaker.release(admitted, False, time.monotonic() - started)
+
+                    self.context.log.error("HTTP POST request to %s failed: %s", endpoint, repr(e))
+                    self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", "error")))
+                else:
+                    if breaker:
+                        breaker.release(admitted, not ubirch_client.post_failed(r), time.monotonic() - started)
+
+                    self.context.metrics.observe("http_" + endpoint, started)
+                    self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", str(r.status_code))))
+                    return r
+
+            attempts_left -= 1
+            attempt += 1
+
+            if attempts_left > 0:
+                await asyncio.sleep(self.retry_delay(attempt))
+            else:
+                self.context.log.error("HTTP POST request finally failed")
+                return None
+
+    # Like CircuitBreaker.acquire(), but waits for a slot on the loop (up to acquireTimeout)
+    async def __acquire(self, endpoint, breaker):
+        deadline = time.monotonic() + breaker.acquireTimeout
+        slotFreed = self.slotFreed[endpoint]
+
+        while True:
+            admitted = breaker.acquire(blocking=False)
+
+            if admitted != circuit_breaker.FULL:
+                return admitted
+
+            # Cleared before the second try - a slot released in between sets it again
+            slotFreed.clear()
+            admitted = breaker.acquire(blocking=False)
+
+            if admitted != circuit_breaker.FULL:
+                return admitted
+
+            try:
+                await asyncio.wait_for(slotFreed.wait(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                breaker.acquire_timed_out()
+                return None
+
+
+class AsyncSubmitter():
+    """ Verifies/uploads measurements and registers keys as tasks of the loop (the interface of MeasurementSubmitter) """
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config["UbirchHTTPConfig"]
+        self.policy = cfg.get("dataUploadPolicy", "independent")
+        self.maxInflight = cfg.get("HTTPMaxInflight", 1000)
+
+        # Per device: the last data upload task - the next one waits for it (keeps them in order)
+        self.chains = {}
+        self.pending = 0
+        self.capacity = asyncio.Event()
+        self.capacity.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        # Called whenever a pending task is done and less than HTTPMaxInflight are pending
+        self.listeners = []
+
+        self.stats = {
+            "submitted": 0,  # how many measurements were submitted
+            "skipped": 0  # how many data uploads were skipped because the verification failed
+        }
+
+    # Returns True if HTTPMaxInflight tasks are pending (backpressure for the ingest)
+    def full(self):
+        return self.pending >= self.maxInflight
+
+    # Wait until less than HTTPMaxInflight tasks are pending
+    async def wait(self):
+        while self.full():
+            await self.capacity.wait()
+
+    # Verify and upload a measurement of a device, returns immediately
+    # verified: the signature was already verified locally (see upp_verifier.py)
+    def submit(self, device, upp, measurements, data_struct, uuid, verified=False):
+        self.stats["submitted"] += 1
+
+        verifyTask = self.__spawn(self.__verify(device, upp, uuid, verified))
+        args = (measurements, data_struct, uuid, device.deviceID, device.app.decoder)
+        uploadTask = self.__spawn(self.__send(device, verifyTask, self.chains.get(device), args))
+
+        self.chains[device] = uploadTask
+        uploadTask.add_done_callback(lambda task: self.chains.pop(device) if self.chains.get(device) is task else None)
+
+    # Send the key registration UPP of a device, returns immediately
+    def register(self, device, upp):
+        self.__spawn(self.__register(device, upp))
+
+    # Wait until all submitted measurements are handled
+    async def drain(self):
+        await self.idle.wait()
+
+    # Return statistics
+    def getStats(self):
+        stats = dict(self.stats)
+        stats["pending"] = self.pending
+
+        return stats
+
+    def __spawn(self, coro):
+        self.pending += 1
+        self.idle.clear()
+
+        if self.pending >= self.maxInflight:
+            self.capacity.clear()
+
+        task = self.context.loop.create_task(coro)
+        task.add_done_callback(self.__done)
+
+        return task
+
+    def __done(self, task):
+        self.pending -= 1
+
+        if self.pending < self.maxInflight:
+            self.capacity.set()
+
+            for listener in self.listeners:
+                listener()
+
+        if self.pending == 0:
+            self.idle.set()
+
+    async def __verify(self, device, upp, uuid, verified):
+        started = time.monotonic()
+
+        try:
+            uuidstr = self.context.uuidbin2str(uuid)
+
+            # Locally verified payloads may be sent later or not at all (see LocalVerifyConfig), deferred ones are
+            # written to the spool
+            if verified:
+                if self.context.verifier.niomon == "defer":
+                    remote = await self.context.offload(self.context.verifier.remote, upp, uuidstr, device.deviceID)
+                else:
+                    remote = self.context.verifier.remote(upp, uuidstr, device.deviceID)
+
+                if not remote:
+                    return True
+
+            r = await self.context.ubirch.averify(uuidstr, upp, self.context.liveAttempts)
+            verified = self.context.verify_result(r, upp, uuidstr, device.deviceID)
+
+            if not verified:
+                device.app.count("verifyFailed")
+
+            return verified
+        except Exception as e:
+            self.context.log.exception(e)
+            device.app.count("verifyFailed")
+            return False
+        finally:
+            self.context.metrics.observe("verify_data", started)
+
+    async def __register(self, device, upp):
+        started = time.monotonic()
+
+        try:
+            r = await self.context.ubirch.aregister_key(upp, self.context.liveAttempts)
+
+            if ubirch_client.post_failed(r):
+                self.context.spoolPost("key", device.deviceID, None, upp)
+
+            device.setRegistrationResponse(r, upp)
+        except Exception as e:
+            self.context.log.exception(e)
+        finally:
+            self.context.metrics.observe("register_device", started)
+
+    async def __send(self, device, verifyTask, previous, args):
+        # The previous upload of this device has to be done first
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        if self.policy != "independent":
+            await asyncio.wait([verifyTask])
+
+        started = time.monotonic()
+
+        try:
+            if self.policy == "onVerifySuccess" and not verifyTask.result():
+                self.context.log.error("[DEV:%s] verification failed - data not uploaded", device.deviceID)
+                self.stats["skipped"] += 1
+            elif not await self.__send_measurements(*args):
+                device.app.count("sendFailed")
+        except Exception as e:
+            self.context.log.exception(e)
+        finally:
+            self.context.metrics.observe("send_measurements", started)
+
+    # Like TTNConnector.send_measurements()
+    async def __send_measurements(self, measurements, data_struct, uuid, dev_id, decoder):
+        # The batching stage does not block
+        if self.context.batcher:
+            return self.context.send_measurements(measurements, data_struct, uuid, dev_id, decoder)
+
+        uuidstr = self.context.uuidbin2str(uuid)
+        data = self.context.data_object(measurements, data_struct, uuidstr, dev_id, decoder)
+        r = await self.context.ubirch.asend_data(uuidstr, data, self.context.liveAttempts)
+
+        return self.context.send_result(r, data, uuidstr, dev_id)
+
+
+class AsyncIngest():
+    """ A bounded queue between the MQTT callbacks and the uplink processing on the loop (the interface of IngestQueue) """
+
+    def __init__(self, context, handler):
+        self.context = context
+        self.handler = handler
+
+        cfg = self.context.config.get("IngestConfig", {})
+        self.queueSize = max(1, cfg.get("queueSize", 1000))
+        self.policy = ingest.LanePolicy(context, cfg)
+
+        # Uplinks per lane, each lane holds up to queueSize - the control lane is taken first, each lane in order
+        self.lanes = [collections.deque(), collections.deque()]
+        self.task = None
+        self.stopping = False
+
+        # Set when an uplink is put or a slot of HTTPMaxInflight got free
+        self.wakeup = asyncio.Event()
+
+        self.stats = {
+            "enqueued": 0,  # how many uplinks were put into the queue
+            "processed": 0,  # how many uplinks were handled
+            "overflows": 0,  # how many uplinks found the queue full
+            "dropped": 0,  # how many uplinks were dropped because the queue was full
+            "prioritized": 0,  # how many uplinks were put into the control lane
+            "shedDropped": 0,  # how many uplinks were dropped by the shedding policy
+            "shedSpooled": 0  # how many measurements were spooled by the shedding policy
+        }
+
+    def start(self):
+        self.context.submitter.listeners.append(self.wakeup.set)
+        self.task = self.context.loop.create_task(self.__consume())
+
+    # Stop after the queued uplinks are processed
+    async def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+
+    # Put an uplink into the queue, to be called on the loop
+    # Returns False if the uplink had to be dropped (or was shed)
+    def put(self, raw_payload, dev_id, appID=None):
+        ctrl = ingest.control_byte(raw_payload)
+        lane = self.policy.lane(ctrl)
+
+        # Shed low priority messages while the queue is (nearly) full
+        if lane == ingest.BULK:
+            action = self.policy.shed(ctrl, len(self.lanes[lane]) / self.queueSize, raw_payload, dev_id, appID,
+                                      self.__spool)
+
+            if action:
+                self.stats["shedDropped" if action == "drop" else "shedSpooled"] += 1
+                return False
+
+        if len(self.lanes[lane]) >= self.queueSize:
+            self.stats["overflows"] += 1
+            self.stats["dropped"] += 1
+            self.context.log.warning("[DEV:%s] ingest queue full - uplink dropped", dev_id)
+            return False
+
+        self.lanes[lane].append((raw_payload, dev_id, time.monotonic(), appID))
+        self.wakeup.set()
+        self.stats["enqueued"] += 1
+
+        if lane == ingest.CONTROL:
+            self.stats["prioritized"] += 1
+
+        return True
+
+    # Call fn(*args) for a device - the timers and the uplinks are all handled on the loop thread
+    def call(self, dev_id, fn, *args):
+        fn(*args)
+
+    # Return the number of uplinks waiting to be processed
+    def depth(self):
+        return len(self.lanes[ingest.CONTROL]) + len(self.lanes[ingest.BULK])
+
+    # Write a shed measurement to the spool in the executor (see AsyncConnector.offload)
+    # Returns True, a failed write is logged by the spool
+    def __spool(self, raw_payload, dev_id, appID):
+        self.context.offload(self.policy.spool_uplink, raw_payload, dev_id, appID)
+
+        return True
+
+    # Return statistics
+    def getStats(self):
+        stats = dict(self.stats)
+        stats["depth"] = self.depth()
+
+        return stats
+
+    # The uplinks are processed one after the other, so the messages of a device stay in order (within a lane)
+    async def __consume(self):
+        control, bulk = self.lanes[ingest.CONTROL], self.lanes[ingest.BULK]
+
+        while True:
+            # Do not start more Ubirch requests than HTTPMaxInflight - only bulk uplinks wait for it, control messages
+            # hardly cause any and are not held up behind them
+            if control:
+                item = control.popleft()
+            elif bulk and not self.context.submitter.full():
+                item = bulk.popleft()
+            elif self.stopping and not bulk:
+                break
+            else:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            self.context.metrics.observe("ingest_queue_wait", item[2])
+
+            try:
+                self.handler(item[0], item[1], item[3])
+            except Exception as e:
+                self.context.log.exception(e)
+            finally:
+                self.stats["processed"] += 1
+
+
+class AsyncMQTTConnection():
+    """ The MQTT connection of a TTN application with gmqtt (the interface of MQTTConnection) """
+
+    # appConfig holds the appID/appAccessKey and the MQTT address of the TTN application
+    def __init__(self, context, appConfig):
+        self.context = context
+        self.appConfig = appConfig
+        self.appID = appConfig["appID"]
+        self.handler = None
+
+        self.client = gmqtt.Client("ttn-ubirch-connector-%s" % self.appID)
+        self.client.set_auth_credentials(self.appID, appConfig["appAccessKey"])
+        self.client.on_connect = self.__on_connect
+        self.client.on_message = self.__on_message
+
+    async def connect(self):
+        host, _, port = self.appConfig.get("mqttAddress", "eu.thethings.network:1883").partition(":")
+
+        await self.client.connect(host, int(port or 1883), ssl=self.appConfig.get("mqttTLS", False), version=MQTTv311)
+
+    async def disconnect(self):
+        await self.client.disconnect()
+
+    # The application client of the TTN handler, used to get the device list (blocking - not called on the loop)
+    @property
+    def app_client(self):
+        if self.handler is None:
+            self.handler = ttn.HandlerClient(self.appID, self.appConfig["appAccessKey"]).application()
+
+        return self.handler
+
+    # (Re)subscribe to the uplinks after every (re)connect
+    def __on_connect(self, client, flags, rc, properties):
+        client.subscribe("%s/devices/+/up" % self.appID, qos=0)
+
+    def __on_message(self, client, topic, payload, qos, properties):
+        started = time.monotonic()
+
+        try:
+            msg = json.loads(payload)
+            self.context.ingest.put(msg.get("payload_raw"), msg["dev_id"], self.appID)
+            self.context.metrics.observe("mqtt_receive", started)
+        except Exception as e:
+            self.context.log.exception(e)
+
+        return 0
+
+    def send(self, deviceID, data):
+        try:
+            self.client.publish("%s/devices/%s/down" % (self.appID, deviceID), json.dumps({
+                "port": 1,
+                "confirmed": False,
+                "payload_raw": str(base64.b64encode(data), "UTF-8"),
+                "schedule": "replace"
+            }), qos=0)
+        except Exception as e:
+            self.context.log.exception(e)
+
+
+class AsyncMQTTLink():
+    """ Provides the AsyncMQTTConnections to TTNApplication.connect() """
+
+    def __init__(self, context):
+        self.context = context
+        self.connections = []
+
+    def app(self, appID):
+        connection = AsyncMQTTConnection(self.context, self.context.apps[appID].config)
+        self.connections.append(connection)
+
+        return connection
+
+    # Connect all applications (retried every five seconds)
+    async def connect(self):
+        for connection in self.connections:
+            while True:
+                self.context.log.info("setting up MQTT connection to TTN (app %s) ...", connection.appID)
+
+                try:
+                    await connection.connect()
+                    break
+                except Exception as e:
+                    self.context.log.error("setting up MQTT connection failed (app %s)!", connection.appID)
+                    self.context.log.exception(e)
+                    await asyncio.sleep(5)
+
+    async def disconnect(self):
+        for connection in self.connections:
+            await connection.disconnect()
+
+
+class AsyncConnector(ttn_connector.TTNConnector):
+    """ The connector on an asyncio event loop - reuses the message handlers, devices and Ubirch stages """
+
+    # link is used instead of the gmqtt connections, it must provide app(appID), connect() and disconnect()
+    def __init__(self, config=None, link=None):
+        if aiohttp is None or (gmqtt is None and link is None):
+            raise ImportError("the asyncio runtime needs aiohttp and gmqtt (pip install -r requirements-async.txt)")
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # Set up the decoding and Ubirch stages - the loop based ones replace the thread based ones below
+        super().__init__(config, offline=True)
+
+        self.scheduler = LoopScheduler(self.loop)
+        self.ubirch.close()
+        self.ubirch = AsyncUbirchClient(self)
+        self.submitter = AsyncSubmitter(self)
+        self.ingest = AsyncIngest(self, self.ingestCB)
+        self.link = link if link is not None else AsyncMQTTLink(self)
+        self.stopping = asyncio.Event()
+        self.loopThread = None
+
+        # Blocking calls (spool/key store writes) running in the executor
+        self.offloaded = set()
+
+        # The loop must not wait for space in the batcher - a full batcher drops at once
+        if self.batcher:
+            self.batcher.addTimeout = 0
+
+        # The session of the HTTP client is bound to the loop, a changed UbirchHTTPConfig needs a restart
+        self.reloadable = tuple(s for s in connector_config.RELOADABLE if s != "UbirchHTTPConfig")
+
+        if self.config.get("LocalVerifyConfig", {}).get("enabled", False):
+            self.verifier = ttn_connector.upp_verifier.UPPVerifier(self)
+            self.verifier.load()
+
+        # Restore the devices of the last (optional) snapshot before any uplink is handled
+        if self.config.get("SnapshotConfig", {}).get("enabled", False):
+            self.snapshots = ttn_connector.device_snapshot.DeviceSnapshots(self)
+            self.snapshots.restore()
+
+    # Run the loop until stop() is called
+    def run(self):
+        self.loop.run_until_complete(self.__main())
+
+    # Stop the connector, queued uplinks and pending requests are processed first (can be called from any thread)
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    # Run a blocking call (like a file write and sync) in the executor instead of on the loop, to be called on the loop
+    # Returns the future of its result - it is awaited before the connector stops
+    def offload(self, fn, *args):
+        future = self.loop.run_in_executor(None, fn, *args)
+        self.offloaded.add(future)
+        future.add_done_callback(self.offloaded.discard)
+
+        return future
+
+    # The spool writes (and syncs) files - posts that failed on the loop are spooled in the executor
+    # The spool replay and batcher threads write it directly
+    def spoolPost(self, kind, dev_id, uuidstr, body):
+        if not self.spool:
+            return
+
+        if threading.get_ident() == self.loopThread:
+            self.offload(self.spool.append, kind, dev_id, uuidstr, body)
+        else:
+            self.spool.append(kind, dev_id, uuidstr, body)
+
+    async def __main(self):
+        self.loopThread = threading.get_ident()
+        await self.ubirch.open()
+        self.ingest.start()
+
+        for app in self.apps.values():
+            app.connect(self.link)
+
+        await self.link.connect()
+
+        # The device list of TTN is fetched with blocking calls
+        if self.snapshots:
+            self.loop.run_in_executor(None, self.reconcileDevices)
+            self.snapshots.start()
+        else:
+            await self.loop.run_in_executor(None, self.setupDevices)
+
+        self.setupGauges()
+
+        if self.config["OPConfig"].get("deviceRefreshPeriod", 0) > 0:
+            for app in self.apps.values():
+                app.devices.start_refresh(self.config["OPConfig"]["deviceRefreshPeriod"])
+
+        if self.configFile and self.config["OPConfig"].get("configWatchPeriod", 0) > 0:
+            self.watcher = connector_config.ConfigWatcher(self, self.configFile,
+                                                          self.config["OPConfig"]["configWatchPeriod"])
+            self.watcher.start()
+
+        self.log.info("running on the event loop")
+
+        await self.stopping.wait()
+
+        if self.watcher:
+            await self.loop.run_in_executor(None, self.watcher.stop)
+
+        await self.link.disconnect()
+        await self.ingest.stop()
+
+        # The device states are final once the queued uplinks are processed
+        if self.snapshots:
+            await self.loop.run_in_executor(None, self.snapshots.stop)
+
+        await self.submitter.drain()
+        await self.ubirch.aclose()
+
+        if self.offloaded:
+            await asyncio.wait(self.offloaded)
+
+        if self.batcher:
+            self.batcher.stop()
+
+        if self.spool:
+            self.spool.stop()
+
+        # Keep the heads of the UPP chains and the keys registered since the last save
+        if self.verifier:
+            await self.loop.run_in_executor(None, self.verifier.save)
+
+        self.ubirch.close()
+
+        if self.logPipeline:
+            self.logPipeline.stop()
+
+
+if __name__ == "__main__":
+    connector = AsyncConnector()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        connector.loop.add_signal_handler(signum, connector.stopping.set)
+
+    # The reload reads the config file, it runs in the executor
+    connector.loop.add_signal_handler(signal.SIGHUP, connector.loop.run_in_executor, None, connector.reloadConfig)
+
+    connector.run()
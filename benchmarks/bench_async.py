@@ -0,0 +1,156 @@
+## End-to-end load benchmark of the asyncio mode: runs the AsyncConnector with its real gmqtt and aiohttp clients ##
+# against a local MQTT broker stand-in and a fake Ubirch
+# usage: python benchmarks/bench_async.py --devices 100 --rate 500 --duration 10 [--latency 20] [--error-rate 0.01]
+# needs the packages of requirements-async.txt to be installed
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import async_connector
+from bench_e2e import FakeHandlerClient, FakeUplink, UplinkFactory, mk_config, percentile, rss_bytes
+from fake_mqtt import FakeMQTTBroker
+from fake_ubirch import FakeUbirch
+
+
+class BenchAsyncConnector(async_connector.AsyncConnector):
+    """ Records when the data object of a measurement was created for the data service (or the batcher) """
+
+    def __init__(self, config, published):
+        self.published = published
+        self.latencies = []
+        super().__init__(config)
+
+    def data_object(self, measurements, data_struct, uuidstr, dev_id=None, decoder=None):
+        started = self.published.pop(bytes(data_struct), None)
+
+        if started is not None:
+            self.latencies.append(time.monotonic() - started)
+
+        return super().data_object(measurements, data_struct, uuidstr, dev_id, decoder)
+
+
+# Publish the uplinks of the devices to the broker at the target rate, then stop the connector
+def publish(connector, broker, devices, args, published, result):
+    if not broker.subscribed.wait(30):
+        print("the connector did not subscribe to the broker")
+        connector.stop()
+        return
+
+    factories = {dev_id: UplinkFactory(dev_id) for dev_id in devices}
+
+    def send(dev_id, payload):
+        uplink = FakeUplink(dev_id, payload)
+        broker.publish("bench/devices/%s/up" % dev_id,
+                       json.dumps({"dev_id": dev_id, "payload_raw": uplink.payload_raw}).encode())
+
+    # Every device registers its key first
+    for dev_id in devices:
+        for part in factories[dev_id].registration_parts():
+            send(dev_id, part)
+            result["registrationParts"] += 1
+
+    wallStart = time.monotonic()
+    interval = 1.0 / args.rate
+
+    while time.monotonic() - wallStart < args.duration:
+        dev_id = devices[result["sent"] % len(devices)]
+        factory = factories[dev_id]
+        r = random.random()
+
+        if r < args.measurements:
+            payload = factory.measurement()
+            published[factory.lastPayload] = time.monotonic()
+        elif r < args.measurements + (1 - args.measurements) / 2:
+            payload = factory.ping()
+        else:
+            payload = factory.ack()
+
+        send(dev_id, payload)
+        result["sent"] += 1
+
+        delay = wallStart + result["sent"] * interval - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    result["publishSeconds"] = time.monotonic() - wallStart
+
+    # Give the broker a moment to deliver the last messages, the connector drains its queues when stopped
+    time.sleep(0.5)
+    connector.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load benchmark of the asyncio mode of the TTN connector")
+    parser.add_argument("--devices", type=int, default=100, help="number of simulated devices")
+    parser.add_argument("--rate", type=float, default=200, help="target uplinks per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to publish uplinks")
+    parser.add_argument("--latency", type=float, default=20, help="latency of the fake Ubirch in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake Ubirch requests failing with 500")
+    parser.add_argument("--max-concurrency", type=int, default=0,
+                        help="max. concurrency limit of the circuit breakers (default: AsyncConfig endpointConcurrency)")
+    parser.add_argument("--batch", action="store_true", help="enable batched submission to the data service")
+    parser.add_argument("--upload-policy", default="independent", help="dataUploadPolicy of the connector")
+    parser.add_argument("--measurements", type=float, default=0.8, help="share of measurements (the rest are pings/acks)")
+    args = parser.parse_args()
+    args.workers = 1
+
+    server = FakeUbirch(latency=args.latency / 1000.0, errorRate=args.error_rate).start()
+    broker = FakeMQTTBroker().start()
+
+    devices = ["bench-dev-%d" % i for i in range(args.devices)]
+    FakeHandlerClient.devices = devices
+    async_connector.ttn.HandlerClient = FakeHandlerClient
+
+    config = mk_config(server, args)
+    config["TTNAppConfig"]["mqttAddress"] = broker.address()
+
+    if args.max_concurrency > 0:
+        config["UbirchHTTPConfig"]["CircuitBreaker"] = {"maxConcurrency": args.max_concurrency}
+
+    published = {}
+    result = {"sent": 0, "registrationParts": 0, "publishSeconds": 0}
+    connector = BenchAsyncConnector(config, published)
+
+    publisher = threading.Thread(target=publish, args=(connector, broker, devices, args, published, result),
+                                 name="publisher", daemon=True)
+    publisher.start()
+
+    cpuStart = os.times()
+    wallStart = time.monotonic()
+
+    # Runs the loop until the publisher stops the connector
+    connector.run()
+
+    wall = time.monotonic() - wallStart
+    cpuEnd = os.times()
+    cpu = (cpuEnd.user - cpuStart.user) + (cpuEnd.system - cpuStart.system)
+    ingest = connector.ingest.getStats()
+    processed = ingest["processed"] - result["registrationParts"]
+    breakers = connector.ubirch.getBreakerStats()
+
+    print("devices:            %d" % args.devices)
+    print("target rate:        %.0f msgs/s" % args.rate)
+    print("published:          %d msgs in %.2fs" % (result["sent"], result["publishSeconds"]))
+    print("processed:          %d msgs in %.2fs (%.0f msgs/s sustained)" % (processed, wall, processed / wall))
+    print("dropped:            %d (overflows: %d)" % (ingest["dropped"], ingest["overflows"]))
+    print("latency p50/p99:    %.1f / %.1f ms" % (percentile(connector.latencies, 50) * 1000,
+                                                   percentile(connector.latencies, 99) * 1000))
+    print("ubirch requests:    %d (%d items)" % (server.requests, server.items))
+    print("breaker timeouts:   %d" % sum(stats["acquireTimeouts"] for stats in breakers.values()))
+    print("cpu:                %.2fs (%.0f%% of one core)" % (cpu, cpu / wall * 100))
+    print("rss:                %.1f MiB" % (rss_bytes() / 1024.0 / 1024.0))
+
+    server.shutdown()
+    broker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
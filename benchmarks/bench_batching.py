@@ -0,0 +1,76 @@
+## Compares sending measurements one by one with the batched modes of the DataBatcher ##
+# usage: python benchmarks/bench_batching.py [items] [latency in ms]
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import data_batcher
+import metrics
+import ubirch_client
+from fake_ubirch import FakeUbirch
+
+
+class BenchContext():
+    def __init__(self, httpConfig):
+        self.config = {"UbirchHTTPConfig": httpConfig}
+        self.log = logging.getLogger("bench")
+        self.metrics = metrics.NullMetrics()
+        self.liveAttempts = None
+
+    def spoolPost(self, kind, dev_id, uuidstr, body):
+        pass
+
+
+def mk_item(i):
+    return ("dev-%d" % (i % 1000), "00000000-0000-0000-0000-%012d" % (i % 1000),
+            {"uuid": "00000000-0000-0000-0000-%012d" % (i % 1000), "msg_type": 77,
+             "data": {"H": 40.5, "T": 21.25, "L_blue": 1, "L_red": 2}, "timestamp": "2020-01-01T00:00:00"})
+
+
+def report(name, server, items, t):
+    print("%-28s %8.1f requests/s %10.1f items/s  (%d requests, %d items, %.2fs)"
+          % (name, server.requests / t, server.items / t, server.requests, server.items, t))
+
+
+def bench_single(items, latency):
+    server = FakeUbirch(latency=latency).start()
+    ctx = BenchContext(server.http_config())
+    ctx.ubirch = ubirch_client.UbirchClient(ctx)
+
+    t = time.monotonic()
+    for i in range(items):
+        item = mk_item(i)
+        ctx.ubirch.send_data(item[1], item[2])
+    report("unbatched", server, items, time.monotonic() - t)
+    server.shutdown()
+
+
+def bench_batched(items, latency, mode):
+    server = FakeUbirch(latency=latency).start()
+    ctx = BenchContext(server.http_config(DataBatchConfig={
+        "enabled": True, "maxItems": 200, "maxLingerMs": 500, "mode": mode, "concurrency": 8}))
+    ctx.ubirch = ubirch_client.UbirchClient(ctx)
+    batcher = data_batcher.DataBatcher(ctx)
+    batcher.start()
+
+    t = time.monotonic()
+    for i in range(items):
+        batcher.add(*mk_item(i))
+    batcher.stop()
+    report("batched (%s)" % mode, server, items, time.monotonic() - t)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 2.0) / 1000.0
+
+    logging.basicConfig(level=logging.WARNING)
+
+    bench_single(items, latency)
+    bench_batched(items, latency, "concurrent")
+    bench_batched(items, latency, "bulk")
@@ -0,0 +1,73 @@
+## Compares the per-message measurement decoding before and after the MeasurementDecoder ##
+# usage: python benchmarks/bench_decoder.py
+
+import datetime
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import measurement_decoder
+
+CONFIG = {
+    "DataConfig": {
+        "structFormat": "ffiii",
+        "dataLayout": ["H", "T", "L_blue", "L_red", "time"]
+    }
+}
+
+
+# Decoding + building lastMeasurement and the data object as it was done before
+def decode_before(config, payload):
+    measurements = struct.unpack(config["DataConfig"]["structFormat"], bytes(payload))
+
+    lastMeasurement = {}
+    for i in range(0, len(config["DataConfig"]["dataLayout"])):
+        if i >= len(measurements):
+            break
+
+        lastMeasurement.update({config["DataConfig"]["dataLayout"][i]: measurements[i]})
+
+    data = {"data": {}}
+    for i in range(0, len(config["DataConfig"]["dataLayout"])):
+        if i >= len(measurements):
+            break
+
+        if config["DataConfig"]["dataLayout"][i] == "time":
+            data["timestamp"] = datetime.datetime.utcfromtimestamp(measurements[i]).isoformat()
+        else:
+            data["data"].update({config["DataConfig"]["dataLayout"][i]: measurements[i]})
+
+    return lastMeasurement, data
+
+
+def decode_after(decoder, payload):
+    measurements = decoder.decode(payload)
+
+    lastMeasurement = decoder.to_dict(measurements)
+    data = {"data": decoder.data_dict(measurements), "timestamp": decoder.isotime(measurements)}
+
+    return lastMeasurement, data
+
+
+if __name__ == "__main__":
+    decoder = measurement_decoder.MeasurementDecoder(CONFIG["DataConfig"])
+    payload = struct.pack("ffiii", 45.5, 21.25, 100, 200, 1600000000)
+    n = 200000
+
+    assert decode_before(CONFIG, payload) == decode_after(decoder, payload)
+
+    before = min(timeit.repeat(lambda: decode_before(CONFIG, payload), number=n, repeat=3)) / n
+    after = min(timeit.repeat(lambda: decode_after(decoder, payload), number=n, repeat=3)) / n
+    unpack_before = min(timeit.repeat(lambda: struct.unpack(CONFIG["DataConfig"]["structFormat"], bytes(payload)),
+                                      number=n, repeat=3)) / n
+    unpack_after = min(timeit.repeat(lambda: decoder.decode(payload), number=n, repeat=3)) / n
+
+    payloads = [payload] * 10000
+    bulk = min(timeit.repeat(lambda: list(decoder.decode_many(payloads)), number=10, repeat=3)) / (10 * len(payloads))
+
+    print("unpack only           before: %7.3f us   after: %7.3f us" % (unpack_before * 1e6, unpack_after * 1e6))
+    print("unpack + dicts        before: %7.3f us   after: %7.3f us" % (before * 1e6, after * 1e6))
+    print("bulk decode (10k)     %7.3f us per payload" % (bulk * 1e6))
@@ -0,0 +1,147 @@
+## Compares the memory per device of the former dict based device state with the slotted TTNDevice ##
+# usage: python benchmarks/bench_device_memory.py [devices]
+
+import gc
+import logging
+import os
+import struct
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import connector_config
+import measurement_decoder
+import ttn_device
+
+CONFIG = {
+    "LogConfig": {"logLevel": 30, "logFile": "", "logFormat": "%(message)s", "enableJSON": False},
+    "OPConfig": {"disableUbirch": True, "showPing": False, "showMeasurements": False},
+    "TTNAppConfig": {"appID": "bench", "appAccessKey": "bench"},
+    "TTNDeviceConfig": {"allowedMessageDelay": 30, "allowedClockOffset": 30},
+    "UbirchHTTPConfig": {
+        "UbirchENV": "bench",
+        "UbirchPASS": "",
+        "UbirchKEY": "http://key.%s.invalid",
+        "UbirchDATA": "http://data.%s.invalid",
+        "UbirchNIOMON": "http://niomon.%s.invalid",
+        "HTTPPostTimeout": 5,
+        "HTTPPostAttempts": 1
+    },
+    "DataConfig": {
+        "structFormat": "ffiii",
+        "dataLayout": ["H", "T", "L_blue", "L_red", "time"]
+    }
+}
+
+
+class BenchContext():
+    def __init__(self):
+        self.config = CONFIG
+        self.settings = connector_config.compile_config(CONFIG)
+        self.log = logging.getLogger("bench")
+
+
+class BenchApp():
+    def __init__(self):
+        self.decoder = measurement_decoder.MeasurementDecoder(CONFIG["DataConfig"])
+
+
+# The key registration state every device held before (allocated with the device)
+class ReassemblerBefore():
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.buffer = None
+        self.chunkSize = 0
+        self.received = 0
+        self.last = -1
+        self.lastChunk = None
+        self.length = 0
+
+
+# The device state as it was held before
+class DeviceBefore():
+    def __init__(self, context, deviceID, app):
+        self.context = context
+        self.deviceID = deviceID
+        self.app = app
+        self.registration = ReassemblerBefore(1024)
+        self.registration_upp = None
+        self.stats = {
+            "totalMeasurements": 0,
+            "measurementsSinceTimesync": 0,
+            "uplinksReceived": 0,
+            "downlinksSent": 0,
+            "pendingAckT": 0,
+            "pendingDataResponseT": 0,
+            "pendingMeasurementT": 0,
+            "pendingRegistrationT": 0,
+            "execOnAck": None,
+            "lastMeasurement": {}
+        }
+        self.timers = {}
+
+    def setMeasurement(self, measurements):
+        self.stats["lastMeasurement"].update(self.app.decoder.to_dict(measurements))
+        self.stats["measurementsSinceTimesync"] += 1
+        self.stats["totalMeasurements"] += 1
+
+    def setAckAction(self):
+        def onAck():
+            self.context.log.info("[DEV:%s] cfg val set" % self.deviceID)
+
+        self.stats["execOnAck"] = onAck
+
+
+class DeviceAfter(ttn_device.TTNDevice):
+    __slots__ = ()
+
+    def setAckAction(self):
+        self.ackAction = ttn_device.AckAction.SET_CFG_VAL
+
+
+# Bytes allocated per device for n devices with one measurement each (and a pending ack action if withAck)
+def bytes_per_device(cls, n, withAck):
+    context = BenchContext()
+    app = BenchApp()
+    payloads = [struct.pack("ffiii", 45.5, 21.25, i, i + 1, 1600000000 + i) for i in range(n)]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    devices = {}
+
+    for i in range(n):
+        device = cls(context, "dev-%d" % i, app)
+        device.setMeasurement(app.decoder.decode(payloads[i]))
+
+        if withAck:
+            device.setAckAction()
+
+        devices[device.deviceID] = device
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return used / n
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    # Both variants have to expose the same state
+    device = DeviceAfter(BenchContext(), "dev", BenchApp())
+    device.setMeasurement(device.app.decoder.decode(struct.pack("ffiii", 45.5, 21.25, 1, 2, 1600000000)))
+    reference = DeviceBefore(BenchContext(), "dev", BenchApp())
+    reference.setMeasurement(reference.app.decoder.decode(struct.pack("ffiii", 45.5, 21.25, 1, 2, 1600000000)))
+    assert dict(device.getLastMeasurement()) == reference.stats["lastMeasurement"]
+
+    print("%d devices" % n)
+    print("%20s %16s %16s" % ("state", "before [B/dev]", "after [B/dev]"))
+
+    for name, withAck in (("measurement", False), ("measurement + ack", True)):
+        print("%20s %16.0f %16.0f" % (name, bytes_per_device(DeviceBefore, n, withAck),
+                                      bytes_per_device(DeviceAfter, n, withAck)))
@@ -0,0 +1,77 @@
+## Compares parse + dispatch of the former if/elif chain with the mprotocol.Dispatcher ##
+# usage: python benchmarks/bench_dispatch.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mprotocol
+
+TYPES = mprotocol.MP_CTRL_B_TYPES
+
+
+def handler(data, device):
+    pass
+
+
+# Parsing as it was done before
+def unpack_mp_msg(mp_msg_b):
+    retval = {}
+
+    retval["MSG_CTRL_B"] = mp_msg_b[0]
+
+    if retval["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_MEASUREMENTS"]\
+            or retval["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_CFG_VAL_RESP"]\
+            or retval["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_REGISTER_KEY_PART"]:
+        retval["MSG_DATA"] = mp_msg_b[1:]
+
+    return retval
+
+
+# Parse + dispatch as it was done before the dispatcher
+def dispatch_before(msg, device):
+    mp_msg_unpacked = unpack_mp_msg(msg)
+
+    if mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_MEASUREMENTS"]:
+        handler(mp_msg_unpacked["MSG_DATA"], device)
+    elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_PING"]:
+        handler(None, device)
+    elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_ACK"]:
+        handler(None, device)
+    elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_NACK"]:
+        handler(None, device)
+    elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_CFG_VAL_RESP"]:
+        handler(mp_msg_unpacked["MSG_DATA"], device)
+    elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_REGISTER_KEY_PART"]:
+        handler(mp_msg_unpacked["MSG_DATA"], device)
+
+
+def run(dispatch, msgs, rounds):
+    t = time.perf_counter()
+
+    for _ in range(rounds):
+        for msg in msgs:
+            dispatch(msg, None)
+
+    return len(msgs) * rounds / (time.perf_counter() - t)
+
+
+if __name__ == "__main__":
+    dispatcher = mprotocol.Dispatcher()
+    for name in ("MSG_MEASUREMENTS", "MSG_PING", "MSG_ACK", "MSG_NACK", "MSG_CFG_VAL_RESP", "MSG_REGISTER_KEY_PART"):
+        dispatcher.register(TYPES[name], handler)
+
+    # A measurement UPP is ~ 170 bytes, a key registration part ~ 50 bytes
+    mixes = {
+        "measurements": [bytes([TYPES["MSG_MEASUREMENTS"]]) + bytes(170)],
+        "registration parts": [bytes([TYPES["MSG_REGISTER_KEY_PART"]]) + bytes(50)],
+        "mixed": [bytes([TYPES["MSG_MEASUREMENTS"]]) + bytes(170), bytes([TYPES["MSG_PING"]]),
+                  bytes([TYPES["MSG_ACK"]]), bytes([TYPES["MSG_REGISTER_KEY_PART"]]) + bytes(50)]
+    }
+
+    for name, msgs in mixes.items():
+        before = run(dispatch_before, msgs, 200000 // len(msgs))
+        after = run(dispatcher.dispatch, msgs, 200000 // len(msgs))
+        print("%-20s before: %10.0f msgs/s   after: %10.0f msgs/s" % (name, before, after))
@@ -0,0 +1,267 @@
+## End-to-end load benchmark: runs the TTNConnector against an injected fake TTN handler and a fake Ubirch ##
+# usage: python benchmarks/bench_e2e.py --devices 100 --rate 500 --duration 10 [--latency 20] [--error-rate 0.01]
+# needs the connector's dependencies (ttn, requests, msgpack, json_logging) to be installed
+
+import argparse
+import base64
+import os
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import msgpack
+import mprotocol
+import mqtt_connection
+import ttn_connector
+from fake_ubirch import FakeUbirch
+
+TYPES = mprotocol.MP_CTRL_B_TYPES
+
+
+class FakeDevice():
+    def __init__(self, dev_id):
+        self.dev_id = dev_id
+
+
+class FakeUplink():
+    def __init__(self, dev_id, payload):
+        self.dev_id = dev_id
+        self.payload_raw = str(base64.b64encode(payload), "UTF-8")
+
+
+class FakeApplicationClient():
+    def __init__(self, devices):
+        self.devs = [FakeDevice(dev_id) for dev_id in devices]
+
+    def devices(self):
+        return self.devs
+
+
+class FakeMQTTClient():
+    def __init__(self):
+        self.uplinkCB = None
+        self.downlinks = 0
+
+    def set_uplink_callback(self, cb):
+        self.uplinkCB = cb
+
+    def connect(self):
+        pass
+
+    def send(self, dev_id, payload, port, conf, sched):
+        self.downlinks += 1
+
+
+class FakeHandlerClient():
+    """ Stands in for ttn.HandlerClient - the benchmark publishes uplinks through its MQTT client """
+
+    devices = []
+    instance = None
+
+    def __init__(self, app_id, access_key):
+        self.mqtt = FakeMQTTClient()
+        FakeHandlerClient.instance = self
+
+    def application(self):
+        return FakeApplicationClient(FakeHandlerClient.devices)
+
+    def data(self):
+        return self.mqtt
+
+
+class UplinkFactory():
+    """ Creates Kellersensor-style uplinks (signed UPPs, pings, acks, key registration parts) """
+
+    def __init__(self, dev_id):
+        self.uuid = struct.pack(">QQ", random.getrandbits(64), random.getrandbits(64))
+        self.prevSig = bytes(64)
+        self.counter = 0
+        self.lastPayload = None
+
+    def measurement(self):
+        self.counter += 1
+        payload = struct.pack("ffiii", 40 + random.random(), 20 + random.random(), self.counter, 0, int(time.time()))
+        # The signature is random (the fake niomon does not check it) - it makes every uplink unique
+        sig = os.urandom(64)
+        upp = msgpack.packb([0x23, self.uuid, self.prevSig, 0x00, payload, sig], use_bin_type=True)
+        self.prevSig = sig
+        self.lastPayload = payload
+
+        return bytes([TYPES["MSG_MEASUREMENTS"]]) + upp
+
+    def ping(self):
+        return bytes([TYPES["MSG_PING"]])
+
+    def ack(self):
+        return bytes([TYPES["MSG_ACK"]])
+
+    def registration_parts(self):
+        upp = msgpack.packb([0x22, self.uuid, 0x01, {"pubKey": os.urandom(32)}, os.urandom(64)], use_bin_type=True)
+        chunks = [upp[i:i + 40] for i in range(0, len(upp), 40)]
+        parts = []
+
+        for i, chunk in enumerate(chunks):
+            flags = 0b10000000 if i == len(chunks) - 1 else 0
+            parts.append(bytes([TYPES["MSG_REGISTER_KEY_PART"], flags | i]) + chunk)
+
+        return parts
+
+
+class BenchConnector(ttn_connector.TTNConnector):
+    """ Records when the data of a measurement was handed to the data service (or the batcher) """
+
+    def __init__(self, config, published):
+        self.published = published
+        self.latencies = []
+        self.latencyLock = threading.Lock()
+        super().__init__(config)
+
+    # With batching
+    def send_measurements(self, measurements, data_struct, uuid, dev_id=None, decoder=None):
+        result = super().send_measurements(measurements, data_struct, uuid, dev_id, decoder)
+        self.record(bytes(data_struct))
+
+        return result
+
+    # Without batching the submitter handles the response of the data service itself
+    def send_result(self, r, data, uuidstr, dev_id=None):
+        result = super().send_result(r, data, uuidstr, dev_id)
+        self.record(base64.b64decode(data["hash"]))
+
+        return result
+
+    def record(self, payload):
+        started = self.published.pop(payload, None)
+
+        if started is not None:
+            with self.latencyLock:
+                self.latencies.append(time.monotonic() - started)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def mk_config(server, args):
+    return {
+        "LogConfig": {"logLevel": 40, "logFile": "/dev/null", "enableJSON": False, "logFormat": "%(message)s"},
+        "OPConfig": {"disableUbirch": False, "showPing": False, "showMeasurements": False, "tickPeriod": 10},
+        "IngestConfig": {"workers": args.workers, "queueSize": 10000},
+        "TTNAppConfig": {"appID": "bench", "appAccessKey": "bench"},
+        "TTNDeviceConfig": {"allowedMessageDelay": 30, "allowedClockOffset": 30},
+        "DataConfig": {"structFormat": "ffiii", "dataLayout": ["H", "T", "L_blue", "L_red", "time"]},
+        "UbirchHTTPConfig": server.http_config(HTTPPoolSize=max(10, args.workers), dataUploadPolicy=args.upload_policy,
+                                               DataBatchConfig={"enabled": args.batch, "mode": "bulk"})
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load benchmark of the TTN connector")
+    parser.add_argument("--devices", type=int, default=100, help="number of simulated devices")
+    parser.add_argument("--rate", type=float, default=200, help="target uplinks per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to publish uplinks")
+    parser.add_argument("--latency", type=float, default=20, help="latency of the fake Ubirch in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake Ubirch requests failing with 500")
+    parser.add_argument("--workers", type=int, default=8, help="ingest workers")
+    parser.add_argument("--batch", action="store_true", help="enable batched submission to the data service")
+    parser.add_argument("--upload-policy", default="independent", help="dataUploadPolicy of the connector")
+    parser.add_argument("--measurements", type=float, default=0.8, help="share of measurements (the rest are pings/acks)")
+    args = parser.parse_args()
+
+    server = FakeUbirch(latency=args.latency / 1000.0, errorRate=args.error_rate).start()
+
+    devices = ["bench-dev-%d" % i for i in range(args.devices)]
+    FakeHandlerClient.devices = devices
+    mqtt_connection.ttn.HandlerClient = FakeHandlerClient
+
+    published = {}
+    connector = BenchConnector(mk_config(server, args), published)
+    connector.scheduler.start()
+    uplinkCB = FakeHandlerClient.instance.mqtt.uplinkCB
+
+    factories = {dev_id: UplinkFactory(dev_id) for dev_id in devices}
+
+    # Every device registers its key first
+    registrationParts = 0
+
+    for dev_id in devices:
+        for part in factories[dev_id].registration_parts():
+            uplinkCB(FakeUplink(dev_id, part), None)
+            registrationParts += 1
+
+    cpuStart = os.times()
+    wallStart = time.monotonic()
+    sent = 0
+    interval = 1.0 / args.rate
+
+    # Publish at the target rate
+    while time.monotonic() - wallStart < args.duration:
+        dev_id = devices[sent % len(devices)]
+        factory = factories[dev_id]
+        r = random.random()
+
+        if r < args.measurements:
+            payload = factory.measurement()
+        elif r < args.measurements + (1 - args.measurements) / 2:
+            payload = factory.ping()
+        else:
+            payload = factory.ack()
+
+        msg = FakeUplink(dev_id, payload)
+
+        # Latency is measured for measurements (their payloads are unique)
+        if r < args.measurements:
+            published[factory.lastPayload] = time.monotonic()
+
+        uplinkCB(msg, None)
+        sent += 1
+
+        delay = wallStart + sent * interval - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    publishEnd = time.monotonic()
+
+    # Let the connector drain its queues
+    connector.stop()
+
+    wall = time.monotonic() - wallStart
+    cpuEnd = os.times()
+    cpu = (cpuEnd.user - cpuStart.user) + (cpuEnd.system - cpuStart.system)
+    ingest = connector.ingest.getStats()
+    processed = ingest["processed"] - registrationParts
+
+    print("devices:            %d" % args.devices)
+    print("target rate:        %.0f msgs/s" % args.rate)
+    print("published:          %d msgs in %.2fs (%.0f msgs/s)" % (sent, publishEnd - wallStart, sent / (publishEnd - wallStart)))
+    print("processed:          %d msgs in %.2fs (%.0f msgs/s sustained)" % (processed, wall, processed / wall))
+    print("dropped:            %d (overflows: %d)" % (ingest["dropped"], ingest["overflows"]))
+    print("latency p50/p99:    %.1f / %.1f ms" % (percentile(connector.latencies, 50) * 1000,
+                                                   percentile(connector.latencies, 99) * 1000))
+    print("ubirch requests:    %d (%d items)" % (server.requests, server.items))
+    print("cpu:                %.2fs (%.0f%% of one core)" % (cpu, cpu / wall * 100))
+    print("rss:                %.1f MiB" % (rss_bytes() / 1024.0 / 1024.0))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
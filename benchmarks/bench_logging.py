@@ -0,0 +1,128 @@
+## Compares the logging overhead per measurement uplink (on the message thread) before and after the LogPipeline ##
+# usage: python benchmarks/bench_logging.py [messages] [devices] [write latency in ms]
+
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import log_pipeline
+
+FORMAT = "[%(asctime)s]--[%(levelname)-8s]  %(message)s"
+
+DATA = {
+    "uuid": "76ff345d-9068-0a26-2d94-863a0456b5ff",
+    "msg_type": 77,
+    "data": {"H": 40.35874557495117, "T": 20.867382049560547, "L_blue": 1, "L_red": 0},
+    "hash": "W28hQmbwpkEBAAAAAAAAAIEK1Go=",
+    "timestamp": "2020-09-13T12:26:40"
+}
+
+
+# A file handler where every write takes latency seconds longer (like a slow disk or a full pipe)
+class SlowFileHandler(logging.FileHandler):
+    def __init__(self, path, latency):
+        super().__init__(path)
+        self.latency = latency
+
+    def emit(self, record):
+        if self.latency:
+            time.sleep(self.latency)
+
+        super().emit(record)
+
+
+# The log calls of a measurement uplink as they were done before (eager formatting + print of the data object)
+def message_before(log, dev_id, out):
+    log.debug("verifying payload with UBirch")
+    log.debug("payload validation succeeded")
+    if out.latency:
+        time.sleep(out.latency)
+
+    print(DATA, file=out)
+    log.info("sending data to UBirch")
+    log.debug("data successfully sent to ubirch")
+    log.debug("[DEV:%s] checking the current time of the device - %d" % (dev_id, 1600000000))
+
+
+# The same log calls now
+def message_after(log, dev_id, out):
+    log.debug("[DEV:%s] verifying payload with UBirch", dev_id)
+    log.debug("[DEV:%s] payload validation succeeded", dev_id)
+    log.debug("[DEV:%s] data object: %s", dev_id, DATA)
+    log.debug("[DEV:%s] sending data to UBirch", dev_id)
+    log.debug("[DEV:%s] data successfully sent to ubirch", dev_id)
+    log.debug("[DEV:%s] checking the current time of the device - %d", dev_id, 1600000000)
+
+
+class SlowWriter():
+    def __init__(self, f, latency):
+        self.f = f
+        self.latency = latency
+
+    def write(self, s):
+        return self.f.write(s)
+
+
+# Returns the time per message spent on the message thread and the total time until everything was written
+def run(variant, level, n, devices, path, latency, deviceDebugRate=0):
+    log = logging.getLogger("bench-%s-%d-%d" % (variant.__name__, level, deviceDebugRate))
+    log.setLevel(level)
+    log.propagate = False
+
+    fh = SlowFileHandler(path, latency)
+    fh.setFormatter(logging.Formatter(FORMAT))
+    pipeline = None
+
+    if variant is message_after:
+        pipeline = log_pipeline.LogPipeline(log, [fh], 0, deviceDebugRate)
+        pipeline.start()
+    else:
+        log.addHandler(fh)
+
+    devIDs = ["dev-%d" % i for i in range(devices)]
+
+    with open(path, "a") as out:
+        out = SlowWriter(out, latency)
+
+        started = time.perf_counter()
+
+        for i in range(n):
+            variant(log, devIDs[i % devices], out)
+
+        hotPath = time.perf_counter() - started
+
+        if pipeline:
+            pipeline.stop()
+
+        total = time.perf_counter() - started
+
+    fh.close()
+
+    return hotPath / n * 1e6, total / n * 1e6
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0
+
+    print("%d messages of %d devices, logging into a file (%.2f ms per write)" % (n, devices, latency * 1000))
+    print("%8s %34s %16s %16s" % ("level", "variant", "thread [us/msg]", "total [us/msg]"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.log")
+
+        for level in (logging.DEBUG, logging.INFO):
+            for name, variant, rate in (("before (sync, eager, print)", message_before, 0),
+                                        ("after (queue, lazy)", message_after, 0),
+                                        ("after (queue, lazy, 10/s/device)", message_after, 10)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+                thread, total = run(variant, level, n, devices, path, latency, rate)
+                print("%8s %34s %16.1f %16.1f" % (logging.getLevelName(level), name, thread, total))
@@ -0,0 +1,47 @@
+## Compares the device lookup of the former linear device list with the DeviceRegistry ##
+# usage: python benchmarks/bench_registry.py
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import device_registry
+
+
+class BenchContext():
+    def __init__(self):
+        self.config = {}
+        self.log = logging.getLogger("bench")
+
+
+# The lookup as it was done before the registry
+def linear_lookup(devices, dev_id):
+    for deviceObj in devices:
+        if deviceObj["ID"] == dev_id:
+            return deviceObj
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    lookups = 1000
+
+    print("%10s %16s %16s" % ("devices", "linear [us]", "registry [us]"))
+
+    for n in (10, 100, 1000, 10000, 100000):
+        registry = device_registry.DeviceRegistry(BenchContext())
+        devices = []
+
+        for i in range(n):
+            device = registry.get_or_create("dev-%d" % i)
+            devices.append({"ID": "dev-%d" % i, "device": device})
+
+        # Look up the devices spread over the whole list
+        ids = ["dev-%d" % (i * n // lookups) for i in range(lookups)]
+
+        linear = timeit.timeit(lambda: [linear_lookup(devices, dev_id) for dev_id in ids], number=1)
+        hashed = min(timeit.repeat(lambda: [registry.get(dev_id) for dev_id in ids], number=1, repeat=5))
+
+        print("%10d %16.3f %16.3f" % (n, linear / lookups * 1e6, hashed / lookups * 1e6))
@@ -0,0 +1,185 @@
+## A local stand-in for the MQTT broker of TTN used by the benchmarks (MQTT 3.1.1, QoS 0 only) ##
+
+import socketserver
+import struct
+import threading
+
+# Packet types (the high nibble of the first byte)
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+
+# Encode the remaining length of a packet
+def encode_length(n):
+    out = bytearray()
+
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    data = s.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def publish_packet(topic, payload):
+    body = encode_string(topic) + payload
+    return bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+
+
+# Returns True if a topic matches a subscription filter (with + and # wildcards)
+def topic_matches(pattern, topic):
+    pattern, topic = pattern.split("/"), topic.split("/")
+
+    for i, level in enumerate(pattern):
+        if level == "#":
+            return True
+
+        if i >= len(topic) or (level != "+" and level != topic[i]):
+            return False
+
+    return len(pattern) == len(topic)
+
+
+class FakeMQTTHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.filters = []
+        self.lock = threading.Lock()
+
+    def handle(self):
+        while True:
+            header = self.__read(1)
+
+            if header is None:
+                break
+
+            length, multiplier = 0, 1
+
+            while True:
+                byte = self.__read(1)
+
+                if byte is None:
+                    return
+
+                length += (byte[0] & 0x7f) * multiplier
+                multiplier *= 128
+
+                if not byte[0] & 0x80:
+                    break
+
+            body = self.__read(length) if length else b""
+
+            if body is None:
+                break
+
+            kind = header[0] >> 4
+
+            if kind == CONNECT:
+                self.send(b"\x20\x02\x00\x00")
+            elif kind == SUBSCRIBE:
+                self.__subscribe(body)
+            elif kind == PUBLISH:
+                self.__publish(header[0], body)
+            elif kind == PINGREQ:
+                self.send(b"\xd0\x00")
+            elif kind == DISCONNECT:
+                break
+
+    def finish(self):
+        self.server.remove(self)
+
+    def send(self, data):
+        with self.lock:
+            self.request.sendall(data)
+
+    def __read(self, n):
+        data = b""
+
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+
+            if not chunk:
+                return None
+
+            data += chunk
+
+        return data
+
+    def __subscribe(self, body):
+        packetID, pos, granted = body[:2], 2, b""
+
+        while pos < len(body):
+            size = struct.unpack(">H", body[pos:pos + 2])[0]
+            self.filters.append(body[pos + 2:pos + 2 + size].decode())
+            pos += 2 + size + 1
+            granted += b"\x00"
+
+        self.send(bytes([0x90]) + encode_length(2 + len(granted)) + packetID + granted)
+        self.server.add(self)
+
+    # Messages of the connector (downlinks) - routed to the other subscribers
+    def __publish(self, flags, body):
+        size = struct.unpack(">H", body[:2])[0]
+        topic = body[2:2 + size].decode()
+        payload = body[2 + size + (2 if flags & 0x06 else 0):]
+
+        with self.server.lock:
+            self.server.published += 1
+
+        self.server.publish(topic, payload, sender=self)
+
+
+class FakeMQTTBroker(socketserver.ThreadingTCPServer):
+    """ Fake MQTT broker - delivers the messages published by the benchmark to the subscribed connector """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), FakeMQTTHandler)
+        self.lock = threading.Lock()
+        self.clients = []
+        self.published = 0  # how many messages the clients published (downlinks)
+        self.subscribed = threading.Event()
+
+    # Start serving in a background thread
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # Return the address in the format of TTNAppConfig "mqttAddress"
+    def address(self):
+        return "127.0.0.1:%d" % self.server_address[1]
+
+    def add(self, client):
+        with self.lock:
+            if client not in self.clients:
+                self.clients.append(client)
+
+        self.subscribed.set()
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    # Send a message to all clients subscribed to the topic
+    def publish(self, topic, payload, sender=None):
+        packet = publish_packet(topic, payload)
+
+        with self.lock:
+            clients = [client for client in self.clients if client is not sender]
+
+        for client in clients:
+            if any(topic_matches(pattern, topic) for pattern in client.filters):
+                try:
+                    client.send(packet)
+                except OSError:
+                    pass
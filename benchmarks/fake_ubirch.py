@@ -0,0 +1,76 @@
+## A local stand-in for the Ubirch niomon, data and key services used by the benchmarks ##
+
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class FakeUbirchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.requests += 1
+
+            # A JSON list is a bulk request to the data service
+            if self.headers.get("Content-Type") == "application/json" and body[:1] == b"[":
+                server.items += len(json.loads(body))
+            else:
+                server.items += 1
+
+        status = 500 if random.random() < server.errorRate else 200
+
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUbirch(http.server.ThreadingHTTPServer):
+    """ Fake Ubirch endpoint with configurable latency (seconds) and error rate (0..1) """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, errorRate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), FakeUbirchHandler)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.items = 0
+
+    # Start serving in a background thread
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # Return the URL template in the format of UbirchHTTPConfig ("%s" is the environment)
+    def url(self, path=""):
+        return "http://127.0.0.1:%d/%s%%s" % (self.server_address[1], path)
+
+    # Return a UbirchHTTPConfig section pointing to this server
+    def http_config(self, **kwargs):
+        cfg = {
+            "UbirchENV": "bench",
+            "UbirchPASS": "bench",
+            "UbirchKEY": self.url("key/"),
+            "UbirchDATA": self.url("data/"),
+            "UbirchDATABulk": self.url("data/bulk/"),
+            "UbirchNIOMON": self.url("niomon/"),
+            "HTTPPostTimeout": 5,
+            "HTTPPostAttempts": 1,
+            "HTTPRetryDelay": 0
+        }
+        cfg.update(kwargs)
+
+        return cfg
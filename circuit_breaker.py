@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+
+# States of a circuit breaker
+CLOSED = "closed"  # requests are sent
+OPEN = "open"  # requests fail fast until the open delay passed
+HALF_OPEN = "half_open"  # one probe request decides whether the circuit closes or opens again
+
+# Returned by acquire(blocking=False) while the concurrency limit is reached
+FULL = "full"
+
+# The value of a state in the breaker_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# The statistics key counting the transitions to a state
+TRANSITIONS = {CLOSED: "closed", HALF_OPEN: "half_opened", OPEN: "opened"}
+
+
+class CircuitBreaker():
+    """ Guards an endpoint - fails fast after consecutive failures and adapts the number of concurrent requests """
+
+    def __init__(self, context, endpoint, cfg):
+        self.context = context
+        self.endpoint = endpoint
+
+        self.failureThreshold = cfg.get("failureThreshold", 5)
+        self.openDelay = cfg.get("openDelay", 1)
+        self.maxOpenDelay = cfg.get("maxOpenDelay", 60)
+        self.latencyTarget = cfg.get("latencyTarget", 3.0)
+        self.acquireTimeout = cfg.get("acquireTimeout", 10)
+        self.minConcurrency = cfg.get("minConcurrency", 1)
+        self.maxConcurrency = cfg.get("maxConcurrency", 16)
+
+        self.cond = threading.Condition()
+        self.state = CLOSED
+        self.failures = 0  # consecutive failures
+        self.trips = 0  # consecutive openings - the open delay doubles with each
+        self.openUntil = 0
+        self.probing = False
+        self.limit = float(self.maxConcurrency)  # concurrency limit, grows by 1 per limit successes
+        self.inflight = 0
+
+        # Called (with self.cond held) whenever a slot is released - for waiters not blocking a thread
+        self.listeners = []
+
+        self.stats = {
+            "rejected": 0,  # how many requests failed fast
+            "acquireTimeouts": 0,  # how many requests failed because no slot got free within acquireTimeout
+            "opened": 0,  # transitions to open
+            "half_opened": 0,  # transitions to half-open
+            "closed": 0  # transitions to closed
+        }
+
+    # Wait for a free slot, returns the state the request was admitted in (pass it to release())
+    # Returns None if the request has to fail fast (the circuit is open or already probed) or no slot got free
+    # within acquireTimeout - the caller handles it like a request without response (e.g. spools it)
+    # blocking=False returns FULL instead of waiting while the limit is reached - for callers waiting themselves,
+    # they are told about released slots by the listeners (see async_connector.py)
+    def acquire(self, blocking=True):
+        deadline = time.monotonic() + self.acquireTimeout
+
+        with self.cond:
+            while True:
+                if self.state == OPEN:
+                    if time.monotonic() < self.openUntil:
+                        self.stats["rejected"] += 1
+                        return None
+
+                    self.__transition(HALF_OPEN)
+
+                if self.state == HALF_OPEN:
+                    if self.probing:
+                        self.stats["rejected"] += 1
+                        return None
+
+                    self.probing = True
+                    self.inflight += 1
+                    return HALF_OPEN
+
+                if self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return CLOSED
+
+                if not blocking:
+                    return FULL
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    self.stats["acquireTimeouts"] += 1
+                    return None
+
+                self.cond.wait(remaining)
+
+    # Report the outcome of an admitted request (latency in seconds)
+    def release(self, admitted, success, latency):
+        with self.cond:
+            self.inflight -= 1
+
+            if admitted == HALF_OPEN:
+                self.probing = False
+
+                if success:
+                    self.failures = 0
+                    self.trips = 0
+                    self.__transition(CLOSED)
+                else:
+                    self.__open()
+            elif success:
+                self.failures = 0
+            else:
+                self.failures += 1
+
+                if self.state == CLOSED and self.failures >= self.failureThreshold:
+                    self.__open()
+
+            # Additive increase while the endpoint is fast and healthy, multiplicative decrease otherwise
+            if success and latency <= self.latencyTarget:
+                self.limit = min(self.maxConcurrency, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(self.minConcurrency, self.limit * 0.75)
+
+            self.cond.notify_all()
+
+            for listener in self.listeners:
+                listener()
+
+    # Count a request that gave up waiting for a slot (the callers of acquire(blocking=False) time out themselves)
+    def acquire_timed_out(self):
+        with self.cond:
+            self.stats["acquireTimeouts"] += 1
+
+    # Return statistics (incl. the current state)
+    def getStats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["state"] = self.state
+            stats["limit"] = int(self.limit)
+            stats["inflight"] = self.inflight
+
+            return stats
+
+    # Helper functions - all expect self.cond to be held #
+    def __open(self):
+        self.trips += 1
+
+        # Exponential backoff with jitter, so the clients of a recovering endpoint do not probe at the same time
+        delay = min(self.maxOpenDelay, self.openDelay * 2 ** (self.trips - 1))
+        self.openUntil = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+        self.__transition(OPEN)
+
+    def __transition(self, state):
+        if state == self.state:
+            return
+
+        self.context.log.warning("circuit of endpoint %s %s (was %s)", self.endpoint, state, self.state)
+
+        self.state = state
+        self.stats[TRANSITIONS[state]] += 1
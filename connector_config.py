@@ -0,0 +1,185 @@
+import collections
+import json
+import os
+import struct
+import threading
+import types
+import measurement_decoder
+import ttn_application
+
+# The OPConfig values read on the message path
+OPSettings = collections.namedtuple("OPSettings", ("disableUbirch", "showPing", "showMeasurements"))
+
+# The TTNDeviceConfig values read on the message path
+DeviceSettings = collections.namedtuple("DeviceSettings", ("allowedMessageDelay", "allowedClockOffset",
+                                                           "registrationTimeout", "registrationMaxBytes"))
+
+# Sections (and LogConfig keys) taking effect on a reload, changes to all others need a restart
+RELOADABLE = ("OPConfig", "TTNDeviceConfig", "DataConfig", "UbirchHTTPConfig", "LogConfig")
+RELOADABLE_LOG_KEYS = ("logLevel",)
+
+# UbirchHTTPConfig keys of the batcher and submitter - they are only read at startup and need a restart
+RESTART_HTTP_KEYS = ("DataBatchConfig", "dataUploadPolicy", "HTTPConcurrency", "HTTPMaxInflight")
+
+# OPConfig keys of the background threads started at startup - they need a restart
+RESTART_OP_KEYS = ("deviceRefreshPeriod", "configWatchPeriod")
+
+# Keys of reloadable sections that keep their current values until a restart: section -> keys
+RESTART_KEYS = {"UbirchHTTPConfig": RESTART_HTTP_KEYS, "OPConfig": RESTART_OP_KEYS}
+
+# Required keys of the sections: key -> expected type(s)
+NUMBER = (int, float)
+REQUIRED = {
+    "LogConfig": {"logLevel": int, "logFile": str, "logFormat": str, "enableJSON": bool},
+    "OPConfig": {"disableUbirch": bool, "showPing": bool, "showMeasurements": bool},
+    "TTNDeviceConfig": {"allowedMessageDelay": NUMBER, "allowedClockOffset": NUMBER},
+    "DataConfig": {"structFormat": str, "dataLayout": list},
+    "UbirchHTTPConfig": {"UbirchENV": str, "UbirchPASS": str, "UbirchKEY": str, "UbirchDATA": str,
+                         "UbirchNIOMON": str, "HTTPPostTimeout": NUMBER, "HTTPPostAttempts": int}
+}
+
+
+class Settings(collections.namedtuple("Settings", ("op", "device", "decoders"))):
+    """ The parsed and validated config - immutable, a reload replaces it as a whole """
+
+    __slots__ = ()
+
+
+# Read a config file (JSON)
+def load(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+# Validate a config and compile the values used on the message path
+# Raises ValueError with a description of the first problem found
+def compile_config(config):
+    for section, keys in REQUIRED.items():
+        if not isinstance(config.get(section), dict):
+            raise ValueError("config: section %s is missing" % section)
+
+        for key, kind in keys.items():
+            value = config[section].get(key)
+
+            # bool is an int, but not a valid number here
+            if value is None or not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+                raise ValueError("config: %s.%s is missing or invalid (%r)" % (section, key, value))
+
+    cfg = config["UbirchHTTPConfig"]
+
+    # The bulk batch mode posts JSON lists - the single item data URL does not take them
+    batchCfg = cfg.get("DataBatchConfig", {})
+
+    if batchCfg.get("enabled", False) and batchCfg.get("mode", "bulk") == "bulk" and "UbirchDATABulk" not in cfg:
+        raise ValueError("config: UbirchHTTPConfig.UbirchDATABulk is needed by the bulk DataBatchConfig mode")
+
+    for key in ("UbirchKEY", "UbirchDATA", "UbirchNIOMON") + (("UbirchDATABulk",) if "UbirchDATABulk" in cfg else ()):
+        try:
+            cfg[key] % cfg["UbirchENV"]
+        except (TypeError, ValueError):
+            raise ValueError("config: UbirchHTTPConfig.%s needs exactly one %%s for the environment" % key)
+
+    # One decoder per application (the global DataConfig is used if the application has no own one)
+    decoders = {}
+
+    for appConfig in ttn_application.app_configs(config):
+        if not isinstance(appConfig, dict) or not appConfig.get("appID") or not appConfig.get("appAccessKey"):
+            raise ValueError("config: every TTNAppConfig needs an appID and appAccessKey")
+
+        if appConfig["appID"] in decoders:
+            raise ValueError("config: TTN application %s is configured twice" % appConfig["appID"])
+
+        try:
+            decoders[appConfig["appID"]] = measurement_decoder.MeasurementDecoder(
+                appConfig.get("DataConfig", config["DataConfig"]))
+        except (KeyError, TypeError, struct.error) as e:
+            raise ValueError("config: DataConfig of %s is invalid (%s)" % (appConfig["appID"], e))
+
+    op = config["OPConfig"]
+    device = config["TTNDeviceConfig"]
+
+    return Settings(
+        op=OPSettings(op["disableUbirch"], op["showPing"], op["showMeasurements"]),
+        device=DeviceSettings(device["allowedMessageDelay"], device["allowedClockOffset"],
+                              device.get("registrationTimeout", 60), device.get("registrationMaxBytes", 1024)),
+        decoders=types.MappingProxyType(decoders))
+
+
+# Return the sections of two configs that differ (in the order of the new config)
+def changed_sections(old, new):
+    return [section for section in list(new) + [s for s in old if s not in new] if old.get(section) != new.get(section)]
+
+
+# Merge a reloaded config into the current one - sections that cannot be reloaded keep their current values
+# Returns the merged config and the changed sections (and keys) that need a restart
+def merge(old, new, reloadable=RELOADABLE):
+    merged = dict(new)
+    restart = []
+
+    for section in changed_sections(old, new):
+        if section == "LogConfig" and section in reloadable and section in old and section in new:
+            # Only the level can be changed
+            if {k: v for k, v in old[section].items() if k not in RELOADABLE_LOG_KEYS} != \
+                    {k: v for k, v in new[section].items() if k not in RELOADABLE_LOG_KEYS}:
+                restart.append(section)
+
+            merged[section] = dict(old[section])
+            merged[section].update((k, new[section][k]) for k in RELOADABLE_LOG_KEYS if k in new[section])
+        elif section in RESTART_KEYS and section in reloadable and section in old and section in new:
+            # The keys only read at startup keep their current values
+            merged[section] = dict(new[section])
+
+            for key in RESTART_KEYS[section]:
+                if old[section].get(key) != new[section].get(key):
+                    restart.append("%s.%s" % (section, key))
+
+                if key in old[section]:
+                    merged[section][key] = old[section][key]
+                else:
+                    merged[section].pop(key, None)
+        elif section not in reloadable:
+            restart.append(section)
+
+            if section in old:
+                merged[section] = old[section]
+            else:
+                del merged[section]
+
+    return merged, restart
+
+
+class ConfigWatcher():
+    """ Reloads the config when its file changes (polls the modification time) """
+
+    def __init__(self, context, path, period):
+        self.context = context
+        self.path = path
+        self.period = period
+        self.stopped = threading.Event()
+        self.thread = None
+        self.mtime = self.__mtime()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__watch_loop, name="config-watch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def __watch_loop(self):
+        while not self.stopped.wait(self.period):
+            mtime = self.__mtime()
+
+            if mtime is not None and mtime != self.mtime:
+                self.mtime = mtime
+                self.context.reloadConfig()
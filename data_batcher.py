@@ -0,0 +1,207 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DataBatcher():
+    """ Collects measurement objects of all devices and sends them to the Ubirch data service in batches """
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config["UbirchHTTPConfig"].get("DataBatchConfig", {})
+        self.maxItems = max(1, cfg.get("maxItems", 200))
+        self.maxLinger = cfg.get("maxLingerMs", 500) / 1000.0
+        self.mode = cfg.get("mode", "bulk")
+        self.concurrency = max(1, cfg.get("concurrency", 4))
+        self.maxPending = max(self.maxItems, cfg.get("maxPending", 10000))
+        self.addTimeout = cfg.get("addTimeout", 0.5)
+
+        if self.mode not in ("bulk", "concurrent"):
+            raise ValueError("unknown data batch mode: %s" % self.mode)
+
+        # Pending items: (dev_id, uuidstr, data)
+        self.items = []
+        self.firstItemT = 0
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+
+        # Notified when a batch was taken from the pending items (add() waits for it while maxPending are pending)
+        self.space = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+        # Used to send the items of a batch concurrently (mode "concurrent")
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix="data-batch")
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "batches": 0,  # how many batches were flushed
+            "requests": 0,  # how many HTTP requests were made
+            "itemsSent": 0,  # how many items were accepted by the data service
+            "itemsFailed": 0,  # how many items could not be sent
+            "itemsDropped": 0  # how many items found maxPending items pending (spooled if enabled)
+        }
+
+    # Start the flushing thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name="data-batcher", daemon=True)
+        self.thread.start()
+
+    # Stop the flushing thread, pending items are flushed
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        self.executor.shutdown(wait=True)
+
+    # Add a measurement object of a device to the current batch
+    # While maxPending items are pending it waits up to addTimeout seconds for a batch to be taken (backpressure),
+    # returns False if the item had to be dropped
+    def add(self, dev_id, uuidstr, data):
+        with self.cond:
+            if len(self.items) >= self.maxPending:
+                deadline = time.monotonic() + self.addTimeout
+
+                while len(self.items) >= self.maxPending:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        break
+
+                    self.space.wait(remaining)
+
+            dropped = len(self.items) >= self.maxPending
+
+            if not dropped:
+                if not self.items:
+                    self.firstItemT = time.monotonic()
+
+                self.items.append((dev_id, uuidstr, data))
+
+                if len(self.items) >= self.maxItems:
+                    self.cond.notify()
+
+        if dropped:
+            self.__count("itemsDropped")
+            self.context.log.warning("[DEV:%s] data batcher full - measurement dropped", dev_id)
+            self.context.spoolPost("data", dev_id, uuidstr, data)
+            return False
+
+        return True
+
+    # Return statistics
+    def getStats(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+
+        with self.cond:
+            stats["pending"] = len(self.items)
+
+        return stats
+
+    def __count(self, key, n=1):
+        with self.statsLock:
+            self.stats[key] += n
+
+    # Wait for a batch to be complete (size or linger time) and send it
+    def __run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    if len(self.items) >= self.maxItems:
+                        break
+
+                    if self.items:
+                        remaining = self.firstItemT + self.maxLinger - time.monotonic()
+
+                        if remaining <= 0:
+                            break
+
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+
+                batch = self.items[:self.maxItems]
+                del self.items[:self.maxItems]
+
+                if batch:
+                    self.space.notify_all()
+
+                if self.items:
+                    # The rest starts lingering now
+                    self.firstItemT = time.monotonic()
+
+                if not batch and not self.running:
+                    return
+
+            if batch:
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    self.context.log.exception(e)
+
+    # Send one batch
+    def flush(self, batch):
+        self.__count("batches")
+
+        if self.mode == "bulk":
+            self.__flush_bulk(batch)
+        else:
+            for item, r in zip(batch, self.executor.map(self.__send_one, batch)):
+                self.__evaluate(item, r)
+
+    def __send_one(self, item):
+        self.__count("requests")
+        return self.context.ubirch.send_data(item[1], item[2], self.context.liveAttempts)
+
+    # Send all items in a single request, the response either applies to all items or
+    # (if the service returns a list of status codes) to each item
+    def __flush_bulk(self, batch):
+        self.__count("requests")
+        r = self.context.ubirch.send_data_bulk([item[2] for item in batch], self.context.liveAttempts)
+
+        statuses = None
+
+        if r is not None and r.status_code == 200 and r.content:
+            try:
+                statuses = r.json()
+            except ValueError:
+                statuses = None
+
+        if isinstance(statuses, list) and len(statuses) == len(batch):
+            for item, status in zip(batch, statuses):
+                self.__evaluate(item, r, status)
+        else:
+            for item in batch:
+                self.__evaluate(item, r)
+
+    # Log and count the result of one item
+    def __evaluate(self, item, r, status=None):
+        dev_id = item[0]
+
+        if r is None:
+            self.__count("itemsFailed")
+            self.context.log.error("[DEV:%s] sending data to ubirch failed (no response)", dev_id)
+            self.context.spoolPost("data", dev_id, item[1], item[2])
+            return
+
+        if status is None:
+            status = r.status_code
+
+        if status == 200:
+            self.__count("itemsSent")
+            self.context.log.debug("[DEV:%s] data successfully sent to ubirch", dev_id)
+        else:
+            self.__count("itemsFailed")
+            self.context.log.error("[DEV:%s] sending data to ubirch failed (STATUS_CODE: %s)", dev_id, status)
+
+            if isinstance(status, int) and status >= 500:
+                self.context.spoolPost("data", dev_id, item[1], item[2])
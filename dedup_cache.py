@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+
+
+# Get the dedup key of a measurement UPP - its signature (the whole UPP if it has none)
+def upp_key(unpacked_upp, upp):
+    if isinstance(unpacked_upp, list) and len(unpacked_upp) >= 6 and isinstance(unpacked_upp[5], bytes):
+        return unpacked_upp[5]
+
+    return upp
+
+
+class DedupCache():
+    """ Remembers the keys (UPP signatures) of recent measurements to drop uplinks delivered more than once """
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config.get("DedupConfig", {})
+        self.window = cfg.get("window", 600)
+        self.maxEntries = max(1, cfg.get("maxEntries", 100000))
+
+        # key -> time it expires, ordered by expiry (a hit moves the key to the end)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.stats = {
+            "lookups": 0,  # how many measurements were looked up
+            "hits": 0,  # how many duplicates were dropped
+            "expired": 0,  # how many keys left the window
+            "evicted": 0  # how many keys were evicted because the cache was full
+        }
+
+    # Returns True if the key was seen in the window, remembers it otherwise
+    def seen(self, key):
+        now = time.monotonic()
+
+        with self.lock:
+            self.stats["lookups"] += 1
+
+            # Drop the keys that left the window (the oldest are first)
+            while self.entries:
+                oldest, expires = next(iter(self.entries.items()))
+
+                if expires > now:
+                    break
+
+                del self.entries[oldest]
+                self.stats["expired"] += 1
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.entries[key] = now + self.window
+                self.stats["hits"] += 1
+                return True
+
+            self.entries[key] = now + self.window
+
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+        return False
+
+    # Return statistics
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+
+        return stats
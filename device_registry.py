@@ -0,0 +1,91 @@
+import threading
+import time
+import ttn_device
+
+
+class DeviceRegistry():
+    """ The device objects of a TTN application, indexed by their device ID """
+
+    def __init__(self, context, app=None):
+        self.context = context
+        self.app = app
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.refreshThread = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    # Iterate over a snapshot of the device objects - devices may be added concurrently
+    def __iter__(self):
+        return iter(list(self.devices.values()))
+
+    def __contains__(self, dev_id):
+        return dev_id in self.devices
+
+    # Get a device object by its ID, None if unknown
+    def get(self, dev_id):
+        return self.devices.get(dev_id)
+
+    # Get a device object by its ID, the object is created if the device is unknown
+    def get_or_create(self, dev_id):
+        device = self.devices.get(dev_id)
+
+        if device is None:
+            with self.lock:
+                # Another thread might have created it meanwhile
+                device = self.devices.get(dev_id)
+
+                if device is None:
+                    self.context.log.info("creating device instance: %s", dev_id)
+                    device = ttn_device.TTNDevice(self.context, dev_id, self.app)
+                    self.devices[dev_id] = device
+
+        return device
+
+    # Create a device object with a state from a snapshot (see device_snapshot.py)
+    def restore(self, dev_id, state):
+        device = ttn_device.TTNDevice(self.context, dev_id, self.app)
+        device.setState(state)
+
+        with self.lock:
+            self.devices[dev_id] = device
+
+        return device
+
+    # Create device objects for all devices of the TTN application
+    def refresh(self):
+        for dev in self.app.mqtt.app_client.devices():
+            self.get_or_create(dev.dev_id)
+
+    # Like refresh(), but devices that are not known to TTN (any more) are removed as well
+    def reconcile(self):
+        known = set()
+
+        for dev in self.app.mqtt.app_client.devices():
+            self.get_or_create(dev.dev_id)
+            known.add(dev.dev_id)
+
+        with self.lock:
+            removed = [self.devices.pop(dev_id) for dev_id in list(self.devices) if dev_id not in known]
+
+        # The deadlines are cleared on the thread of the scheduler (reconcile runs in the background)
+        for device in removed:
+            self.context.log.info("removing device instance: %s (unknown to TTN)", device.deviceID)
+            self.context.scheduler.call_soon_threadsafe(device.clearDeadlines)
+
+    # Refresh the device list every period seconds in the background
+    def start_refresh(self, period):
+        self.refreshThread = threading.Thread(target=self.__refresh_loop, args=(period,),
+                                              name="device-refresh", daemon=True)
+        self.refreshThread.start()
+
+    def __refresh_loop(self, period):
+        while True:
+            time.sleep(period)
+
+            try:
+                self.refresh()
+            except Exception as e:
+                self.context.log.error("refreshing the device list failed")
+                self.context.log.exception(e)
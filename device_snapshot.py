@@ -0,0 +1,173 @@
+import os
+import struct
+import threading
+import time
+import zlib
+import msgpack
+
+# The file starts with a magic, the format version and the time it was written
+HEADER = struct.Struct("<4sHd")
+MAGIC = b"TTNS"
+VERSION = 1
+# Every record (one device) is prefixed by its length and the crc32 of its payload (as in the spool)
+RECORD_HEADER = struct.Struct("<II")
+
+
+class DeviceSnapshots():
+    """ Persists the state of all devices to a local file, periodically and on shutdown """
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config.get("SnapshotConfig", {})
+        self.path = cfg.get("path", "devices.snapshot")
+        self.period = cfg.get("period", 60)
+        self.fsync = cfg.get("fsync", True)
+
+        self.lock = threading.Lock()  # only one snapshot is written at a time
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "written": 0,  # how many snapshots were written
+            "failed": 0,  # how many snapshots could not be written
+            "restored": 0,  # how many devices were restored on startup
+            "corrupt": 0,  # how many damaged records were skipped on startup
+            "lastDevices": 0,  # devices in the last snapshot
+            "lastBytes": 0,  # size of the last snapshot
+            "lastSeconds": 0.0  # how long writing the last snapshot took
+        }
+
+    # Write a snapshot every period seconds in the background
+    def start(self):
+        if self.period <= 0:
+            return
+
+        self.thread = threading.Thread(target=self.__snapshot_loop, name="device-snapshots", daemon=True)
+        self.thread.start()
+
+    # Stop the background writer and write a final snapshot
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        self.write()
+
+    # Return statistics
+    def getStats(self):
+        with self.statsLock:
+            return dict(self.stats)
+
+    # Write a snapshot of all devices (atomically - the old snapshot is kept until the new one is complete)
+    def write(self):
+        started = time.monotonic()
+        tmp = self.path + ".tmp"
+        count = 0
+        size = HEADER.size
+
+        with self.lock:
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+                    for app in self.context.apps.values():
+                        for device in app.devices:
+                            payload = msgpack.packb([app.appID, device.deviceID, device.getState()], use_bin_type=True)
+                            f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                            f.write(payload)
+
+                            count += 1
+                            size += RECORD_HEADER.size + len(payload)
+
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                os.replace(tmp, self.path)
+            except Exception as e:
+                with self.statsLock:
+                    self.stats["failed"] += 1
+
+                self.context.log.error("writing the device snapshot failed")
+                self.context.log.exception(e)
+                return False
+
+        with self.statsLock:
+            self.stats["written"] += 1
+            self.stats["lastDevices"] = count
+            self.stats["lastBytes"] = size
+            self.stats["lastSeconds"] = time.monotonic() - started
+
+        self.context.log.debug("device snapshot written (%d devices, %d bytes)" % (count, size))
+        return True
+
+    # Restore the devices of the last snapshot, returns the number of restored devices
+    # Devices of applications that are not configured any more are dropped
+    def restore(self):
+        started = time.monotonic()
+
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.context.log.info("no device snapshot found (%s)" % self.path)
+            return 0
+
+        try:
+            magic, version, created = HEADER.unpack_from(data)
+        except struct.error:
+            magic, version, created = None, None, 0
+
+        if magic != MAGIC or version != VERSION:
+            self.context.log.warning("device snapshot %s has an unknown format - ignored" % self.path)
+            return 0
+
+        restored = 0
+        corrupt = 0
+        offset = HEADER.size
+
+        while offset < len(data):
+            try:
+                length, crc = RECORD_HEADER.unpack_from(data, offset)
+            except struct.error:
+                corrupt += 1
+                break
+
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            offset += RECORD_HEADER.size + length
+
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                # The length can not be trusted either - skip the rest
+                corrupt += 1
+                break
+
+            dev_id = None
+
+            try:
+                appID, dev_id, state = msgpack.unpackb(payload, raw=False)
+                app = self.context.apps.get(appID)
+
+                if app is not None:
+                    app.devices.restore(dev_id, state)
+                    restored += 1
+            except Exception as e:
+                corrupt += 1
+                self.context.log.error("[DEV:%s] restoring the device state failed: %s" % (dev_id, repr(e)))
+
+        with self.statsLock:
+            self.stats["restored"] = restored
+            self.stats["corrupt"] = corrupt
+
+        self.context.log.info("restored %d devices from the snapshot of %s in %.3fs (%d damaged records skipped)"
+                              % (restored, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)),
+                                 time.monotonic() - started, corrupt))
+
+        return restored
+
+    def __snapshot_loop(self):
+        while not self.stopped.wait(self.period):
+            self.write()
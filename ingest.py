@@ -0,0 +1,257 @@
+import binascii
+import collections
+import functools
+import threading
+import time
+import zlib
+import mprotocol
+
+# Lanes of an ingest worker - the control lane is always emptied first
+CONTROL = 0  # acks/nacks, config value responses and key registration parts (they have deadlines)
+BULK = 1  # measurements, pings and unknown messages
+
+# Messages in the control lane (by default)
+CONTROL_TYPES = ("MSG_ACK", "MSG_NACK", "MSG_CFG_VAL_RESP", "MSG_REGISTER_KEY_PART")
+
+# Messages shed while the bulk lane is filled to a fraction: type -> {"action": "drop"|"spool", "fill": fraction}
+SHEDDING = {
+    "MSG_PING": {"action": "drop", "fill": 0.5},
+    "MSG_MEASUREMENTS": {"action": "spool", "fill": 1.0}
+}
+
+
+# Get the control byte of a raw (base64) payload without decoding all of it, None if it is empty or invalid
+def control_byte(raw_payload):
+    try:
+        return binascii.a2b_base64(raw_payload[:4])[0]
+    except (binascii.Error, IndexError, TypeError):
+        return None
+
+
+class LanePolicy():
+    """ Decides the lane of an uplink and whether it is shed, by its control byte (see IngestConfig) """
+
+    def __init__(self, context, cfg):
+        self.context = context
+        self.enabled = cfg.get("priorityLanes", True)
+        self.lanes = {mprotocol.MP_CTRL_B_TYPES[name]: CONTROL for name in cfg.get("controlTypes", CONTROL_TYPES)}
+        self.shedding = {mprotocol.MP_CTRL_B_TYPES[name]: (name, rule["action"], rule.get("fill", 1.0))
+                         for name, rule in cfg.get("shedding", SHEDDING).items()}
+
+        for name, action, fill in self.shedding.values():
+            if action not in ("drop", "spool"):
+                raise ValueError("unknown shedding action for %s: %s" % (name, action))
+
+    # Get the lane of a message
+    def lane(self, ctrl):
+        return self.lanes.get(ctrl, BULK) if self.enabled else BULK
+
+    # Shed a message of the bulk lane if its lane is filled to the fraction (0 - 1) of its rule
+    # Returns the action taken ("drop" or "spool"), None if the message has to be enqueued
+    # spool is called to write a spooled message (default: spool_uplink, see AsyncIngest for the event loop)
+    def shed(self, ctrl, fill, raw_payload, dev_id, appID, spool=None):
+        rule = self.shedding.get(ctrl)
+
+        if rule is None or fill < rule[2]:
+            return None
+
+        name, action, _ = rule
+
+        if action == "spool":
+            # Without a spool the measurement is enqueued (or dropped) like any other uplink
+            if not self.context.spool:
+                return None
+
+            if not (spool or self.spool_uplink)(raw_payload, dev_id, appID):
+                action = "drop"
+        else:
+            self.context.log.debug("[DEV:%s] %s shed - ingest queue %d%% full", dev_id, name, fill * 100)
+
+        self.context.metrics.inc("ingest_shed_total", (("type", name), ("action", action)))
+        return action
+
+    # Write a shed uplink to the spool, returns False if it could not be written
+    # It is only sent to Ubirch when it is replayed, the device state is not updated (see TTNConnector.replayUplink)
+    def spool_uplink(self, raw_payload, dev_id, appID):
+        return self.context.spool.append("uplink", dev_id, None, [appID, raw_payload])
+
+
+class Lanes():
+    """ The bounded queue of an ingest worker - control messages are taken before bulk messages """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lanes = (collections.deque(), collections.deque())
+        self.cond = threading.Condition()
+
+    def qsize(self):
+        return len(self.lanes[CONTROL]) + len(self.lanes[BULK])
+
+    # How full a lane is (0 - 1)
+    def fill(self, lane):
+        return len(self.lanes[lane]) / self.maxsize
+
+    # Append an item to a lane, waits up to timeout seconds while the lane is full
+    # Returns False if it stayed full
+    def put(self, lane, item, timeout=0):
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.lanes[lane]) < self.maxsize, timeout):
+                return False
+
+            self.lanes[lane].append(item)
+            self.cond.notify_all()
+
+        return True
+
+    # Append a call to the control lane (not bounded, it must not be lost)
+    def call(self, fn):
+        with self.cond:
+            self.lanes[CONTROL].append(fn)
+            self.cond.notify_all()
+
+    # Append the end marker behind all queued items (not bounded)
+    def close(self):
+        with self.cond:
+            self.lanes[BULK].append(None)
+            self.cond.notify_all()
+
+    # Take the next item, blocks while both lanes are empty
+    def get(self):
+        with self.cond:
+            self.cond.wait_for(self.qsize)
+
+            item = self.lanes[CONTROL].popleft() if self.lanes[CONTROL] else self.lanes[BULK].popleft()
+            self.cond.notify_all()
+
+        return item
+
+
+class IngestQueue():
+    """ A bounded queue + worker pool decoupling the MQTT callback from uplink processing (with priority lanes) """
+
+    def __init__(self, context, handler):
+        self.context = context
+        self.handler = handler
+
+        cfg = self.context.config.get("IngestConfig", {})
+        self.workerCount = max(1, cfg.get("workers", 4))
+        self.queueSize = max(1, cfg.get("queueSize", 1000))
+        self.enqueueTimeout = cfg.get("enqueueTimeout", 0.5)
+
+        self.policy = LanePolicy(context, cfg)
+
+        # One queue per worker - a device is always mapped to the same worker to keep its messages in order
+        # (within a lane - control messages skip ahead of the device's measurements)
+        self.queues = [Lanes(self.queueSize) for _ in range(self.workerCount)]
+        self.threads = []
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,  # how many uplinks were put into the queue
+            "processed": 0,  # how many uplinks were handled by a worker
+            "overflows": 0,  # how often a producer had to wait for a full queue
+            "dropped": 0,  # how many uplinks were dropped because the queue stayed full
+            "prioritized": 0,  # how many uplinks were put into the control lane
+            "shedDropped": 0,  # how many uplinks were dropped by the shedding policy
+            "shedSpooled": 0  # how many measurements were spooled by the shedding policy
+        }
+
+    # Start the worker threads
+    def start(self):
+        for i in range(self.workerCount):
+            t = threading.Thread(target=self.__worker, args=(self.queues[i],),
+                                 name="ingest-worker-%d" % i, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    # Stop the worker threads after the queued uplinks are processed
+    def stop(self):
+        for q in self.queues:
+            q.close()
+
+        for t in self.threads:
+            t.join()
+
+        self.threads = []
+
+    # Get the queue of the worker responsible for a device
+    def __get_queue(self, dev_id):
+        return self.queues[zlib.crc32(dev_id.encode()) % self.workerCount]
+
+    # Put an uplink into the queue, to be called from the MQTT network thread
+    # Returns False if the uplink had to be dropped (or was shed)
+    def put(self, raw_payload, dev_id, appID=None):
+        q = self.__get_queue(dev_id)
+
+        ctrl = control_byte(raw_payload)
+        lane = self.policy.lane(ctrl)
+
+        # Shed low priority messages while the queue is (nearly) full
+        action = self.policy.shed(ctrl, q.fill(BULK), raw_payload, dev_id, appID) if lane == BULK else None
+
+        if action:
+            self.__count("shedDropped" if action == "drop" else "shedSpooled")
+            return False
+
+        item = (raw_payload, dev_id, time.monotonic(), appID)
+
+        if not q.put(lane, item):
+            self.__count("overflows")
+
+            # Apply backpressure on the producer - wait (bounded) for space
+            if not q.put(lane, item, self.enqueueTimeout):
+                self.__count("dropped")
+                self.context.log.warning("[DEV:%s] ingest queue full - uplink dropped", dev_id)
+                return False
+
+        self.__count("enqueued")
+
+        if lane == CONTROL:
+            self.__count("prioritized")
+
+        return True
+
+    # Call fn(*args) on the worker responsible for a device, ahead of its queued uplinks
+    # (the device timeouts, so the state of a device is only changed by one thread)
+    def call(self, dev_id, fn, *args):
+        self.__get_queue(dev_id).call(functools.partial(fn, *args))
+
+    # Return the number of uplinks waiting to be processed
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    # Return statistics
+    def getStats(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+
+        stats["depth"] = self.depth()
+        return stats
+
+    def __count(self, key):
+        with self.statsLock:
+            self.stats[key] += 1
+
+    def __worker(self, q):
+        while True:
+            item = q.get()
+
+            if item is None:
+                break
+
+            if callable(item):
+                try:
+                    item()
+                except Exception as e:
+                    self.context.log.exception(e)
+
+                continue
+
+            self.context.metrics.observe("ingest_queue_wait", item[2])
+
+            try:
+                self.handler(item[0], item[1], item[3])
+            except Exception as e:
+                self.context.log.exception(e)
+            finally:
+                self.__count("processed")
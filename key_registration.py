@@ -0,0 +1,124 @@
+# Layout of the first byte of a key registration part (the rest of the part is a chunk of the UPP)
+FLAG_LAST = 0b10000000  # the part is the last one
+FLAG_RESET = 0b01000000  # discard all parts received before
+INDEX_MASK = 0b00111111  # index of the part (0-63)
+
+# Results of KeyReassembler.add()
+PART_ADDED = "added"
+PART_DUPLICATE = "duplicate"
+PART_INVALID = "invalid"  # the part does not fit to the parts received before
+PART_OVERFLOW = "overflow"  # the UPP would be larger than maxBytes
+UPP_COMPLETE = "complete"
+
+
+class KeyReassembler():
+    """ Reassembles the key registration UPP of a device from its parts (in any order, of any size) """
+
+    __slots__ = ("maxBytes", "chunks", "received", "last", "size")
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.reset()
+
+    # Discard all received parts
+    def reset(self):
+        self.chunks = None  # the chunks by part index (None if not received yet)
+        self.received = 0  # bitmask of the received part indexes
+        self.last = -1  # index of the last part (-1 if not received yet)
+        self.size = 0  # bytes received so far
+
+    # Whether there are parts waiting for the rest of the UPP
+    def pending(self):
+        return self.received != 0
+
+    # Return the indexes of the parts missing so far
+    def gaps(self):
+        top = self.last if self.last >= 0 else self.received.bit_length() - 1
+
+        return [i for i in range(top) if not self.received & (1 << i)]
+
+    # Return the received parts as plain values (see device_snapshot.py)
+    def getState(self):
+        return [self.received, self.last, list(self.chunks) if self.chunks is not None else None]
+
+    # Restore the parts returned by getState()
+    def setState(self, state):
+        self.reset()
+
+        # [chunkSize, received, last, lastChunk, length, data] of the former fixed size parts
+        if len(state) == 6:
+            state = self.__convert(*state)
+
+        self.received, self.last, chunks = state
+
+        if chunks is not None:
+            self.chunks = [bytes(chunk) if chunk is not None else None for chunk in chunks]
+            self.size = sum(len(chunk) for chunk in self.chunks if chunk is not None)
+
+            if self.size > self.maxBytes:
+                self.reset()
+                raise ValueError("key registration parts exceed maxBytes")
+
+    # Add a part (flags/index byte + chunk), returns (result, UPP if it is complete else None)
+    def add(self, part):
+        if len(part) < 1:
+            return PART_INVALID, None
+
+        flags = part[0]
+        index = flags & INDEX_MASK
+        chunk = bytes(part[1:])
+
+        if flags & FLAG_RESET:
+            self.reset()
+
+        if self.received & (1 << index):
+            return PART_DUPLICATE, None
+
+        if flags & FLAG_LAST:
+            # There can only be one last part and no part after it
+            if self.last >= 0 or self.received >> index:
+                return PART_INVALID, None
+
+            self.last = index
+        elif not chunk or (self.last >= 0 and index > self.last):
+            return PART_INVALID, None
+
+        if self.size + len(chunk) > self.maxBytes:
+            return PART_OVERFLOW, None
+
+        if self.chunks is None:
+            self.chunks = []
+
+        if len(self.chunks) <= index:
+            self.chunks.extend([None] * (index + 1 - len(self.chunks)))
+
+        self.chunks[index] = chunk
+        self.received |= 1 << index
+        self.size += len(chunk)
+
+        # Complete if all parts up to the last one were received
+        if self.last >= 0 and self.received == (1 << (self.last + 1)) - 1:
+            upp = b"".join(self.chunks[:self.last + 1])
+            self.reset()
+            return UPP_COMPLETE, upp
+
+        return PART_ADDED, None
+
+    # Split the state of the former fixed size parts into the chunks by index
+    @staticmethod
+    def __convert(chunkSize, received, last, lastChunk, length, data):
+        if data is None:
+            return received, last, None
+
+        chunks = [None] * received.bit_length()
+
+        for index in range(len(chunks)):
+            if not received & (1 << index):
+                continue
+
+            if index == last:
+                chunks[index] = lastChunk if lastChunk is not None else data[index * chunkSize:length]
+            else:
+                chunks[index] = data[index * chunkSize:(index + 1) * chunkSize]
+
+        return received, last, chunks
@@ -0,0 +1,159 @@
+import collections
+import logging
+import threading
+
+
+class RecordQueueHandler(logging.Handler):
+    """ Puts log records into a bounded deque without formatting them - records are dropped if it is full """
+
+    def __init__(self, maxRecords):
+        super().__init__()
+        self.maxRecords = maxRecords  # 0 - unbounded
+        self.records = collections.deque()
+        self.ready = threading.Event()  # set when records were added since the listener emptied the deque
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    # Without the handler lock - appending to a deque is thread safe
+    def handle(self, record):
+        rv = self.filter(record)
+
+        if rv:
+            self.emit(record)
+
+        return rv
+
+    # The record is formatted by the listener thread (the message args are kept until then)
+    def emit(self, record):
+        if self.maxRecords and len(self.records) >= self.maxRecords:
+            with self.lock:
+                self.dropped += 1
+
+            return
+
+        self.records.append(record)
+
+        if not self.ready.is_set():
+            self.ready.set()
+
+
+class DeviceRateLimit(logging.Filter):
+    """ Limits the debug messages of every device ("[DEV:%s] ..." messages) to rate per second """
+
+    def __init__(self, rate, keep=60):
+        super().__init__()
+        self.rate = rate
+        self.keep = keep  # seconds the window of a device without messages is kept
+        self.windows = {}  # dev_id -> [second, messages in it, messages suppressed in it]
+        self.pruned = 0  # second of the last pruning
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not isinstance(record.args, tuple) or not record.args \
+                or not str(record.msg).startswith("[DEV:"):
+            return True
+
+        dev_id = record.args[0]
+        second = int(record.created)
+
+        with self.lock:
+            window = self.windows.get(dev_id)
+
+            if window is None or window[0] != second:
+                # A new second - report how many messages were suppressed in the last one
+                if window is not None and window[2]:
+                    record.msg += " (%d debug messages of the device suppressed before)" % window[2]
+
+                self.windows[dev_id] = [second, 1, 0]
+
+                if second - self.pruned >= self.keep:
+                    self.__prune(second)
+
+                return True
+
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+
+            window[2] += 1
+            self.suppressed += 1
+
+        return False
+
+    # Forget the devices without messages for keep seconds (removed devices, changing dev_ids)
+    def __prune(self, second):
+        self.windows = {k: w for k, w in self.windows.items() if second - w[0] < self.keep}
+        self.pruned = second
+
+
+class LogPipeline():
+    """ Moves the handlers of a logger to a background thread, logging calls only enqueue the record """
+
+    def __init__(self, log, handlers, maxRecords=10000, deviceDebugRate=10):
+        self.log = log
+        self.handlers = handlers
+        self.queueHandler = RecordQueueHandler(maxRecords)
+        self.thread = None
+        self.stopping = False
+        self.rateLimit = None
+
+        if deviceDebugRate > 0:
+            self.rateLimit = DeviceRateLimit(deviceDebugRate)
+            self.log.addFilter(self.rateLimit)
+
+    def start(self):
+        self.log.addHandler(self.queueHandler)
+
+        self.thread = threading.Thread(target=self.__run, name="log-pipeline", daemon=True)
+        self.thread.start()
+
+    # Write the queued records and log directly from now on (e.g. while shutting down)
+    def stop(self):
+        if self.queueHandler not in self.log.handlers:
+            return
+
+        for handler in self.handlers:
+            self.log.addHandler(handler)
+
+        self.log.removeHandler(self.queueHandler)
+
+        # Nothing is put into the deque, so stopping never waits for space
+        self.stopping = True
+        self.queueHandler.ready.set()
+        self.thread.join()
+
+        # Records of logging calls that were still running when the handler was removed
+        self.__write()
+
+    # Return statistics
+    def getStats(self):
+        return {
+            "dropped": self.queueHandler.dropped,  # records dropped because the queue was full
+            "suppressed": self.rateLimit.suppressed if self.rateLimit else 0  # rate limited debug messages
+        }
+
+    # Write the queued records until stopped
+    def __run(self):
+        ready = self.queueHandler.ready
+
+        while True:
+            ready.wait()
+            ready.clear()
+
+            stopping = self.stopping
+            self.__write()
+
+            if stopping:
+                break
+
+    # Write the records in the deque to the handlers (if their level allows it)
+    def __write(self):
+        records = self.queueHandler.records
+
+        while records:
+            record = records.popleft()
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
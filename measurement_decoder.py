@@ -0,0 +1,60 @@
+import datetime
+import struct
+
+
+class MeasurementDecoder():
+    """ Decodes the measurement struct of a UPP payload - compiled once from the DataConfig """
+
+    def __init__(self, dataConfig):
+        self.struct = struct.Struct(dataConfig["structFormat"])
+        self.layout = tuple(dataConfig["dataLayout"])
+
+        # Number of values in the struct (a record is the plain tuple of them, the names are only
+        # applied where they are needed - see to_dict() and ttn_device.MeasurementView)
+        self.count = len(self.struct.unpack(bytes(self.struct.size)))
+
+        # Map the named values once: (index, name) of all data values and the index of "time"
+        named = list(enumerate(self.layout[:self.count]))
+        self.dataFields = tuple((i, name) for i, name in named if name != "time")
+        self.timeIndex = self.layout.index("time") if "time" in self.layout[:self.count] else None
+
+        # Index of every named value (the last one if a name is used twice, like to_dict())
+        self.index = {name: i for i, name in named}
+
+    # Decode one payload (any bytes-like object, it is not copied)
+    def decode(self, payload):
+        return self.struct.unpack(payload)
+
+    # Decode many payloads at once (e.g. for replay/backfill), returns an iterator of one record per payload
+    def decode_many(self, payloads):
+        buf = bytearray()
+
+        for payload in payloads:
+            if len(payload) != self.struct.size:
+                raise struct.error("unpack requires a buffer of %d bytes" % self.struct.size)
+
+            buf += payload
+
+        return self.struct.iter_unpack(bytes(buf))
+
+    # Return all named values of a record as dict
+    def to_dict(self, record):
+        return dict(zip(self.layout, record))
+
+    # Return the named values of a record without "time" (as sent to the data service)
+    def data_dict(self, record):
+        return {name: record[i] for i, name in self.dataFields}
+
+    # Return the "time" value of a record (None if the layout has no time)
+    def time(self, record):
+        if self.timeIndex is None:
+            return None
+
+        return record[self.timeIndex]
+
+    # Return the "time" value of a record in ISO format (None if the layout has no time)
+    def isotime(self, record):
+        if self.timeIndex is None:
+            return None
+
+        return datetime.datetime.utcfromtimestamp(record[self.timeIndex]).isoformat()
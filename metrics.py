@@ -0,0 +1,173 @@
+import bisect
+import http.server
+import threading
+import time
+
+PREFIX = "ttn_connector_"
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Format labels given as tuple of (name, value) pairs
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in labels)
+
+
+class Histogram():
+    """ A latency histogram with fixed buckets """
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics():
+    """ Collects per-stage latencies, counters and gauges and serves them in the Prometheus text format """
+
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.Lock()
+        self.histograms = {}  # stage -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # name -> (help, function returning a value or a list of (labels, value))
+        self.collectors = []  # functions returning a list of (name, labels, value) counters
+        self.server = None
+
+    # Record the duration of a pipeline stage, started at the time.monotonic() value started
+    def observe(self, stage, started):
+        duration = time.monotonic() - started
+
+        with self.lock:
+            histogram = self.histograms.get(stage)
+
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+
+            histogram.observe(duration)
+
+    # Increment a counter, labels is a tuple of (name, value) pairs
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    # Register a gauge, fn is called on every scrape
+    def gauge(self, name, help, fn):
+        self.gauges[name] = (help, fn)
+
+    # Register a function returning additional counters on every scrape
+    def collector(self, fn):
+        self.collectors.append(fn)
+
+    # Render all metrics in the Prometheus text format
+    def render(self):
+        lines = []
+
+        with self.lock:
+            histograms = [(stage, list(h.counts), h.sum, h.count) for stage, h in self.histograms.items()]
+            counters = list(self.counters.items())
+
+        lines.append("# HELP %sstage_seconds Duration of the pipeline stages" % PREFIX)
+        lines.append("# TYPE %sstage_seconds histogram" % PREFIX)
+
+        for stage, counts, total, count in sorted(histograms):
+            cumulative = 0
+
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append('%sstage_seconds_bucket{stage="%s",le="%s"} %d' % (PREFIX, stage, bound, cumulative))
+
+            lines.append('%sstage_seconds_sum{stage="%s"} %f' % (PREFIX, stage, total))
+            lines.append('%sstage_seconds_count{stage="%s"} %d' % (PREFIX, stage, count))
+
+        for fn in self.collectors:
+            try:
+                counters.extend(((name, labels), value) for name, labels, value in fn())
+            except Exception as e:
+                self.context.log.exception(e)
+
+        typed = set()
+
+        for (name, labels), value in sorted(counters, key=lambda c: (c[0][0], format_labels(c[0][1]))):
+            if name not in typed:
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+                typed.add(name)
+
+            lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+
+        for name, (help, fn) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                self.context.log.exception(e)
+                continue
+
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+
+            if isinstance(value, list):
+                for labels, v in value:
+                    lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), v))
+            else:
+                lines.append("%s%s %s" % (PREFIX, name, value))
+
+        return "\n".join(lines) + "\n"
+
+    # Serve the metrics on http://address:port/metrics in a background thread
+    def start_server(self, address, port):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.HTTPServer((address, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+
+        self.context.log.info("serving metrics on %s:%d/metrics" % self.server.server_address[:2])
+
+
+class NullMetrics():
+    """ Used when metrics are disabled - all calls do nothing """
+
+    def observe(self, stage, started):
+        pass
+
+    def inc(self, name, labels=(), n=1):
+        pass
+
+    def gauge(self, name, help, fn):
+        pass
+
+    def collector(self, fn):
+        pass
+
+    def render(self):
+        return ""
@@ -27,6 +27,9 @@ MP_CTRL_B_TYPES = {
     "MSG_CTRL_RESTORE_ORIG_CONFIG": 0x18  # Load config from original_config.json
 }
 
+# Names of the control bytes
+MP_CTRL_B_NAMES = {v: k for k, v in MP_CTRL_B_TYPES.items()}
+
 # List of config value IDs
 MP_CTRL_CFGVAL_IDs = {
     "MEASURE_INTERVAL": 0x00,  # the measurement interval
@@ -40,20 +43,43 @@ MP_CTRL_CFGVAL_IDs = {
 }
 
 
+# Control bytes of received messages that carry data
+MP_DATA_CTRL_BS = frozenset([
+    MP_CTRL_B_TYPES["MSG_MEASUREMENTS"],
+    MP_CTRL_B_TYPES["MSG_CFG_VAL_RESP"],
+    MP_CTRL_B_TYPES["MSG_REGISTER_KEY_PART"]
+])
+
+# Prebuilt encoders for all messages sent by this program (native byte order, no padding)
+MP_ENCODERS = {
+    MP_CTRL_B_TYPES["MSG_CTRL_TIMESYNC"]: struct.Struct("=BI"),  # control byte, unix time
+    MP_CTRL_B_TYPES["MSG_CTRL_RESTART"]: struct.Struct("=B"),  # control byte
+    MP_CTRL_B_TYPES["MSG_CTRL_READ_CFG_VAL"]: struct.Struct("=BB"),  # control byte, value ID
+    MP_CTRL_B_TYPES["MSG_CTRL_SET_CFG_VAL"]: struct.Struct("=BBf"),  # control byte, value ID, value
+    MP_CTRL_B_TYPES["MSG_CTRL_RESTORE_ORIG_CONFIG"]: struct.Struct("=B")  # control byte
+}
+
+
 # These functions only contain code to create/unpack messages that should be sent by this program
 def mk_mp_msg(mp_msg_j):
+    ctrl = mp_msg_j["MSG_CTRL_B"]
+    encoder = MP_ENCODERS[ctrl]
+
     # Single-Byte messages
-    if mp_msg_j["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_CTRL_RESTART"]\
-            or mp_msg_j["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_CTRL_RESTORE_ORIG_CONFIG"]:
-        return bytes([mp_msg_j["MSG_CTRL_B"]])
+    if encoder.size == 1:
+        return encoder.pack(ctrl)
 
     # Multi-Byte messages
-    elif mp_msg_j["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_CTRL_TIMESYNC"]:
-        return bytes([mp_msg_j["MSG_CTRL_B"]]) + struct.pack("I", mp_msg_j["MSG_DATA"])
-    elif mp_msg_j["MSG_CTRL_B"] == mp_msg_j["MSG_CTRL_READ_CFG_VAL"]:
-        return bytes([mp_msg_j["MSG_CTRL_B"], mp_msg_j["MSG_DATA"]])
-    elif mp_msg_j["MSG_CTRL_B"] == mp_msg_j["MSG_CTRL_SET_CFG_VAL"]:
-        return bytes([mp_msg_j["MSG_CTRL_B"], mp_msg_j["MSG_DATA"][0]]) + struct.pack("f", mp_msg_j["MSG_DATA"][1])
+    if ctrl == MP_CTRL_B_TYPES["MSG_CTRL_SET_CFG_VAL"]:
+        return encoder.pack(ctrl, mp_msg_j["MSG_DATA"][0], mp_msg_j["MSG_DATA"][1])
+
+    return encoder.pack(ctrl, mp_msg_j["MSG_DATA"])
+
+
+# Split a message into its control byte and its data
+# LoRa frames are small (<= 222 bytes), slicing them is cheaper than creating a memoryview
+def parse_mp_msg(mp_msg_b):
+    return mp_msg_b[0], mp_msg_b[1:]
 
 
 def unpack_mp_msg(mp_msg_b):
@@ -62,9 +88,33 @@ def unpack_mp_msg(mp_msg_b):
     # All message contains a control byte
     retval["MSG_CTRL_B"] = mp_msg_b[0]
 
-    if retval["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_MEASUREMENTS"]\
-            or retval["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_CFG_VAL_RESP"]\
-            or retval["MSG_CTRL_B"] == MP_CTRL_B_TYPES["MSG_REGISTER_KEY_PART"]:
+    if retval["MSG_CTRL_B"] in MP_DATA_CTRL_BS:
         retval["MSG_DATA"] = mp_msg_b[1:]
 
     return retval
+
+
+class Dispatcher():
+    """ Calls the handler registered for the control byte of a message """
+
+    def __init__(self, default=None):
+        # Handlers indexed by control byte
+        self.table = [None] * 256
+        # Called with (ctrl, data, *args) for control bytes without a handler
+        self.default = default
+
+    # Register a handler to be called with (data, *args) for messages with the control byte ctrl
+    def register(self, ctrl, handler):
+        self.table[ctrl] = handler
+
+    # Parse a message and pass it to its handler, returns what the handler returns
+    def dispatch(self, mp_msg_b, *args):
+        handler = self.table[mp_msg_b[0]]
+
+        if handler is None:
+            if self.default is None:
+                return None
+
+            return self.default(mp_msg_b[0], mp_msg_b[1:], *args)
+
+        return handler(mp_msg_b[1:], *args)
@@ -1,23 +1,30 @@
 import base64
+import time
 import ttn
 
 
 class MQTTConnection():
-    def __init__(self, context):
+    # appConfig holds the appID/appAccessKey of the TTN application
+    def __init__(self, context, appConfig):
         self.context = context
+        self.appConfig = appConfig
+        self.appID = appConfig["appID"]
         self.connection_failed = False
         self.connect()
 
     def __uplinkcb(self, msg, client):
+        started = time.monotonic()
+
         try:
-            self.context.uplinkCB(self.extract_payload(msg), msg.dev_id)
+            # Only enqueue the message here, it is processed by the ingest workers
+            self.context.ingest.put(msg.payload_raw, msg.dev_id, self.appID)
+            self.context.metrics.observe("mqtt_receive", started)
         except Exception as e:
             self.context.log.exception(e)
 
     def connect(self):
         try:
-            self.handler = ttn.HandlerClient(
-                self.context.config["TTNAppConfig"]["appID"], self.context.config["TTNAppConfig"]["appAccessKey"])
+            self.handler = ttn.HandlerClient(self.appConfig["appID"], self.appConfig["appAccessKey"])
             self.app_client = self.handler.application()
             self.mqtt_client = self.handler.data()
 
@@ -35,9 +42,12 @@ class MQTTConnection():
             self.context.log.exception(e)
 
     def extract_payload(self, msg):
-        raw_payload = msg.payload_raw
+        return decode_payload(msg.payload_raw)
+
 
-        if not raw_payload:
-            return None
+# Decode the (base64) raw payload of an uplink
+def decode_payload(raw_payload):
+    if not raw_payload:
+        return None
 
-        return base64.decodebytes(bytes(raw_payload, "utf8"))
+    return base64.decodebytes(bytes(raw_payload, "utf8"))
@@ -0,0 +1,266 @@
+## Offline replay/backfill of recorded TTN uplinks through the decode -> verify -> send pipeline ##
+# The archive is a JSONL/NDJSON file, one uplink per line:
+#   {"dev_id": "...", "app_id": "...", "payload_raw": "<base64>", "timestamp": "..."}
+# app_id is optional, the first application of the config is used without it
+# usage: python replay.py archive.jsonl [--rate N] [--concurrency N] [--batch N] [--checkpoint FILE] [--dry-run]
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import dedup_cache
+import mprotocol
+import mqtt_connection
+import ttn_connector
+
+
+# Stream the archive line by line starting at offset
+# Yields (offset after the line, line number, uplink dict or None if the line is not valid JSON)
+def read_archive(path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        lineno = 0
+
+        for line in f:
+            offset += len(line)
+            lineno += 1
+            line = line.strip()
+
+            if not line:
+                continue
+
+            try:
+                yield offset, lineno, json.loads(line)
+            except ValueError:
+                yield offset, lineno, None
+
+
+# Decode the archived uplinks, yields (offset, dev_id, message bytes or None, app_id or None)
+def decode_uplinks(records):
+    for offset, lineno, uplink in records:
+        try:
+            yield offset, uplink["dev_id"], mqtt_connection.decode_payload(uplink["payload_raw"]), uplink.get("app_id")
+        except Exception:
+            yield offset, None, None, None
+
+
+class Checkpoint():
+    """ Stores how far an archive has been replayed (atomically) """
+
+    def __init__(self, path, archive):
+        self.path = path
+        self.archive = os.path.abspath(archive)
+
+        # The statistics of the earlier runs, the ones of this run are added to them
+        self.stats = collections.Counter()
+
+    # Return the offset to resume at (0 if there is no checkpoint for this archive)
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        if state.get("archive") != self.archive:
+            return 0
+
+        self.stats = collections.Counter(state.get("stats", {}))
+
+        return state.get("offset", 0)
+
+    # Store the offset and the statistics of this run (added to the ones of the earlier runs)
+    def save(self, offset, stats):
+        if not self.path:
+            return
+
+        tmp = self.path + ".tmp"
+
+        with open(tmp, "w") as f:
+            json.dump({"archive": self.archive, "offset": offset, "stats": dict(self.stats + stats)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self.path)
+
+
+class Replayer():
+    """ Pushes decoded uplinks through the connector's Ubirch stages """
+
+    def __init__(self, connector, dryRun=False):
+        self.connector = connector
+        self.dryRun = dryRun
+
+    # Process a batch of messages [(dev_id, msg, app_id), ...], returns the results used for the statistics (in order)
+    # The measurements of the batch are decoded at once by the decoder of their application
+    def process_batch(self, batch):
+        results = [None] * len(batch)
+        uplinks = {}
+        measurements = {}
+
+        for i, (dev_id, msg, appID) in enumerate(batch):
+            uplink = self.__parse(dev_id, msg, appID)
+
+            if isinstance(uplink, str):
+                results[i] = uplink
+            else:
+                uplinks[i] = uplink
+
+        # Bulk decode, grouped by decoder - payloads of the wrong size are invalid
+        byDecoder = collections.defaultdict(list)
+
+        for i, (app, upp, unpacked_upp) in uplinks.items():
+            if isinstance(unpacked_upp[4], bytes) and len(unpacked_upp[4]) == app.decoder.struct.size:
+                byDecoder[app.decoder].append(i)
+            else:
+                results[i] = "invalid"
+
+        for decoder, indices in byDecoder.items():
+            measurements.update(zip(indices, decoder.decode_many([uplinks[i][2][4] for i in indices])))
+
+        for i in sorted(measurements):
+            results[i] = self.__send(batch[i][0], *uplinks[i], measurements[i])
+
+        return results
+
+    # Parse one message, returns (app, upp, unpacked UPP) of a measurement or the result if there is nothing to send
+    def __parse(self, dev_id, msg, appID):
+        if not dev_id or not msg:
+            return "invalid"
+
+        app = self.connector.apps.get(appID, self.connector.app) if appID is not None else self.connector.app
+
+        ctrl, upp = mprotocol.parse_mp_msg(msg)
+
+        # Only measurements are forwarded to Ubirch
+        if ctrl != mprotocol.MP_CTRL_B_TYPES["MSG_MEASUREMENTS"]:
+            return "skipped"
+
+        try:
+            unpacked_upp = msgpack.unpackb(upp)
+        except Exception:
+            return "invalid"
+
+        if not isinstance(unpacked_upp, list) or len(unpacked_upp) < 6 or not isinstance(unpacked_upp[1], bytes) \
+                or len(unpacked_upp[1]) != 16:
+            return "invalid"
+
+        return app, upp, unpacked_upp
+
+    # Send one decoded measurement, returns the result used for the statistics
+    def __send(self, dev_id, app, upp, unpacked_upp, measurements):
+        # Archives of several gateways can contain an uplink more than once
+        if self.connector.dedup and self.connector.dedup.seen(dedup_cache.upp_key(unpacked_upp, upp)):
+            return "duplicate"
+
+        if self.dryRun:
+            return "valid"
+
+        verified = self.connector.verifiy_data(upp, unpacked_upp[1], dev_id)
+        sent = self.connector.send_measurements(measurements, unpacked_upp[4], unpacked_upp[1], dev_id, app.decoder)
+
+        return "sent" if verified and sent else "failed"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded TTN uplinks to Ubirch")
+    parser.add_argument("archive", help="JSONL/NDJSON archive of uplinks")
+    parser.add_argument("--config", default=ttn_connector.CONFIGFILE, help="connector config file")
+    parser.add_argument("--rate", type=float, default=0, help="max. uplinks per second (0 = as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=8, help="uplinks processed concurrently")
+    parser.add_argument("--batch", type=int, default=64, help="uplinks decoded and handed to a worker at once")
+    parser.add_argument("--checkpoint", help="file to store the progress in, the replay resumes from it")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="uplinks between two checkpoints")
+    parser.add_argument("--dry-run", action="store_true", help="only decode and validate, do not send anything")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    connector = ttn_connector.TTNConnector(config, offline=True)
+    replayer = Replayer(connector, args.dry_run or config["OPConfig"]["disableUbirch"])
+    checkpoint = Checkpoint(args.checkpoint, args.archive)
+
+    start = checkpoint.load()
+    if start:
+        connector.log.info("resuming replay of %s at offset %d" % (args.archive, start))
+
+    stats = collections.Counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="replay")
+    # With a rate limit a batch is filled in at most a second
+    batchSize = max(1, min(args.batch, int(args.rate)) if args.rate > 0 else args.batch)
+    batch = []
+    # (offset after the batch, uplinks, future) in archive order - bounds memory and keeps the checkpoint consistent
+    inflight = collections.deque()
+    inflightUplinks = 0
+    maxInflight = max(1, args.concurrency) * 2
+    done = 0
+    lastCheckpoint = 0
+    offset = start
+    began = time.monotonic()
+
+    def complete_first():
+        nonlocal offset, done, inflightUplinks
+        entryOffset, count, future = inflight.popleft()
+
+        try:
+            stats.update(future.result())
+        except Exception as e:
+            connector.log.exception(e)
+            stats["failed"] += count
+
+        offset = entryOffset
+        done += count
+        inflightUplinks -= count
+
+    def submit_batch(entryOffset):
+        nonlocal batch, inflightUplinks
+        inflight.append((entryOffset, len(batch), executor.submit(replayer.process_batch, batch)))
+        inflightUplinks += len(batch)
+        batch = []
+
+    for entryOffset, dev_id, msg, appID in decode_uplinks(read_archive(args.archive, start)):
+        if args.rate > 0:
+            delay = began + (done + inflightUplinks + len(batch)) / args.rate - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        batch.append((dev_id, msg, appID))
+
+        if len(batch) >= batchSize:
+            submit_batch(entryOffset)
+
+        # Advance over all finished batches at the head, wait if too many are in flight
+        while inflight and (inflight[0][2].done() or len(inflight) >= maxInflight):
+            complete_first()
+
+        if done - lastCheckpoint >= args.checkpoint_every:
+            checkpoint.save(offset, stats)
+            lastCheckpoint = done
+
+    if batch:
+        submit_batch(entryOffset)
+
+    while inflight:
+        complete_first()
+
+    executor.shutdown()
+    connector.stop()
+    checkpoint.save(offset, stats)
+
+    elapsed = time.monotonic() - began
+    print("replayed %d uplinks in %.1fs (%.0f/s): %s"
+          % (done, elapsed, done / elapsed if elapsed > 0 else 0,
+             ", ".join("%s=%d" % item for item in sorted(stats.items()))))
+
+    return 0 if stats["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
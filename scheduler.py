@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer():
+    """ A scheduled callback, can be cancelled in O(1) """
+
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    # Cancel the timer - it is removed from the heap lazily
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler():
+    """ Fires callbacks at their deadline - only expired timers are touched """
+
+    def __init__(self, context):
+        self.context = context
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Call callback(*args) in delay seconds
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    # Call callback(*args) from any thread - the timers of this scheduler can be cancelled from any thread, so at once
+    def call_soon_threadsafe(self, callback, *args):
+        callback(*args)
+
+    # Call callback(*args) at the time.monotonic() value when
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+
+            # Wake up the scheduler if the new timer is the next one to fire
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+
+            # Drop cancelled timers if they make up most of the heap
+            if len(self.heap) > 1024 and len(self.heap) % 1024 == 0:
+                self.__compact()
+
+        return timer
+
+    # Run the scheduler in the current thread until stop() is called
+    def run(self):
+        self.running = True
+
+        while self.running:
+            with self.cond:
+                while self.running:
+                    if self.heap:
+                        timeout = self.heap[0][0] - time.monotonic()
+
+                        if timeout <= 0:
+                            break
+
+                        self.cond.wait(timeout)
+                    else:
+                        self.cond.wait()
+
+                if not self.running:
+                    return
+
+                timer = heapq.heappop(self.heap)[2]
+
+            if not timer.cancelled:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self.context.log.exception(e)
+
+    # Run the scheduler in a background thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="timer-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __compact(self):
+        live = [entry for entry in self.heap if not entry[2].cancelled]
+
+        if len(live) < len(self.heap) // 2:
+            heapq.heapify(live)
+            self.heap = live
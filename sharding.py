@@ -0,0 +1,450 @@
+## Supervisor mode: runs the connector in N worker processes to use more than one CPU core ##
+# The supervisor process owns the MQTT subscription and forwards the uplinks in batched frames over pipes
+# to the workers. Every device is assigned to one worker by a stable hash of its ID, so its TTNDevice state
+# machine lives in exactly one process. Downlinks and statistics are sent back over the same pipe.
+# usage: python sharding.py (the number of workers is set in "ShardConfig")
+
+import collections
+import copy
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+
+import msgpack
+import connector_config
+import metrics
+import ttn_application
+import ttn_connector
+
+# Frame types
+FRAME_UPLINKS = 0  # supervisor -> worker: [FRAME_UPLINKS, [[appID, dev_id, payload_raw], ...]]
+FRAME_STOP = 1  # supervisor -> worker: [FRAME_STOP]
+FRAME_DOWNLINK = 2  # worker -> supervisor: [FRAME_DOWNLINK, appID, dev_id, data]
+FRAME_STATS = 3  # worker -> supervisor: [FRAME_STATS, {name: value}]
+
+# Worker statistics exported as gauges, all others are counters
+GAUGES = ("devices", "ingest_depth", "submit_pending", "batch_pending", "dedup_entries", "verify_keys",
+          "spool_depthRecords", "spool_depthBytes", "spool_replayRate", "snapshot_lastDevices", "snapshot_lastBytes",
+          "snapshot_lastSeconds")
+
+# Stands in for the device objects of the TTN application client
+Device = collections.namedtuple("Device", ("dev_id",))
+
+
+# Get the index of the worker responsible for a device
+# Not crc32 like the ingest queue - its low bits would map all devices of a worker to the same ingest thread
+def shard_of(dev_id, workers):
+    return int.from_bytes(hashlib.md5(dev_id.encode()).digest()[:4], "big") % workers
+
+
+def pack_frame(frame):
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def unpack_frame(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+class ShardLink():
+    """ Used by a worker's connector instead of the MQTT connections - downlinks are sent to the supervisor """
+
+    def __init__(self, conn, devIDs):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.devIDs = devIDs  # appID -> IDs of the devices assigned to this worker
+
+    # Get the stand-in for the MQTT connection of an application
+    def app(self, appID):
+        return ShardAppLink(self, appID)
+
+    def sendFrame(self, frame):
+        data = pack_frame(frame)
+
+        # Device threads and the stats thread share the pipe
+        with self.lock:
+            self.conn.send_bytes(data)
+
+
+class ShardAppLink():
+    """ Stands in for the MQTT connection (and application client) of one application in a worker """
+
+    def __init__(self, link, appID):
+        self.link = link
+        self.appID = appID
+        self.app_client = self
+
+    # The devices assigned to this worker (when it was started), used by DeviceRegistry.refresh()
+    def devices(self):
+        return [Device(dev_id) for dev_id in self.link.devIDs.get(self.appID, [])]
+
+    def send(self, deviceID, data):
+        try:
+            self.link.sendFrame([FRAME_DOWNLINK, self.appID, deviceID, data])
+        except Exception as e:
+            logging.getLogger("mainlog").exception(e)
+
+
+# Flatten the statistics of a worker's stages into one dict
+def worker_stats(connector):
+    stats = {"devices": sum(len(app.devices) for app in connector.apps.values())}
+
+    for prefix, stage in (("ingest", connector.ingest), ("submit", connector.submitter),
+                          ("batch", connector.batcher), ("spool", connector.spool),
+                          ("snapshot", connector.snapshots), ("dedup", connector.dedup),
+                          ("verify", connector.verifier)):
+        if stage:
+            for k, v in stage.getStats().items():
+                stats["%s_%s" % (prefix, k)] = v
+
+    return stats
+
+
+# Get the config of a worker - the supervisor's with the overrides of the worker
+def shard_config(config, index):
+    config = copy.deepcopy(config)
+
+    # Every worker needs its own spool directory, device snapshot and metrics port
+    if config.get("SpoolConfig", {}).get("enabled", False):
+        config["SpoolConfig"]["directory"] = "%s/shard-%d" % (config["SpoolConfig"].get("directory", "spool"), index)
+
+    if config.get("SnapshotConfig", {}).get("enabled", False):
+        config["SnapshotConfig"]["path"] = "%s.shard-%d" % (config["SnapshotConfig"].get("path", "devices.snapshot"), index)
+
+    if config.get("LocalVerifyConfig", {}).get("enabled", False):
+        verifyConfig = config["LocalVerifyConfig"]
+        verifyConfig["keyStore"] = "%s.shard-%d" % (verifyConfig.get("keyStore", "keys.store"), index)
+
+    if config.get("MetricsConfig", {}).get("enabled", False):
+        config["MetricsConfig"]["port"] = config["MetricsConfig"].get("port", 9100) + 1 + index
+
+    return config
+
+
+class WorkerConnector(ttn_connector.TTNConnector):
+    """ The connector of a worker process, a reload reads the config file and applies the overrides of the worker """
+
+    def __init__(self, config, index, configFile, link):
+        self.index = index
+        super().__init__(shard_config(config, index), link=link)
+
+        # Set after the setup - the supervisor watches the config file, not the workers
+        self.configFile = configFile
+
+    # Loads the config again for a reload (see TTNConnector.reloadConfig)
+    def loadConfig(self):
+        config = super().loadConfig()
+
+        return shard_config(config, self.index) if config is not None else None
+
+
+# Main function of a worker process
+def run_worker(config, index, conn, devIDs, configFile=None):
+    # The supervisor handles the signals (and forwards SIGHUP once the connector is set up)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    link = ShardLink(conn, devIDs)
+    connector = WorkerConnector(config, index, configFile, link)
+    connector.scheduler.start()
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=connector.reloadConfig, name="config-reload", daemon=True).start())
+
+    connector.log.info("shard worker %d started with %d devices" % (index, sum(map(len, devIDs.values()))))
+
+    statsPeriod = connector.config.get("ShardConfig", {}).get("statsPeriod", 10)
+
+    def report_stats():
+        while True:
+            time.sleep(statsPeriod)
+
+            try:
+                link.sendFrame([FRAME_STATS, worker_stats(connector)])
+            except OSError:
+                return
+
+    threading.Thread(target=report_stats, name="shard-stats", daemon=True).start()
+
+    while True:
+        try:
+            frame = unpack_frame(conn.recv_bytes())
+        except EOFError:
+            # The supervisor is gone
+            break
+
+        if frame[0] == FRAME_STOP:
+            break
+
+        for appID, dev_id, raw_payload in frame[1]:
+            connector.ingest.put(raw_payload, dev_id, appID)
+
+    connector.log.info("shard worker %d stopping" % index)
+    connector.stop()
+
+
+class Shard():
+    """ The supervisor's end of one worker process """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.workerStats = {}
+
+        self.stats = {
+            "forwarded": 0,  # how many uplinks were sent to the worker
+            "frames": 0,  # how many frames they were sent in
+            "dropped": 0,  # how many uplinks were lost because the worker was down
+            "restarts": 0  # how often the worker was restarted
+        }
+
+    # Start the worker process and the thread reading from it
+    def start(self, devIDs):
+        # Spawned, not forked - the supervisor runs threads (MQTT, metrics) which must not be copied
+        ctx = multiprocessing.get_context("spawn")
+        conn, workerConn = ctx.Pipe()
+
+        self.process = ctx.Process(target=run_worker, name="shard-%d" % self.index,
+                                   args=(self.supervisor.config, self.index, workerConn, devIDs,
+                                         self.supervisor.configFile))
+        self.process.start()
+        workerConn.close()
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+
+            self.conn = conn
+
+        threading.Thread(target=self.__reader, args=(conn,), name="shard-reader-%d" % self.index,
+                         daemon=True).start()
+
+    # Queue an uplink for the worker, the frame is sent when it is full
+    def put(self, raw_payload, dev_id, appID):
+        with self.lock:
+            self.pending.append((appID, dev_id, raw_payload))
+
+            if len(self.pending) >= self.supervisor.frameItems:
+                self.__flush()
+
+    # Send the queued uplinks
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.__flush()
+
+    # Ask the worker to stop (it processes its queued uplinks first) and wait for it
+    def stop(self, timeout):
+        with self.lock:
+            if self.pending:
+                self.__flush()
+
+            try:
+                self.conn.send_bytes(pack_frame([FRAME_STOP]))
+            except OSError:
+                pass
+
+        self.process.join(timeout)
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+    # Must be called with self.lock held
+    def __flush(self):
+        items = self.pending
+        self.pending = []
+
+        try:
+            self.conn.send_bytes(pack_frame([FRAME_UPLINKS, items]))
+            self.stats["forwarded"] += len(items)
+            self.stats["frames"] += 1
+        except OSError:
+            self.stats["dropped"] += len(items)
+            self.supervisor.log.warning("shard worker %d is down - %d uplinks dropped" % (self.index, len(items)))
+
+    def __reader(self, conn):
+        while True:
+            try:
+                frame = unpack_frame(conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+
+            try:
+                if frame[0] == FRAME_DOWNLINK:
+                    self.supervisor.apps[frame[1]].mqtt.send(frame[2], frame[3])
+                elif frame[0] == FRAME_STATS:
+                    self.workerStats = frame[1]
+            except Exception as e:
+                self.supervisor.log.exception(e)
+
+
+class Supervisor():
+    """ Runs the connector in N worker processes, devices are sharded by a stable hash of their ID """
+
+    def __init__(self, config=None):
+        self.configFile = ttn_connector.CONFIGFILE if config is None else None
+        self.config = config if config is not None else ttn_connector.TTNConnector.getConfig(self)
+        self.log = ttn_connector.TTNConnector.setupLog(self, self.config["LogConfig"]["logFile"],
+                                                       self.config["LogConfig"]["logLevel"],
+                                                       self.config["LogConfig"]["logFormat"])
+        self.settings = connector_config.compile_config(self.config)
+        self.watcher = None
+
+        cfg = self.config.get("ShardConfig", {})
+        self.workerCount = max(1, cfg.get("workers", multiprocessing.cpu_count()))
+        self.frameItems = max(1, cfg.get("frameItems", 64))
+        self.frameLinger = cfg.get("frameLingerMs", 5) / 1000.0
+        self.restartDelay = cfg.get("restartDelay", 1)
+
+        self.shards = [Shard(self, i) for i in range(self.workerCount)]
+        self.running = False
+
+        # Only the MQTT connections of the applications are used, their devices live in the workers
+        self.apps = collections.OrderedDict((appConfig["appID"], ttn_application.TTNApplication(self, appConfig))
+                                            for appConfig in ttn_application.app_configs(self.config))
+
+        # The MQTT connection calls self.ingest.put() - the supervisor forwards to the workers instead
+        self.ingest = self
+        self.metrics = metrics.NullMetrics()
+
+    # Called by the MQTT connections for every uplink
+    def put(self, raw_payload, dev_id, appID=None):
+        self.shards[shard_of(dev_id, self.workerCount)].put(raw_payload, dev_id, appID)
+        return True
+
+    # Start the workers and connect to TTN, blocks until stop() is called (or SIGINT)
+    def run(self):
+        self.running = True
+
+        # Connect first, the device lists are needed to start the workers
+        for app in self.apps.values():
+            app.connect()
+
+        for shard in self.shards:
+            shard.start(self.getDeviceIDs(shard.index))
+
+        self.log.info("started %d shard workers" % self.workerCount)
+        self.metrics = ttn_connector.TTNConnector.setupMetrics(self)
+        self.metrics.collector(self.getCounters)
+
+        for name in GAUGES:
+            self.metrics.gauge("shard_%s" % name, "%s of the shard workers" % name,
+                               lambda name=name: [((("worker", shard.index),), shard.workerStats[name])
+                                                  for shard in self.shards if name in shard.workerStats])
+
+        threading.Thread(target=self.__flush_loop, name="shard-flush", daemon=True).start()
+
+        # The workers reload the config when its file changes (see reloadConfig)
+        if self.configFile and self.config["OPConfig"].get("configWatchPeriod", 0) > 0:
+            self.watcher = connector_config.ConfigWatcher(self, self.configFile,
+                                                          self.config["OPConfig"]["configWatchPeriod"])
+            self.watcher.start()
+
+        try:
+            self.__monitor()
+        except KeyboardInterrupt:
+            self.stop()
+
+        for shard in self.shards:
+            shard.stop(timeout=30)
+
+        self.log.info("all shard workers stopped")
+
+        if self.logPipeline:
+            self.logPipeline.stop()
+
+    # Stop the workers (run() returns when they are done)
+    def stop(self):
+        self.running = False
+
+        if self.watcher:
+            self.watcher.stop()
+
+    # Let the workers reload the config (they read the config file themselves)
+    def reloadConfig(self):
+        if self.configFile is None:
+            self.log.warning("config reload requested, but the config was not loaded from a file - ignored")
+            return
+
+        for shard in self.shards:
+            if shard.process and shard.process.is_alive():
+                os.kill(shard.process.pid, signal.SIGHUP)
+
+        self.log.info("config reload forwarded to %d shard workers" % self.workerCount)
+
+    # Get the IDs of the TTN devices assigned to a worker (by appID)
+    def getDeviceIDs(self, index):
+        devIDs = {}
+
+        for appID, app in self.apps.items():
+            try:
+                devices = app.mqtt.app_client.devices()
+            except Exception as e:
+                self.log.error("getting the device list failed (app %s)" % appID)
+                self.log.exception(e)
+                devices = []
+
+            devIDs[appID] = [dev.dev_id for dev in devices if shard_of(dev.dev_id, self.workerCount) == index]
+
+        return devIDs
+
+    # Return the statistics of the supervisor and the workers (summed up)
+    def getStats(self):
+        stats = {}
+
+        for shard in self.shards:
+            for stage in (shard.stats, shard.workerStats):
+                for k, v in stage.items():
+                    stats[k] = stats.get(k, 0) + v
+
+        return stats
+
+    # Return the statistics of every worker as counters, labelled with the worker index
+    def getCounters(self):
+        counters = []
+
+        for shard in self.shards:
+            labels = (("worker", shard.index),)
+
+            for stage in (shard.stats, shard.workerStats):
+                for k, v in stage.items():
+                    if k not in GAUGES:
+                        counters.append(("shard_%s_total" % k, labels, v))
+
+        return counters
+
+    # Restart crashed workers
+    def __monitor(self):
+        while self.running:
+            multiprocessing.connection.wait([shard.process.sentinel for shard in self.shards], timeout=1)
+
+            for shard in self.shards:
+                if self.running and not shard.process.is_alive():
+                    self.log.error("shard worker %d exited with code %s - restarting"
+                                   % (shard.index, shard.process.exitcode))
+                    shard.stats["restarts"] += 1
+                    time.sleep(self.restartDelay)
+                    shard.start(self.getDeviceIDs(shard.index))
+
+    # Send partially filled frames after frameLingerMs
+    def __flush_loop(self):
+        while self.running:
+            time.sleep(self.frameLinger)
+
+            for shard in self.shards:
+                shard.flush()
+
+
+if __name__ == "__main__":
+    supervisor = Supervisor()
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.reloadConfig())
+    supervisor.run()
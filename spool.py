@@ -0,0 +1,342 @@
+import os
+import struct
+import threading
+import time
+import zlib
+import msgpack
+
+# Every record is prefixed by its length and the crc32 of its payload
+RECORD_HEADER = struct.Struct("<II")
+# The cursor file stores the segment ID and the offset of the next record to be replayed
+CURSOR = struct.Struct("<QQ")
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+class Spool():
+    """ An append-only, segment based on-disk spool for Ubirch posts that failed """
+
+    def __init__(self, context, handler):
+        self.context = context
+        self.handler = handler  # called with (kind, dev_id, uuidstr, body), returns True when acknowledged
+
+        cfg = self.context.config.get("SpoolConfig", {})
+        self.directory = cfg.get("directory", "spool")
+        self.segmentBytes = cfg.get("segmentBytes", 1024 * 1024)
+        self.maxBytes = cfg.get("maxBytes", 100 * 1024 * 1024)
+        self.fsync = cfg.get("fsync", "segment")
+        self.replayRate = cfg.get("replayRate", 10)
+        self.replayRetryDelay = cfg.get("replayRetryDelay", 5)
+        self.replayMaxRetryDelay = cfg.get("replayMaxRetryDelay", 300)
+        self.checkpointEvery = cfg.get("checkpointEvery", 100)
+
+        if self.fsync not in ("always", "segment", "never"):
+            raise ValueError("unknown spool fsync policy: %s" % self.fsync)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+        self.stats = {
+            "spooled": 0,  # how many records were written
+            "rejected": 0,  # how many records were not written because maxBytes was reached
+            "replayed": 0,  # how many records were acknowledged by Ubirch
+            "replayFailed": 0,  # how many replay attempts failed
+            "corrupt": 0,  # how many damaged records/segment tails were skipped
+            "depthRecords": 0,  # how many records wait to be replayed
+            "depthBytes": 0,  # how many bytes the spool uses on disk
+            "replayRate": 0.0  # replayed records per second (last measurement interval)
+        }
+
+        self.__load()
+
+    # Start the background replayer
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__replay, name="spool-replayer", daemon=True)
+        self.thread.start()
+
+    # Stop the background replayer and persist the read position
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        with self.lock:
+            self.__write_cursor()
+
+            if self.readFile:
+                self.readFile.close()
+                self.readFile = None
+
+            if self.writeFile:
+                self.__sync(self.writeFile)
+                self.writeFile.close()
+                self.writeFile = None
+
+    # Return statistics
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    # Append a failed post to the spool (deferred: a post that is not sent live on purpose, logged as debug)
+    # Returns False if the record was rejected because the spool is full
+    def append(self, kind, dev_id, uuidstr, body, deferred=False):
+        payload = msgpack.packb([kind, dev_id, uuidstr, body], use_bin_type=True)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self.cond:
+            if self.stats["depthBytes"] + len(record) > self.maxBytes:
+                self.stats["rejected"] += 1
+                self.context.log.error("[DEV:%s] spool full - %s post dropped", dev_id, kind)
+                return False
+
+            if self.writeFile is None or self.writeSize + len(record) > self.segmentBytes:
+                self.__rotate()
+
+            # One write per record, so the replayer never sees half a record of a healthy writer
+            self.writeFile.write(record)
+            self.writeSize += len(record)
+
+            if self.fsync == "always":
+                os.fsync(self.writeFile.fileno())
+
+            self.stats["spooled"] += 1
+            self.stats["depthRecords"] += 1
+            self.stats["depthBytes"] += len(record)
+
+            self.cond.notify_all()
+
+        if deferred:
+            self.context.log.debug("[DEV:%s] %s post deferred to the replay", dev_id, kind)
+        else:
+            self.context.log.warning("[DEV:%s] %s post spooled for replay", dev_id, kind)
+
+        return True
+
+    # Helper functions - all expect self.lock to be held (or no thread to be running) #
+    def __segment_path(self, segID):
+        return os.path.join(self.directory, "%016d%s" % (segID, SEGMENT_SUFFIX))
+
+    def __sync(self, f):
+        if self.fsync != "never":
+            os.fsync(f.fileno())
+
+    # Start a new segment
+    def __rotate(self):
+        if self.writeFile:
+            self.__sync(self.writeFile)
+            self.writeFile.close()
+
+        self.writeSegID = (self.segments[-1] + 1) if self.segments else self.readSegID
+        self.segments.append(self.writeSegID)
+        self.writeFile = open(self.__segment_path(self.writeSegID), "ab", buffering=0)
+        self.writeSize = 0
+
+    # Persist the read position (atomically)
+    def __write_cursor(self):
+        tmp = os.path.join(self.directory, CURSOR_FILE + ".tmp")
+
+        with open(tmp, "wb") as f:
+            f.write(CURSOR.pack(self.readSegID, self.readOffset))
+            self.__sync(f)
+
+        os.replace(tmp, os.path.join(self.directory, CURSOR_FILE))
+        self.unsavedAcks = 0
+
+    # Load the segments and the read position from disk
+    def __load(self):
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.readSegID = 0
+        self.readOffset = 0
+        self.unsavedAcks = 0
+        self.readFile = None
+        self.writeFile = None
+        self.writeSegID = None
+        self.writeSize = 0
+
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), "rb") as f:
+                self.readSegID, self.readOffset = CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            if self.segments:
+                self.readSegID = self.segments[0]
+
+        # Segments before the cursor were already replayed
+        for segID in [s for s in self.segments if s < self.readSegID]:
+            os.remove(self.__segment_path(segID))
+            self.segments.remove(segID)
+
+        if self.segments and self.readSegID not in self.segments:
+            self.readSegID = self.segments[0]
+            self.readOffset = 0
+
+        # Count the pending records
+        for segID in self.segments:
+            path = self.__segment_path(segID)
+            size = os.path.getsize(path)
+            offset = self.readOffset if segID == self.readSegID else 0
+
+            self.stats["depthBytes"] += size
+
+            with open(path, "rb") as f:
+                self.stats["depthRecords"] += self.__count_records(f, offset, size)
+
+        if self.stats["depthRecords"]:
+            self.context.log.info("spool contains %d records to be replayed", self.stats["depthRecords"])
+
+    # Count the complete records of a segment file from offset on (by their headers)
+    @staticmethod
+    def __count_records(f, offset, size):
+        count = 0
+        f.seek(offset)
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+
+            if len(header) < RECORD_HEADER.size:
+                return count
+
+            length, _ = RECORD_HEADER.unpack(header)
+            f.seek(length, os.SEEK_CUR)
+
+            if f.tell() > size:
+                return count
+
+            count += 1
+
+    # Read the next record without consuming it
+    # Returns (record, next offset) or None if there is nothing (complete) to read
+    def __peek(self):
+        while self.segments:
+            if self.readFile is None:
+                self.readFile = open(self.__segment_path(self.readSegID), "rb")
+
+            self.readFile.seek(self.readOffset)
+            header = self.readFile.read(RECORD_HEADER.size)
+            record = None
+
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = self.readFile.read(length)
+
+                if len(payload) == length:
+                    if zlib.crc32(payload) == crc:
+                        return msgpack.unpackb(payload, raw=False), self.readOffset + RECORD_HEADER.size + length
+
+                    record = "corrupt"
+            elif len(header) == 0:
+                record = "end"
+
+            if self.readSegID == self.writeSegID and record != "corrupt":
+                # The segment is still being written to
+                return None
+
+            if record != "end":
+                # A damaged record (or a torn tail after a crash) - skip the rest of the segment
+                self.stats["corrupt"] += 1
+                self.context.log.error("spool segment %d is damaged at offset %d - skipping the rest",
+                                       self.readSegID, self.readOffset)
+
+                # The skipped records are not pending anymore
+                size = os.path.getsize(self.__segment_path(self.readSegID))
+                skipped = self.__count_records(self.readFile, self.readOffset, size)
+                self.stats["depthRecords"] = max(0, self.stats["depthRecords"] - skipped)
+
+            self.__compact()
+
+        return None
+
+    # Delete the fully replayed read segment and move on to the next one
+    def __compact(self):
+        self.readFile.close()
+        self.readFile = None
+
+        path = self.__segment_path(self.readSegID)
+        self.stats["depthBytes"] -= os.path.getsize(path)
+
+        if self.readSegID == self.writeSegID:
+            self.writeFile.close()
+            self.writeFile = None
+            self.writeSegID = None
+
+        os.remove(path)
+        self.segments.remove(self.readSegID)
+
+        self.readSegID = self.segments[0] if self.segments else self.readSegID + 1
+        self.readOffset = 0
+        self.__write_cursor()
+
+    # Replay the spooled records (rate limited)
+    def __replay(self):
+        retryDelay = self.replayRetryDelay
+        intervalStart = time.monotonic()
+        intervalReplayed = 0
+
+        while True:
+            with self.cond:
+                entry = None
+
+                while self.running:
+                    entry = self.__peek()
+
+                    if entry:
+                        break
+
+                    self.cond.wait(1)
+
+                if not self.running:
+                    return
+
+            record, nextOffset = entry
+            started = time.monotonic()
+
+            try:
+                acknowledged = self.handler(*record)
+            except Exception as e:
+                self.context.log.exception(e)
+                acknowledged = False
+
+            with self.cond:
+                if acknowledged:
+                    self.readOffset = nextOffset
+                    self.unsavedAcks += 1
+                    self.stats["replayed"] += 1
+                    self.stats["depthRecords"] -= 1
+                    intervalReplayed += 1
+                    retryDelay = self.replayRetryDelay
+
+                    if self.unsavedAcks >= self.checkpointEvery:
+                        self.__write_cursor()
+                else:
+                    self.stats["replayFailed"] += 1
+
+                now = time.monotonic()
+
+                if now - intervalStart >= 10:
+                    self.stats["replayRate"] = intervalReplayed / (now - intervalStart)
+                    intervalStart = now
+                    intervalReplayed = 0
+
+                if acknowledged:
+                    # Rate limit
+                    wait = 1.0 / self.replayRate - (now - started) if self.replayRate > 0 else 0
+                else:
+                    # The endpoint is (still) down - back off
+                    wait = retryDelay
+                    retryDelay = min(retryDelay * 2, self.replayMaxRetryDelay)
+
+                # Appends notify the condition, so wait until the deadline has really passed
+                deadline = now + wait
+
+                while self.running and deadline > time.monotonic():
+                    self.cond.wait(deadline - time.monotonic())
@@ -0,0 +1,243 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import ubirch_client
+
+# When the data upload of a measurement is started
+POLICIES = (
+    "independent",  # at the same time as the verification
+    "afterVerify",  # after the verification finished
+    "onVerifySuccess"  # only after a successful verification
+)
+
+
+class MeasurementSubmitter():
+    """ Verifies measurements with niomon and uploads them to the data service concurrently, registers keys """
+
+    # A request does not block its worker thread between attempts - retries are new jobs (see UbirchClient.post_later)
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config["UbirchHTTPConfig"]
+        self.policy = cfg.get("dataUploadPolicy", "independent")
+
+        if self.policy not in POLICIES:
+            raise ValueError("unknown data upload policy: %s" % self.policy)
+
+        self.executor = ThreadPoolExecutor(max_workers=cfg.get("HTTPConcurrency", 16),
+                                           thread_name_prefix="ubirch-http")
+
+        # Bounds the number of requests in flight - submit() blocks when it is reached (backpressure)
+        self.inflight = threading.BoundedSemaphore(cfg.get("HTTPMaxInflight", 1000))
+
+        # Per device: queue of data uploads waiting for their predecessor (keeps them in order)
+        self.chains = {}
+        self.pending = 0
+        self.cond = threading.Condition()
+
+        self.stats = {
+            "submitted": 0,  # how many measurements were submitted
+            "skipped": 0  # how many data uploads were skipped because the verification failed
+        }
+
+    # Verify and upload a measurement of a device, returns immediately
+    # verified: the signature was already verified locally (see upp_verifier.py)
+    def submit(self, device, upp, measurements, data_struct, uuid, verified=False):
+        with self.cond:
+            self.stats["submitted"] += 1
+
+        self.__acquire()
+        verifyFuture = Future()
+        self.executor.submit(self.__verify, device, upp, uuid, verified, verifyFuture)
+
+        self.__acquire()
+        args = (measurements, data_struct, uuid, device.deviceID, device.app.decoder)
+
+        with self.cond:
+            chain = self.chains.setdefault(device, collections.deque())
+            chain.append((verifyFuture, args))
+
+            # Another upload of this device is running - this one is started when it is done
+            if len(chain) > 1:
+                return
+
+        self.__start(device, verifyFuture, args)
+
+    # Send the key registration UPP of a device, returns immediately
+    def register(self, device, upp):
+        self.__acquire()
+        self.executor.submit(self.__register, device, upp)
+
+    # Wait until all submitted measurements are handled and stop the worker threads
+    def stop(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+
+        self.executor.shutdown(wait=True)
+
+    # Return statistics
+    def getStats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["pending"] = self.pending
+
+        return stats
+
+    def __acquire(self):
+        self.inflight.acquire()
+
+        with self.cond:
+            self.pending += 1
+
+    def __release(self):
+        self.inflight.release()
+
+        with self.cond:
+            self.pending -= 1
+
+            if self.pending == 0:
+                self.cond.notify_all()
+
+    # Sets the result of the verification (True if niomon validated the UPP) to verifyFuture
+    def __verify(self, device, upp, uuid, verified, verifyFuture):
+        started = time.monotonic()
+
+        try:
+            uuidstr = self.context.uuidbin2str(uuid)
+
+            # Locally verified payloads may be sent later or not at all (see LocalVerifyConfig)
+            if verified and not self.context.verifier.remote(upp, uuidstr, device.deviceID):
+                self.__verified(device, verifyFuture, True, started)
+                return
+
+            self.context.log.debug("[DEV:%s] verifying payload with UBirch", device.deviceID)
+            request = self.context.ubirch.verify(uuidstr, upp, self.context.liveAttempts, self.executor)
+        except Exception as e:
+            self.context.log.exception(e)
+            self.__verified(device, verifyFuture, False, started)
+            return
+
+        request.add_done_callback(lambda f: self.__verify_done(device, verifyFuture, upp, uuidstr, f, started))
+
+    # Like TTNConnector.verifiy_data()
+    def __verify_done(self, device, verifyFuture, upp, uuidstr, request, started):
+        try:
+            verified = self.context.verify_result(request.result(), upp, uuidstr, device.deviceID)
+        except Exception as e:
+            self.context.log.exception(e)
+            verified = False
+
+        self.__verified(device, verifyFuture, verified, started)
+
+    def __verified(self, device, verifyFuture, verified, started):
+        if not verified:
+            device.app.count("verifyFailed")
+
+        self.context.metrics.observe("verify_data", started)
+        self.__release()
+        verifyFuture.set_result(verified)
+
+    def __register(self, device, upp):
+        started = time.monotonic()
+
+        try:
+            request = self.context.ubirch.register_key(upp, self.context.liveAttempts, self.executor)
+        except Exception as e:
+            self.context.log.exception(e)
+            self.context.metrics.observe("register_device", started)
+            self.__release()
+            return
+
+        request.add_done_callback(lambda f: self.__registered(device, upp, f, started))
+
+    # Like TTNConnector.register_key()
+    def __registered(self, device, upp, request, started):
+        try:
+            r = request.result()
+
+            if ubirch_client.post_failed(r):
+                self.context.spoolPost("key", device.deviceID, None, upp)
+
+            device.setRegistrationResponse(r, upp)
+        except Exception as e:
+            self.context.log.exception(e)
+        finally:
+            self.context.metrics.observe("register_device", started)
+            self.__release()
+
+    # Start the upload at the head of a device's chain (according to the policy)
+    def __start(self, device, verifyFuture, args):
+        if self.policy == "independent":
+            self.executor.submit(self.__send, device, verifyFuture, args)
+        else:
+            # Does not block a thread - called as soon as the verification is done
+            verifyFuture.add_done_callback(lambda f: self.executor.submit(self.__send, device, f, args))
+
+    def __send(self, device, verifyFuture, args):
+        started = time.monotonic()
+        sent = True
+
+        try:
+            if self.policy == "onVerifySuccess" and not verifyFuture.result():
+                self.context.log.error("[DEV:%s] verification failed - data not uploaded", device.deviceID)
+
+                with self.cond:
+                    self.stats["skipped"] += 1
+            elif not self.context.batcher:
+                self.__send_measurements(device, started, *args)
+                return
+            else:
+                # The batching stage does not block
+                sent = self.context.send_measurements(*args)
+        except Exception as e:
+            self.context.log.exception(e)
+
+        self.__sent(device, sent, started)
+
+    # Like TTNConnector.send_measurements() - the response is handled when the request is done
+    def __send_measurements(self, device, started, measurements, data_struct, uuid, dev_id, decoder):
+        try:
+            uuidstr = self.context.uuidbin2str(uuid)
+            data = self.context.data_object(measurements, data_struct, uuidstr, dev_id, decoder)
+
+            self.context.log.debug("[DEV:%s] sending data to UBirch", dev_id)
+            request = self.context.ubirch.send_data(uuidstr, data, self.context.liveAttempts, self.executor)
+        except Exception as e:
+            self.context.log.exception(e)
+            self.__sent(device, False, started)
+            return
+
+        request.add_done_callback(lambda f: self.__send_done(device, data, uuidstr, dev_id, f, started))
+
+    def __send_done(self, device, data, uuidstr, dev_id, request, started):
+        try:
+            sent = self.context.send_result(request.result(), data, uuidstr, dev_id)
+        except Exception as e:
+            self.context.log.exception(e)
+            sent = False
+
+        self.__sent(device, sent, started)
+
+    # Called when the upload of a measurement is done
+    def __sent(self, device, sent, started):
+        if not sent:
+            device.app.count("sendFailed")
+
+        self.context.metrics.observe("send_measurements", started)
+        self.__release()
+
+        # Start the next upload of this device
+        with self.cond:
+            chain = self.chains[device]
+            chain.popleft()
+
+            if not chain:
+                del self.chains[device]
+                return
+
+            verifyFuture, args = chain[0]
+
+        self.__start(device, verifyFuture, args)
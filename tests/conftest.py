@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the connector are not a package, they are imported from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,147 @@
+import logging
+import time
+
+import circuit_breaker
+from circuit_breaker import CLOSED, FULL, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class Context():
+    def __init__(self):
+        self.log = logging.getLogger("test-breaker")
+
+
+def breaker(**cfg):
+    cfg.setdefault("failureThreshold", 3)
+    cfg.setdefault("openDelay", 0.02)
+    cfg.setdefault("acquireTimeout", 0.01)
+
+    return CircuitBreaker(Context(), "test", cfg)
+
+
+def fail(b, count=1):
+    for _ in range(count):
+        b.release(b.acquire(), False, 0.1)
+
+
+def succeed(b, count=1, latency=0.1):
+    for _ in range(count):
+        b.release(b.acquire(), True, latency)
+
+
+def test_opens_after_consecutive_failures():
+    b = breaker()
+    fail(b, 2)
+
+    assert b.state == CLOSED
+
+    fail(b)
+
+    assert b.state == OPEN
+    assert b.acquire() is None
+    assert b.getStats()["opened"] == 1
+    assert b.getStats()["rejected"] == 1
+
+
+def test_success_resets_the_failures():
+    b = breaker()
+    fail(b, 2)
+    succeed(b)
+    fail(b, 2)
+
+    assert b.state == CLOSED
+
+
+def test_half_open_admits_one_probe_and_closes_on_success():
+    b = breaker()
+    fail(b, 3)
+    time.sleep(0.03)
+
+    probe = b.acquire()
+
+    assert probe == HALF_OPEN
+    assert b.acquire() is None
+
+    b.release(probe, True, 0.1)
+
+    assert b.state == CLOSED
+    assert b.acquire() == CLOSED
+    assert b.getStats()["half_opened"] == 1
+    assert b.getStats()["closed"] == 1
+
+
+def test_failed_probe_opens_again_with_a_longer_delay():
+    b = breaker(openDelay=1, maxOpenDelay=60)
+    fail(b, 3)
+    b.openUntil = 0
+
+    probe = b.acquire()
+    started = time.monotonic()
+    b.release(probe, False, 0.1)
+
+    assert b.state == OPEN
+    assert b.trips == 2
+    # 2 * openDelay with a jitter of 50 - 100%
+    assert started + 0.9 <= b.openUntil <= time.monotonic() + 2
+
+
+def test_open_delay_is_capped():
+    b = breaker(openDelay=1, maxOpenDelay=4)
+    b.trips = 10
+    fail(b, 3)
+
+    assert b.openUntil <= time.monotonic() + 4
+
+
+def test_limit_decreases_multiplicatively_on_failures_and_slow_responses():
+    b = breaker(maxConcurrency=16, minConcurrency=2, failureThreshold=100, latencyTarget=1)
+
+    fail(b)
+    assert b.limit == 12
+
+    succeed(b, latency=2)
+    assert b.limit == 9
+
+    fail(b, 20)
+    assert b.limit == 2
+
+
+def test_limit_increases_additively_on_fast_successes():
+    b = breaker(maxConcurrency=8, minConcurrency=1, failureThreshold=100)
+    b.limit = 4.0
+
+    succeed(b, 4)
+    assert int(b.limit) == 4
+
+    succeed(b, 4)
+    assert int(b.limit) == 5
+
+    succeed(b, 100)
+    assert b.limit == 8
+
+
+def test_concurrency_limit():
+    b = breaker(maxConcurrency=2)
+    held = [b.acquire(), b.acquire()]
+
+    assert held == [CLOSED, CLOSED]
+    assert b.acquire(blocking=False) == FULL
+    assert b.acquire() is None
+    assert b.getStats()["acquireTimeouts"] == 1
+
+    released = []
+    b.listeners.append(lambda: released.append(b.inflight))
+    b.release(held.pop(), True, 0.1)
+
+    assert released == [1]
+    assert b.acquire(blocking=False) == CLOSED
+
+
+def test_stats():
+    b = breaker()
+    b.acquire()
+
+    stats = b.getStats()
+
+    assert stats["state"] == CLOSED
+    assert stats["inflight"] == 1
+    assert circuit_breaker.STATE_VALUES[stats["state"]] == 0
@@ -0,0 +1,160 @@
+import copy
+
+import pytest
+
+import connector_config
+
+CONFIG = {
+    "LogConfig": {"logLevel": 20, "logFile": "connector.log", "logFormat": "%(message)s", "enableJSON": False},
+    "OPConfig": {"disableUbirch": False, "showPing": False, "showMeasurements": True,
+                 "deviceRefreshPeriod": 300, "configWatchPeriod": 5},
+    "TTNAppConfig": {"appID": "app", "appAccessKey": "key"},
+    "TTNDeviceConfig": {"allowedMessageDelay": 30, "allowedClockOffset": 30},
+    "DataConfig": {"structFormat": "ffiii", "dataLayout": ["H", "T", "L_blue", "L_red", "time"]},
+    "UbirchHTTPConfig": {
+        "UbirchENV": "demo",
+        "UbirchPASS": "pass",
+        "UbirchKEY": "https://key.%s.ubirch.com/api/keyService/v1/pubkey/mpack",
+        "UbirchDATA": "https://data.%s.ubirch.com/v1/msgPack",
+        "UbirchNIOMON": "https://niomon.%s.ubirch.com/",
+        "HTTPPostTimeout": 5,
+        "HTTPPostAttempts": 3,
+        "HTTPConcurrency": 16
+    }
+}
+
+
+def changed(**sections):
+    config = copy.deepcopy(CONFIG)
+
+    for section, values in sections.items():
+        config.setdefault(section, {}).update(values)
+
+    return config
+
+
+def test_unchanged_config():
+    merged, restart = connector_config.merge(CONFIG, copy.deepcopy(CONFIG))
+
+    assert merged == CONFIG
+    assert restart == []
+
+
+def test_reloadable_sections_take_effect():
+    new = changed(OPConfig={"showPing": True}, TTNDeviceConfig={"allowedClockOffset": 60},
+                  DataConfig={"dataLayout": ["A", "T", "L_blue", "L_red", "time"]},
+                  UbirchHTTPConfig={"HTTPPostAttempts": 5})
+
+    merged, restart = connector_config.merge(CONFIG, new)
+
+    assert merged == new
+    assert restart == []
+
+
+def test_other_sections_need_a_restart():
+    new = changed(TTNAppConfig={"appAccessKey": "other"}, SpoolConfig={"enabled": True})
+
+    merged, restart = connector_config.merge(CONFIG, new)
+
+    assert restart == ["TTNAppConfig", "SpoolConfig"]
+    assert merged["TTNAppConfig"] == CONFIG["TTNAppConfig"]
+    assert "SpoolConfig" not in merged
+
+
+def test_removed_section_needs_a_restart():
+    new = copy.deepcopy(CONFIG)
+    new["IngestConfig"] = {"workers": 2}
+
+    merged, restart = connector_config.merge(new, CONFIG)
+
+    assert restart == ["IngestConfig"]
+    assert merged["IngestConfig"] == {"workers": 2}
+
+
+def test_only_the_log_level_is_reloaded():
+    merged, restart = connector_config.merge(CONFIG, changed(LogConfig={"logLevel": 10}))
+
+    assert merged["LogConfig"]["logLevel"] == 10
+    assert restart == []
+
+    merged, restart = connector_config.merge(CONFIG, changed(LogConfig={"logLevel": 10, "logFile": "other.log"}))
+
+    assert merged["LogConfig"]["logLevel"] == 10
+    assert merged["LogConfig"]["logFile"] == "connector.log"
+    assert restart == ["LogConfig"]
+
+
+@pytest.mark.parametrize("section, key, value, other", [
+    ("UbirchHTTPConfig", "HTTPConcurrency", 32, "HTTPPostAttempts"),
+    ("UbirchHTTPConfig", "HTTPMaxInflight", 100, "HTTPPostAttempts"),
+    ("UbirchHTTPConfig", "dataUploadPolicy", "after_verify", "HTTPPostAttempts"),
+    ("UbirchHTTPConfig", "DataBatchConfig", {"enabled": True}, "HTTPPostAttempts"),
+    ("OPConfig", "deviceRefreshPeriod", 60, "showPing"),
+    ("OPConfig", "configWatchPeriod", 1, "showPing")
+])
+def test_startup_keys_keep_their_values(section, key, value, other):
+    merged, restart = connector_config.merge(CONFIG, changed(**{section: {key: value, other: 1}}))
+
+    assert restart == ["%s.%s" % (section, key)]
+    assert merged[section].get(key) == CONFIG[section].get(key)
+    # The other keys of the section are reloaded
+    assert merged[section][other] == 1
+
+
+def test_removed_startup_key_keeps_its_value():
+    new = copy.deepcopy(CONFIG)
+    del new["OPConfig"]["deviceRefreshPeriod"]
+
+    merged, restart = connector_config.merge(CONFIG, new)
+
+    assert restart == ["OPConfig.deviceRefreshPeriod"]
+    assert merged["OPConfig"]["deviceRefreshPeriod"] == 300
+
+
+def test_added_startup_key_is_not_taken():
+    merged, restart = connector_config.merge(CONFIG, changed(UbirchHTTPConfig={"HTTPMaxInflight": 100}))
+
+    assert restart == ["UbirchHTTPConfig.HTTPMaxInflight"]
+    assert "HTTPMaxInflight" not in merged["UbirchHTTPConfig"]
+
+
+def test_merge_does_not_change_its_arguments():
+    old = copy.deepcopy(CONFIG)
+    new = changed(OPConfig={"deviceRefreshPeriod": 60}, LogConfig={"logLevel": 10})
+    expected = copy.deepcopy(new)
+
+    connector_config.merge(old, new)
+
+    assert old == CONFIG
+    assert new == expected
+
+
+def test_compile_config():
+    settings = connector_config.compile_config(CONFIG)
+
+    assert settings.op.showMeasurements
+    assert settings.device.registrationTimeout == 60
+    assert list(settings.decoders) == ["app"]
+
+
+@pytest.mark.parametrize("section, values", [
+    ("OPConfig", {"showPing": None}),
+    ("TTNDeviceConfig", {"allowedClockOffset": True}),
+    ("UbirchHTTPConfig", {"UbirchKEY": "https://key.ubirch.com/"}),
+    ("UbirchHTTPConfig", {"DataBatchConfig": {"enabled": True}}),
+    ("UbirchHTTPConfig", {"DataBatchConfig": {"enabled": True}, "UbirchDATABulk": "https://data/%s/%s"}),
+    ("DataConfig", {"structFormat": "fz"}),
+    ("TTNAppConfig", {"appAccessKey": ""})
+])
+def test_compile_config_rejects_invalid_configs(section, values):
+    with pytest.raises(ValueError):
+        connector_config.compile_config(changed(**{section: values}))
+
+
+def test_compile_config_bulk_batches():
+    config = changed(UbirchHTTPConfig={"DataBatchConfig": {"enabled": True},
+                                       "UbirchDATABulk": "https://data.%s.ubirch.com/v1/msgPack/batch"})
+
+    connector_config.compile_config(config)
+    connector_config.compile_config(changed(UbirchHTTPConfig={"DataBatchConfig": {"enabled": True,
+                                                                                 "mode": "concurrent"}}))
@@ -0,0 +1,153 @@
+import random
+
+import pytest
+
+import key_registration
+from key_registration import FLAG_LAST, FLAG_RESET, KeyReassembler
+
+UPP = bytes(range(256)) + bytes(range(100))
+
+
+# Split the UPP into parts of the given chunk sizes (the last part gets the rest)
+def split(sizes, upp=UPP):
+    parts = []
+    offset = 0
+
+    for index, size in enumerate(sizes):
+        parts.append(bytes([index]) + upp[offset:offset + size])
+        offset += size
+
+    parts.append(bytes([FLAG_LAST | len(sizes)]) + upp[offset:])
+
+    return parts
+
+
+def add_all(reassembler, parts):
+    return [reassembler.add(part) for part in parts]
+
+
+def test_in_order():
+    results = add_all(KeyReassembler(1024), split([100, 100, 100]))
+
+    assert [r[0] for r in results[:-1]] == [key_registration.PART_ADDED] * 3
+    assert results[-1] == (key_registration.UPP_COMPLETE, UPP)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_out_of_order_and_uneven(seed):
+    parts = split([10, 120, 33, 1, 90])
+    random.Random(seed).shuffle(parts)
+
+    results = add_all(KeyReassembler(1024), parts)
+
+    assert results[-1] == (key_registration.UPP_COMPLETE, UPP)
+    assert all(r == (key_registration.PART_ADDED, None) for r in results[:-1])
+
+
+def test_last_part_first():
+    parts = split([100, 100])
+    r = KeyReassembler(1024)
+
+    assert r.add(parts[2]) == (key_registration.PART_ADDED, None)
+    assert r.gaps() == [0, 1]
+    assert r.add(parts[0]) == (key_registration.PART_ADDED, None)
+    assert r.add(parts[1]) == (key_registration.UPP_COMPLETE, UPP)
+    assert not r.pending()
+
+
+def test_duplicate_part_is_ignored():
+    parts = split([100, 100])
+    r = KeyReassembler(1024)
+
+    r.add(parts[0])
+
+    assert r.add(parts[0]) == (key_registration.PART_DUPLICATE, None)
+    assert r.add(parts[1]) == (key_registration.PART_ADDED, None)
+    assert r.add(parts[2]) == (key_registration.UPP_COMPLETE, UPP)
+
+
+def test_gaps():
+    parts = split([50, 50, 50, 50])
+    r = KeyReassembler(1024)
+
+    r.add(parts[0])
+    r.add(parts[3])
+
+    assert r.gaps() == [1, 2]
+    assert r.pending()
+
+    r.add(parts[4])
+
+    assert r.gaps() == [1, 2]
+
+
+def test_part_after_the_last_one_is_invalid():
+    parts = split([100, 100])
+    r = KeyReassembler(1024)
+
+    r.add(parts[1])
+    r.add(parts[2])
+
+    assert r.add(bytes([3]) + b"more") == (key_registration.PART_INVALID, None)
+    assert r.add(bytes([FLAG_LAST | 1]) + b"again") == (key_registration.PART_DUPLICATE, None)
+    assert r.add(bytes([FLAG_LAST | 0]) + b"second last") == (key_registration.PART_INVALID, None)
+
+
+def test_empty_parts_are_invalid():
+    r = KeyReassembler(1024)
+
+    assert r.add(b"") == (key_registration.PART_INVALID, None)
+    assert r.add(bytes([0])) == (key_registration.PART_INVALID, None)
+
+
+def test_over_cap():
+    parts = split([100, 100])
+    r = KeyReassembler(300)
+
+    assert r.add(parts[0]) == (key_registration.PART_ADDED, None)
+    assert r.add(parts[2]) == (key_registration.PART_ADDED, None)
+    assert r.add(parts[1]) == (key_registration.PART_OVERFLOW, None)
+
+
+def test_reset_flag_discards_the_parts_before():
+    r = KeyReassembler(1024)
+    r.add(bytes([0]) + b"stale")
+    r.add(bytes([2]) + b"stale")
+
+    parts = split([100, 100])
+    parts[0] = bytes([FLAG_RESET | 0]) + parts[0][1:]
+
+    assert add_all(r, parts)[-1] == (key_registration.UPP_COMPLETE, UPP)
+
+
+def test_state_round_trip():
+    parts = split([10, 200, 30])
+    r = KeyReassembler(1024)
+    r.add(parts[3])
+    r.add(parts[1])
+
+    restored = KeyReassembler(1024)
+    restored.setState(r.getState())
+
+    assert restored.gaps() == [0, 2]
+    assert restored.add(parts[0])[0] == key_registration.PART_ADDED
+    assert restored.add(parts[2]) == (key_registration.UPP_COMPLETE, UPP)
+
+
+def test_state_of_fixed_size_parts():
+    # [chunkSize, received, last, lastChunk, length, data] - parts 0 and 2 of 100 bytes, the last one not yet received
+    state = [100, 0b101, -1, None, 300, UPP[:100] + bytes(100) + UPP[200:300]]
+    r = KeyReassembler(1024)
+    r.setState(state)
+
+    assert r.gaps() == [1]
+    assert r.add(bytes([1]) + UPP[100:200])[0] == key_registration.PART_ADDED
+    assert r.add(bytes([FLAG_LAST | 3]) + UPP[300:]) == (key_registration.UPP_COMPLETE, UPP)
+
+
+def test_state_over_cap_is_rejected():
+    r = KeyReassembler(1024)
+    r.add(bytes([0]) + UPP)
+
+    with pytest.raises(ValueError):
+        KeyReassembler(100).setState(r.getState())
@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+
+import spool
+
+
+class Context():
+    def __init__(self, directory, **cfg):
+        cfg.update(directory=str(directory), fsync="never", replayRate=0, replayRetryDelay=60)
+        self.config = {"SpoolConfig": cfg}
+        self.log = logging.getLogger("test-spool")
+
+
+# Collects the replayed records, acknowledges them if accept(record) is true
+class Handler():
+    def __init__(self, accept=lambda *record: True):
+        self.accept = accept
+        self.records = []
+
+    def __call__(self, *record):
+        if not self.accept(*record):
+            return False
+
+        self.records.append(list(record))
+        return True
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def fill(directory, count, **cfg):
+    s = spool.Spool(Context(directory, **cfg), Handler())
+
+    for i in range(count):
+        assert s.append("data", "dev-%d" % i, "uuid", b"body-%d" % i)
+
+    s.stop()
+
+
+def replay(directory, handler, **cfg):
+    s = spool.Spool(Context(directory, **cfg), handler)
+    s.start()
+    wait_for(lambda: s.getStats()["depthRecords"] == 0 and not s.segments)
+    s.stop()
+
+    return s
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(str(directory)) if name.endswith(spool.SEGMENT_SUFFIX))
+
+
+def test_replays_all_records_in_order(tmp_path):
+    fill(tmp_path, 5)
+    handler = Handler()
+
+    s = replay(tmp_path, handler)
+
+    assert [r[1] for r in handler.records] == ["dev-%d" % i for i in range(5)]
+    assert handler.records[0] == ["data", "dev-0", "uuid", b"body-0"]
+    assert s.getStats()["replayed"] == 5
+    assert s.getStats()["corrupt"] == 0
+    assert segments(tmp_path) == []
+
+
+def test_torn_record_skips_the_tail_of_its_segment(tmp_path):
+    fill(tmp_path, 3)
+    path = os.path.join(str(tmp_path), segments(tmp_path)[0])
+
+    # A crash while the last record was written
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    handler = Handler()
+    s = replay(tmp_path, handler)
+
+    assert [r[1] for r in handler.records] == ["dev-0", "dev-1"]
+    assert s.getStats()["corrupt"] == 1
+
+
+def test_crc_corrupt_record_skips_the_rest_of_its_segment_only(tmp_path):
+    # Two records per segment
+    record = spool.RECORD_HEADER.size + len(b"\x94\xa4data\xa5dev-0\xa4uuid\xc4\x06body-0")
+    fill(tmp_path, 4, segmentBytes=2 * record)
+    first = os.path.join(str(tmp_path), segments(tmp_path)[0])
+
+    assert len(segments(tmp_path)) == 2
+
+    # Flip the last byte of the first record's payload
+    with open(first, "r+b") as f:
+        f.seek(record - 1)
+        last = f.read(1)
+        f.seek(record - 1)
+        f.write(bytes([last[0] ^ 0xff]))
+
+    handler = Handler()
+    s = replay(tmp_path, handler, segmentBytes=2 * record)
+
+    assert [r[1] for r in handler.records] == ["dev-2", "dev-3"]
+    assert s.getStats()["corrupt"] == 1
+
+
+def test_resumes_at_the_cursor_after_a_restart(tmp_path):
+    fill(tmp_path, 6)
+
+    # Only the first three records are acknowledged before the restart
+    handler = Handler(lambda kind, dev_id, uuidstr, body: dev_id in ("dev-0", "dev-1", "dev-2"))
+    s = spool.Spool(Context(tmp_path), handler)
+    s.start()
+    wait_for(lambda: s.getStats()["replayFailed"] > 0)
+    s.stop()
+
+    assert [r[1] for r in handler.records] == ["dev-0", "dev-1", "dev-2"]
+
+    handler = Handler()
+    s = spool.Spool(Context(tmp_path), handler)
+
+    assert s.getStats()["depthRecords"] == 3
+
+    s.start()
+    wait_for(lambda: s.getStats()["depthRecords"] == 0)
+    s.stop()
+
+    assert [r[1] for r in handler.records] == ["dev-3", "dev-4", "dev-5"]
+
+
+def test_rejects_records_beyond_max_bytes(tmp_path):
+    s = spool.Spool(Context(tmp_path, maxBytes=100), Handler())
+
+    assert s.append("data", "dev-0", "uuid", b"x" * 40)
+    assert not s.append("data", "dev-1", "uuid", b"x" * 40)
+    assert s.getStats()["rejected"] == 1
+
+    s.stop()
@@ -0,0 +1,62 @@
+import threading
+import time
+import device_registry
+import mqtt_connection
+
+
+# Get the configs of all applications - "TTNAppConfig" holds one application or a list of them
+def app_configs(config):
+    apps = config["TTNAppConfig"]
+
+    return apps if isinstance(apps, list) else [apps]
+
+
+class TTNApplication():
+    """ A TTN application served by the connector - its MQTT connection, devices and measurement decoder """
+
+    def __init__(self, context, appConfig):
+        self.context = context
+        self.config = appConfig
+        self.appID = appConfig["appID"]
+
+        # The global DataConfig is used if the application has no own one (compiled by connector_config)
+        self.decoder = context.settings.decoders[self.appID]
+
+        # Device IDs are only unique within an application
+        self.devices = device_registry.DeviceRegistry(context, self)
+        self.mqtt = None
+
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "uplinks": 0,  # how many uplinks were received
+            "downlinks": 0,  # how many downlinks were sent
+            "errors": 0,  # how many uplinks could not be processed
+            "verifyFailed": 0,  # how many measurements could not be verified with niomon
+            "sendFailed": 0  # how many measurements could not be sent to the data service
+        }
+
+    # Set up the MQTT connection (retried every five seconds), link is used instead if given (see sharding.py)
+    def connect(self, link=None):
+        if link is not None:
+            self.mqtt = link.app(self.appID)
+            return
+
+        while True:
+            self.context.log.info("setting up MQTT connection to TTN (app %s) ..." % self.appID)
+            self.mqtt = mqtt_connection.MQTTConnection(self.context, self.config)
+
+            if not self.mqtt.connection_failed:
+                break
+
+            self.context.log.error("setting up MQTT connection failed (app %s)!" % self.appID)
+            time.sleep(5)
+
+    # Increment a statistics counter
+    def count(self, key, n=1):
+        with self.statsLock:
+            self.stats[key] += n
+
+    # Return statistics
+    def getStats(self):
+        with self.statsLock:
+            return dict(self.stats)
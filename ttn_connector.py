@@ -1,16 +1,30 @@
 import time
 import sys
-import datetime
+import signal
+import threading
 import requests
 import json
-import struct
 import msgpack
 import logging
 import json_logging
 import base64
+import collections
 import mprotocol
-import ttn_device
 import mqtt_connection
+import ingest
+import ubirch_client
+import data_batcher
+import dedup_cache
+import submitter
+import spool
+import device_snapshot
+import scheduler
+import upp_verifier
+import metrics
+import log_pipeline
+import circuit_breaker
+import ttn_application
+import connector_config
 from os import getenv
 
 CONFIGFILE = getenv("CONNECTOR_CONFIG_PATH", "config.json")
@@ -20,13 +34,38 @@ CONFIGFILE = getenv("CONNECTOR_CONFIG_PATH", "config.json")
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 class TTNConnector():
-    def __init__(self):
+    # Sets up the connector, config is loaded from CONFIGFILE if not given - call run() to start it
+    # offline=True only sets up the decoding and Ubirch stages, without MQTT and devices (see replay.py)
+    # link is used instead of the MQTT connections, link.app(appID) must provide send() and app_client (see sharding.py)
+    def __init__(self, config=None, offline=False, link=None):
         # Get the configuration and initialize the logger
-        self.config = self.getConfig()
+        # The config file is read again on a reload (see reloadConfig), a given config can not be reloaded
+        self.configFile = CONFIGFILE if config is None else None
+        self.config = config if config is not None else self.getConfig()
         self.log = self.setupLog(self.config["LogConfig"]["logFile"],
                                  self.config["LogConfig"]["logLevel"],
                                  self.config["LogConfig"]["logFormat"])
-        self.devices = []
+        self.metrics = self.setupMetrics()
+        self.scheduler = scheduler.TimerScheduler(self)
+
+        # Validate the config and compile the values used on the message path (replaced as a whole on a reload)
+        self.settings = connector_config.compile_config(self.config)
+        self.reloadable = connector_config.RELOADABLE
+        self.reloadLock = threading.Lock()
+        self.watcher = None
+
+        # Set up the message handlers
+        self.setupDispatcher()
+
+        # Set up the TTN applications (by appID) - each has its own devices and measurement decoder
+        self.apps = collections.OrderedDict()
+
+        for appConfig in ttn_application.app_configs(self.config):
+            self.apps[appConfig["appID"]] = ttn_application.TTNApplication(self, appConfig)
+
+        # The first application is used if none is given (e.g. by replay.py)
+        self.app = next(iter(self.apps.values()))
+        self.decoder = self.app.decoder
 
         self.log.info("initialising ...")
 
@@ -37,28 +76,115 @@ class TTNConnector():
         if self.config["OPConfig"]["disableUbirch"]:
             self.log.warning("Not verifying any data with Ubirch!")
 
-        # Set up MQTT connection
-        while True:
-            self.log.info("setting up MQTT connection to TTN ...")
-            self.mqtt = mqtt_connection.MQTTConnection(self)
+        # Set up the shared Ubirch HTTP client
+        self.ubirch = ubirch_client.UbirchClient(self)
+
+        # Set up the (optional) spool for posts that failed
+        self.spool = None
+        self.liveAttempts = None
+
+        if self.config.get("SpoolConfig", {}).get("enabled", False):
+            self.spool = spool.Spool(self, self.replaySpooled)
+            self.spool.start()
+
+            # Failed posts are replayed later, no need to block the pipeline with retries
+            self.liveAttempts = self.config["SpoolConfig"].get("liveAttempts", 1)
+
+        # Set up the (optional) batching stage for the data service
+        self.batcher = None
+
+        if self.config["UbirchHTTPConfig"].get("DataBatchConfig", {}).get("enabled", False):
+            self.batcher = data_batcher.DataBatcher(self)
+            self.batcher.start()
+
+        # Set up the stage verifying/uploading measurements and registering keys
+        self.submitter = submitter.MeasurementSubmitter(self)
+
+        # Set up the (optional) cache dropping measurements delivered more than once
+        self.dedup = None
+
+        if self.config.get("DedupConfig", {}).get("enabled", False):
+            self.dedup = dedup_cache.DedupCache(self)
+
+        self.ingest = None
+        self.snapshots = None
+        self.verifier = None
+
+        if offline:
+            return
+
+        # Set up the (optional) local verification of the UPP signatures with the keys of the registration UPPs
+        if self.config.get("LocalVerifyConfig", {}).get("enabled", False):
+            self.verifier = upp_verifier.UPPVerifier(self)
+            self.verifier.load()
+
+        # Restore the devices of the last (optional) snapshot before any uplink is handled
+        if self.config.get("SnapshotConfig", {}).get("enabled", False):
+            self.snapshots = device_snapshot.DeviceSnapshots(self)
+            self.snapshots.restore()
+
+        # Set up the ingest queue, uplinks are processed by its workers instead of the MQTT thread
+        self.ingest = ingest.IngestQueue(self, self.ingestCB)
+        self.ingest.start()
+
+        # Set up the MQTT connections
+        for app in self.apps.values():
+            app.connect(link)
+
+        # Setup device - with snapshots, the restored devices are reconciled with TTN in the background
+        if self.snapshots:
+            threading.Thread(target=self.reconcileDevices, name="device-reconcile", daemon=True).start()
+            self.snapshots.start()
+        else:
+            self.setupDevices()
+
+        # Export the queue depths and the per-device totals
+        self.setupGauges()
+
+        # Keep the device list up to date in the background
+        if self.config["OPConfig"].get("deviceRefreshPeriod", 0) > 0:
+            for app in self.apps.values():
+                app.devices.start_refresh(self.config["OPConfig"]["deviceRefreshPeriod"])
+
+        # Reload the config when its file changes (it is also reloaded on SIGHUP)
+        if self.configFile and self.config["OPConfig"].get("configWatchPeriod", 0) > 0:
+            self.watcher = connector_config.ConfigWatcher(self, self.configFile,
+                                                          self.config["OPConfig"]["configWatchPeriod"])
+            self.watcher.start()
+
+    # Loop - fire the device timeouts when they are due (blocks until stop() is called)
+    def run(self):
+        self.scheduler.run()
+
+    # Stop all stages, queued uplinks and pending posts are processed first
+    def stop(self):
+        if self.watcher:
+            self.watcher.stop()
+
+        if self.ingest:
+            self.ingest.stop()
+
+        # The device states are final once the queued uplinks are processed
+        if self.snapshots:
+            self.snapshots.stop()
+
+        self.submitter.stop()
+
+        if self.batcher:
+            self.batcher.stop()
 
-            if self.mqtt.connection_failed:
-                # Retry every five sconds
-                self.log.error("setting up MQTT connection failed!")
-                time.sleep(5)
-            else:
-                break
+        if self.spool:
+            self.spool.stop()
 
-        # Setup device
-        self.setupDevices()
+        # Keep the heads of the UPP chains and the keys registered since the last save
+        if self.verifier:
+            self.verifier.save()
 
-        # Loop
-        while True:
-            # Make a tick in all device objects
-            for deviceObj in self.devices:
-                deviceObj["device"].tick(noTimesync=True)
+        self.scheduler.stop()
+        self.ubirch.close()
 
-            time.sleep(self.config["OPConfig"]["tickPeriod"])
+        if self.logPipeline:
+            self.logPipeline.stop()
 
     # Loads the config from CONFIGFILE
     def getConfig(self):
@@ -68,6 +194,76 @@ class TTNConnector():
             print("ERROR opening configfile (%s)!" % CONFIGFILE)
             raise(e)
 
+    # Loads the config again for a reload, None if it can not be reloaded
+    def loadConfig(self):
+        if self.configFile is None:
+            return None
+
+        return connector_config.load(self.configFile)
+
+    # Reload the config - the values of the reloadable sections (see connector_config.RELOADABLE) take effect at once,
+    # changes to other sections are logged and need a restart. Returns True if the config was reloaded
+    # A config that can not be read or is invalid is rejected, the current one is kept
+    def reloadConfig(self):
+        with self.reloadLock:
+            try:
+                config = self.loadConfig()
+
+                if config is None:
+                    self.log.warning("config reload requested, but the config was not loaded from a file - ignored")
+                    return False
+
+                config, restart = connector_config.merge(self.config, config, self.reloadable)
+                settings = connector_config.compile_config(config)
+            except Exception as e:
+                self.log.error("config reload failed - keeping the current config (%s)", e)
+                return False
+
+            changed = connector_config.changed_sections(self.config, config)
+
+            if restart:
+                self.log.warning("config changed, restart required for: %s", ", ".join(restart))
+
+            # The sections needing a restart keep their current values
+            if not changed:
+                self.log.info("config reloaded - nothing to change")
+                return True
+
+            old = self.config
+            self.config = config
+            self.settings = settings
+
+            # The decoders of the applications whose DataConfig changed - the last measurements were decoded with the
+            # old one and can not be read with the new one
+            for appID, app in self.apps.items():
+                if app.config.get("DataConfig", old["DataConfig"]) != app.config.get("DataConfig", config["DataConfig"]):
+                    app.decoder = settings.decoders[appID]
+
+                    for device in app.devices:
+                        device.lastMeasurement = None
+
+            self.decoder = self.app.decoder
+
+            if config["UbirchHTTPConfig"] != old["UbirchHTTPConfig"]:
+                self.reloadUbirch()
+
+            if config["LogConfig"]["logLevel"] != old["LogConfig"]["logLevel"]:
+                self.log.setLevel(config["LogConfig"]["logLevel"])
+                self.logHandler.setLevel(config["LogConfig"]["logLevel"])
+
+            self.log.info("config reloaded - changed: %s", ", ".join(changed))
+
+            return True
+
+    # Replace the Ubirch HTTP client with one of the current config
+    # The old one is closed once the posts in flight are done (at most all attempts with their retry delays)
+    def reloadUbirch(self):
+        old = self.ubirch
+        self.ubirch = ubirch_client.UbirchClient(self)
+
+        grace = old.attempts * (sum(old.timeout) + old.maxRetryDelay)
+        self.scheduler.call_later(grace, old.close)
+
     # Sets up the logger
     def setupLog(self, logfile, level, format):
         json_logging.ENABLE_JSON_LOGGING = self.config["LogConfig"]["enableJSON"]
@@ -85,240 +281,477 @@ class TTNConnector():
             raise(e)
 
         fh.setLevel(level)
+        self.logHandler = fh
 
         if self.config["LogConfig"]["enableJSON"] == False:
             # Create a format
             fmt = logging.Formatter(format)
             fh.setFormatter(fmt)
 
-        log.addHandler(fh)
+        # The file handler writes in a background thread - logging calls on the message path only enqueue the record
+        self.logPipeline = None
+
+        if self.config["LogConfig"].get("async", True):
+            self.logPipeline = log_pipeline.LogPipeline(log, [fh], self.config["LogConfig"].get("queueSize", 10000),
+                                                        self.config["LogConfig"].get("deviceDebugRate", 10))
+            self.logPipeline.start()
+        else:
+            log.addHandler(fh)
 
         return log
 
+    # Sets up the metrics, if disabled all calls to them do nothing
+    def setupMetrics(self):
+        cfg = self.config.get("MetricsConfig", {})
+
+        if not cfg.get("enabled", False):
+            return metrics.NullMetrics()
+
+        m = metrics.Metrics(self)
+        m.start_server(cfg.get("address", "127.0.0.1"), cfg.get("port", 9100))
+
+        return m
+
+    # Register the gauges/collectors evaluated on every scrape
+    def setupGauges(self):
+        self.metrics.gauge("ingest_queue_depth", "Uplinks waiting to be processed", self.ingest.depth)
+        self.metrics.gauge("devices", "Known devices",
+                           lambda: [((("app", app.appID),), len(app.devices)) for app in self.apps.values()])
+        self.metrics.gauge("scheduled_timers", "Scheduled device timeouts (incl. cancelled)", lambda: len(self.scheduler))
+        self.metrics.collector(lambda: [("ingest_%s_total" % k, (), v) for k, v in self.ingest.getStats().items()
+                                        if k != "depth"])
+
+        self.metrics.gauge("submit_pending", "Verifications/data uploads/key registrations waiting or in flight",
+                           lambda: self.submitter.getStats()["pending"])
+        self.metrics.collector(lambda: [("submit_%s_total" % k, (), v) for k, v in self.submitter.getStats().items()
+                                        if k != "pending"])
+
+        if self.dedup:
+            self.metrics.gauge("dedup_entries", "Measurements remembered by the dedup cache",
+                               lambda: self.dedup.getStats()["entries"])
+            self.metrics.gauge("dedup_hit_ratio", "Share of the measurements dropped as duplicates",
+                               lambda: self.dedup.getStats()["hits"] / max(1, self.dedup.getStats()["lookups"]))
+            self.metrics.collector(lambda: [("dedup_%s_total" % k, (), v) for k, v in self.dedup.getStats().items()
+                                            if k != "entries"])
+
+        if self.verifier:
+            self.metrics.gauge("local_verify_keys", "Device keys in the key store of the local verification",
+                               lambda: self.verifier.getStats()["keys"])
+            self.metrics.collector(lambda: [("local_verify_%s_total" % k, (), v)
+                                            for k, v in self.verifier.getStats().items() if k != "keys"])
+
+        if self.batcher:
+            self.metrics.gauge("batch_pending", "Measurements waiting for the next batch",
+                               lambda: self.batcher.getStats()["pending"])
+            self.metrics.collector(lambda: [("batch_%s_total" % k, (), v) for k, v in self.batcher.getStats().items()
+                                            if k != "pending"])
+
+        if self.snapshots:
+            self.metrics.gauge("snapshot_last_devices", "Devices in the last device snapshot",
+                               lambda: self.snapshots.getStats()["lastDevices"])
+            self.metrics.gauge("snapshot_last_seconds", "Time it took to write the last device snapshot",
+                               lambda: self.snapshots.getStats()["lastSeconds"])
+            self.metrics.collector(lambda: [("snapshot_%s_total" % k, (), v) for k, v in self.snapshots.getStats().items()
+                                            if k in ("written", "failed")])
+
+        if self.spool:
+            self.metrics.gauge("spool_depth_records", "Spooled posts waiting to be replayed",
+                               lambda: self.spool.getStats()["depthRecords"])
+            self.metrics.gauge("spool_depth_bytes", "Disk usage of the spool",
+                               lambda: self.spool.getStats()["depthBytes"])
+            self.metrics.gauge("spool_replay_rate", "Replayed posts per second",
+                               lambda: self.spool.getStats()["replayRate"])
+            self.metrics.collector(lambda: [("spool_%s_total" % k, (), v) for k, v in self.spool.getStats().items()
+                                            if not k.startswith("depth") and k != "replayRate"])
+
+        if self.ubirch.breakers:
+            self.metrics.gauge("breaker_state", "State of the circuit breakers (0 closed, 1 half-open, 2 open)",
+                               lambda: [((("endpoint", endpoint),), circuit_breaker.STATE_VALUES[stats["state"]])
+                                        for endpoint, stats in self.ubirch.getBreakerStats().items()])
+            self.metrics.gauge("breaker_concurrency_limit", "Adaptive concurrency limit of the circuit breakers",
+                               lambda: [((("endpoint", endpoint),), stats["limit"])
+                                        for endpoint, stats in self.ubirch.getBreakerStats().items()])
+            self.metrics.collector(self.getBreakerCounters)
+
+        if self.logPipeline:
+            self.metrics.collector(lambda: [("log_%s_total" % k, (), v) for k, v in self.logPipeline.getStats().items()])
+
+        self.metrics.collector(self.getAppCounters)
+
+        if self.config.get("MetricsConfig", {}).get("perDevice", False):
+            self.metrics.collector(self.getDeviceCounters)
+
+    # Return the rejected requests and state transitions of the circuit breakers as counters
+    def getBreakerCounters(self):
+        counters = []
+
+        for endpoint, stats in self.ubirch.getBreakerStats().items():
+            labels = (("endpoint", endpoint),)
+            counters.append(("breaker_rejected_total", labels, stats["rejected"]))
+            counters.append(("breaker_acquire_timeouts_total", labels, stats["acquireTimeouts"]))
+
+            for state, key in circuit_breaker.TRANSITIONS.items():
+                counters.append(("breaker_transitions_total", labels + (("to", state),), stats[key]))
+
+        return counters
+
+    # Return the throughput/error totals of all applications as counters
+    def getAppCounters(self):
+        counters = []
+
+        for app in self.apps.values():
+            labels = (("app", app.appID),)
+            counters.extend(("app_%s_total" % k, labels, v) for k, v in app.getStats().items())
+
+        return counters
+
+    # Return the uplink/downlink totals of all devices as counters
+    def getDeviceCounters(self):
+        counters = []
+
+        for app in self.apps.values():
+            for device in app.devices:
+                labels = (("app", app.appID), ("device", device.deviceID))
+                counters.append(("device_uplinks_total", labels, device.uplinksReceived))
+                counters.append(("device_downlinks_total", labels, device.downlinksSent))
+
+        return counters
+
     # Setup devices
     def setupDevices(self):
-        devs = self.mqtt.app_client.devices()
-        # Go trough the list of device IDs and create device objects
-        for dev in devs:
-            self.log.info("creating device instance: %s" % dev.dev_id)
-            self.devices.append({
-                "ID": dev.dev_id,
-                "device": ttn_device.TTNDevice(self, dev.dev_id)
-            })
-
-    # Get a device object from the self.devices[] array by its it
-    def getDeviceObjByID(self, dev_id):
-        for deviceObj in self.devices:
-            if deviceObj["ID"] == dev_id:
-                return deviceObj
+        # Create device objects for all devices known at startup - unknown devices are created on their first uplink
+        # Restored devices that were deleted in TTN meanwhile are removed
+        for app in self.apps.values():
+            app.devices.reconcile()
 
-    # Function to be called on mqtt messages
-    def uplinkCB(self, msg, dev_id):
-        # Check if there are any devices
-        if len(self.devices) < 1:
+    # Setup devices in the background (the restored devices are used meanwhile)
+    def reconcileDevices(self):
+        started = time.monotonic()
+
+        try:
+            self.setupDevices()
+        except Exception as e:
+            self.log.error("reconciling the restored devices with TTN failed")
+            self.log.exception(e)
             return
 
+        self.log.info("restored devices reconciled with TTN in %.3fs", time.monotonic() - started)
+
+    # Get a device object by its ID (and the ID of its application), None if unknown
+    def getDevice(self, dev_id, appID=None):
+        app = self.apps.get(appID) if appID is not None else self.app
+
+        return app.devices.get(dev_id) if app else None
+
+    # Function to be called by the ingest workers with the raw (base64) payload of an uplink
+    def ingestCB(self, raw_payload, dev_id, appID=None):
+        started = time.monotonic()
+        self.uplinkCB(mqtt_connection.decode_payload(raw_payload), dev_id, appID)
+        self.metrics.observe("uplink", started)
+
+    # Set up the table of message handlers (by control byte)
+    # Other message types can be added with self.dispatcher.register(ctrl, handler)
+    def setupDispatcher(self):
+        types = mprotocol.MP_CTRL_B_TYPES
+
+        self.dispatcher = mprotocol.Dispatcher(self.unhandledCB)
+        self.dispatcher.register(types["MSG_MEASUREMENTS"], self.measurementsCB)
+        self.dispatcher.register(types["MSG_PING"], self.pingCB)
+        self.dispatcher.register(types["MSG_ACK"], self.ackCB)
+        self.dispatcher.register(types["MSG_NACK"], self.nackCB)
+        self.dispatcher.register(types["MSG_CFG_VAL_RESP"], self.cfgValRespCB)
+        self.dispatcher.register(types["MSG_REGISTER_KEY_PART"], self.registerKeyPartCB)
+
+    # Function to be called on mqtt messages
+    def uplinkCB(self, msg, dev_id, appID=None):
+        app = self.apps[appID] if appID is not None else self.app
+        app.count("uplinks")
+
         # Try to unpack and process the message
         try:
-            # Get the payload
-            mp_msg_unpacked = mprotocol.unpack_mp_msg(msg)
-
-            # Handle the message
-            if mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_MEASUREMENTS"]:
-                upp = mp_msg_unpacked["MSG_DATA"]
-
-                if not upp:
-                    self.log.error("[DEV:%s] measurement does not contain a payload!" % dev_id)
-                else:
-                    unpacked_upp = msgpack.unpackb(upp)
-                    unpacked_measurements = self.unpack_measurements(unpacked_upp)
-
-                    # Payload (UPP) layout:
-                    #   [0] = UPP Version
-                    #   [1] = Device UUID
-                    #   [2] = Previous UPP signature
-                    #   [3] = UPP Type
-                    #   [4] = UPP Payload
-                    #   [5] = UPP Signature
-
-                    # Transmit the received measurement to the current device object and tick it
-                    self.getDeviceObjByID(dev_id)["device"].setMeasurement(unpacked_measurements)
-                    time.sleep(0.1)
-                    self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=False)
-
-                    # Send it to ubirch
-                    if not self.config["OPConfig"]["disableUbirch"]:
-                        self.verifiy_data(upp, unpacked_upp[1])
-                        self.send_measurements(unpacked_measurements, unpacked_upp[4], unpacked_upp[1])
-            elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_PING"]:
-                # Transmit the ping to the current device and tick it
-                self.getDeviceObjByID(dev_id)["device"].ping()
-                time.sleep(0.1)
-                self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=True)
-            elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_ACK"]:
-                # Transmit the acknowledge to the current device and tick it
-                self.getDeviceObjByID(dev_id)["device"].setAckReceived()
-                time.sleep(0.1)
-                self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=True)
-            elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_NACK"]:
-                # Transmit the NOT-acknowledge to the current device and tick it
-                self.getDeviceObjByID(dev_id)["device"].setNackReceived()
-                time.sleep(0.1)
-                self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=True)
-            elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_CFG_VAL_RESP"]:
-                # Pass the information to the device object and tick it
-                payload = mp_msg_unpacked["MSG_DATA"]
-
-                if not payload:
-                    self.log.error("[DEV:%s] cfg val response does not contain a payload!" % dev_id)
-                else:
-                    self.getDeviceObjByID(dev_id)["device"].setDataResponseReceived(mp_msg_unpacked["MSG_DATA"])
-                    time.sleep(0.1)
-                    self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=True)
-            elif mp_msg_unpacked["MSG_CTRL_B"] == mprotocol.MP_CTRL_B_TYPES["MSG_REGISTER_KEY_PART"]:
-                # Transmit the part to the device object and tick it
-                self.getDeviceObjByID(dev_id)["device"].setRegistrationPartReceived(mp_msg_unpacked["MSG_DATA"])
-                time.sleep(0.1)
-                self.getDeviceObjByID(dev_id)["device"].tick(noTimesync=True)
-            else:
-                self.log.warning("[DEV:%s] unhandled MSG_CTRL_B: %d" % (dev_id, mp_msg_unpacked["MSG_CTRL_B"]))
+            device = app.devices.get_or_create(dev_id)
+            device.uplinksReceived += 1
+
+            if msg:
+                self.metrics.inc("messages_total", (("app", app.appID),
+                                                    ("type", mprotocol.MP_CTRL_B_NAMES.get(msg[0], "unknown"))))
+
+            # Pass the message to the handler of its control byte
+            self.dispatcher.dispatch(msg, device)
         except Exception as e:
+            app.count("errors")
             self.log.exception(e)
 
-    def unpack_measurements(self, unpacked_upp):
+    # Message handlers - called with the message data and the device object #
+    def measurementsCB(self, upp, device):
+        if not upp:
+            self.log.error("[DEV:%s] measurement does not contain a payload!", device.deviceID)
+            return
+
+        started = time.monotonic()
+        unpacked_upp = msgpack.unpackb(upp)
+        self.metrics.observe("msgpack_decode", started)
+
+        # The UUID is needed for every request to Ubirch (see replay.py)
+        if not isinstance(unpacked_upp, list) or len(unpacked_upp) < 6 or not isinstance(unpacked_upp[1], bytes) \
+                or len(unpacked_upp[1]) != 16:
+            self.log.error("[DEV:%s] measurement is no UPP with a 16 byte UUID - dropped", device.deviceID)
+            device.app.count("errors")
+            return
+
+        # TTN delivers an uplink more than once if several gateways received it (or after a reconnect)
+        if self.dedup and self.dedup.seen(dedup_cache.upp_key(unpacked_upp, upp)):
+            self.log.debug("[DEV:%s] duplicate measurement dropped", device.deviceID)
+            return
+
+        # Reject UPPs with an invalid signature before any request is made
+        verified = False
+
+        if self.verifier:
+            result = self.verifier.verify(unpacked_upp, upp, device.deviceID)
+
+            if result == upp_verifier.INVALID:
+                device.app.count("verifyFailed")
+                return
+
+            verified = result == upp_verifier.VALID
+
+        started = time.monotonic()
+        unpacked_measurements = self.unpack_measurements(unpacked_upp, device.app.decoder)
+        self.metrics.observe("unpack_measurements", started)
+
+        # A payload that can not be decoded is no measurement - the device state is not touched and nothing is sent
+        if unpacked_measurements is None:
+            self.log.error("[DEV:%s] measurement could not be decoded - dropped", device.deviceID)
+            device.app.count("errors")
+            return
+
+        # Payload (UPP) layout:
+        #   [0] = UPP Version
+        #   [1] = Device UUID
+        #   [2] = Previous UPP signature
+        #   [3] = UPP Type
+        #   [4] = UPP Payload
+        #   [5] = UPP Signature
+
+        # Transmit the received measurement to the current device object and tick it
+        device.setMeasurement(unpacked_measurements)
+        device.tick(noTimesync=False)
+
+        # Send it to ubirch (verification and data upload run concurrently in the background)
+        if not self.settings.op.disableUbirch:
+            self.submitter.submit(device, upp, unpacked_measurements, unpacked_upp[4], unpacked_upp[1], verified)
+
+    def pingCB(self, data, device):
+        # Transmit the ping to the current device and tick it
+        device.ping()
+        device.tick(noTimesync=True)
+
+    def ackCB(self, data, device):
+        # Transmit the acknowledge to the current device and tick it
+        device.setAckReceived()
+        device.tick(noTimesync=True)
+
+    def nackCB(self, data, device):
+        # Transmit the NOT-acknowledge to the current device and tick it
+        device.setNackReceived()
+        device.tick(noTimesync=True)
+
+    def cfgValRespCB(self, payload, device):
+        # Pass the information to the device object and tick it
+        if not payload:
+            self.log.error("[DEV:%s] cfg val response does not contain a payload!", device.deviceID)
+            return
+
+        device.setDataResponseReceived(payload)
+        device.tick(noTimesync=True)
+
+    def registerKeyPartCB(self, part, device):
+        # Transmit the part to the device object and tick it
+        device.setRegistrationPartReceived(part)
+        device.tick(noTimesync=True)
+
+    def unhandledCB(self, ctrl, data, device):
+        self.log.warning("[DEV:%s] unhandled MSG_CTRL_B: %d", device.deviceID, ctrl)
+
+    # decoder is the one of the device's application (default: the first application's)
+    def unpack_measurements(self, unpacked_upp, decoder=None):
+        decoder = decoder or self.decoder
+
         try:
             # the unpacked_upp has to contain at least five elements - the fith element contains the relevent data
             if not unpacked_upp or len(unpacked_upp) < 5:
                 return None
 
             # Replace measurement data struct with the unpacked measurements
-            return struct.unpack(self.config["DataConfig"]["structFormat"], bytes(unpacked_upp[4]))
+            return decoder.decode(unpacked_upp[4])
         except Exception as e:
-            self.log.error("received invalid UPP: %s" % str(list(unpacked_upp)))
+            self.log.error("received invalid UPP: %s", list(unpacked_upp))
             self.log.exception(e)
 
     def uuidbin2str(self, uuidbin):
-        # from 16 byte bin to str: "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
-        # get the raw number
-        tmp = struct.unpack('>QQ', uuidbin)
+        # from 16 byte bin to str: "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx" (cached per UUID)
+        return ubirch_client.uuidbin2str(uuidbin)
 
-        # but every hex-digit into a single element
-        tmpl = list(hex(tmp[0]).split('x')[1]) + list(hex(tmp[1]).split('x')[1])
+    # Returns True if niomon validated the payload (verified: the signature was verified locally)
+    def verifiy_data(self, payload, uuid, dev_id=None, verified=False):
+        uuidstr = self.uuidbin2str(uuid)
 
-        tmpl.insert(8, '-')
-        tmpl.insert(13, '-')
-        tmpl.insert(18, '-')
-        tmpl.insert(23, '-')
+        # Locally verified payloads may be sent later or not at all (see LocalVerifyConfig)
+        if verified and not self.verifier.remote(payload, uuidstr, dev_id):
+            return True
 
-        # put it into a string
-        uuidstr = ""
-        for e in tmpl:
-            uuidstr += e
+        self.log.debug("[DEV:%s] verifying payload with UBirch", dev_id)
 
-        return uuidstr
+        return self.verify_result(self.ubirch.verify(uuidstr, payload, self.liveAttempts), payload, uuidstr, dev_id)
 
-    def verifiy_data(self, payload, uuid):
-        attempts_left = self.config["UbirchHTTPConfig"]["HTTPPostAttempts"]
+    # Handle the response of niomon (the post is spooled if it failed), returns True if niomon validated the payload
+    def verify_result(self, r, payload, uuidstr, dev_id=None):
+        if ubirch_client.post_failed(r):
+            self.spoolPost("niomon", dev_id, uuidstr, payload)
 
-        uuidstr = self.uuidbin2str(uuid)
+        if r is None:
+            return False
 
-        self.log.debug("verifying payload with UBirch")
+        if r.status_code == requests.codes.OK:
+            self.log.debug("[DEV:%s] payload validation succeeded", dev_id)
+            return True
 
-        while True:
-            try:
-                passwordB64 = base64.encodebytes(bytes(self.config["UbirchHTTPConfig"]["UbirchPASS"], "UTF-8")).decode("utf-8").rstrip('\n')
-                r = requests.post((self.config["UbirchHTTPConfig"]["UbirchNIOMON"] % self.config["UbirchHTTPConfig"]["UbirchENV"]),
-                                  headers={"X-Ubirch-Hardware-Id": uuidstr,
-                                            "X-Ubirch-Auth-Type": "ubirch",
-                                            "X-Ubirch-Credential": passwordB64},
-                                  timeout=self.config["UbirchHTTPConfig"]["HTTPPostTimeout"],
-                                  data=payload,
-                                  verify=False)
-            except Exception as e:
-                self.log.exception(e)
-            else:
-                # Will exit loop here when message sent
-                break
-
-            attempts_left -= 1
-
-            if attempts_left > 0:
-                self.log.error("HTTP POST request failed - trying again %d more times in %d seconds"
-                               % (attempts_left, 3))
-                time.sleep(3)
-            else:
-                self.log.error("HTTP POST request finally failed")
-                return
+        self.log.error("[DEV:%s] payload validation failed (STATUS_CODE: %d/%s)", dev_id, r.status_code, r.reason)
+        return False
 
-        if r.status_code == requests.codes.OK:
-            self.log.debug("payload validation succeeded")
-        else:
-            self.log.error("payload validation failed (STATUS_CODE: %d/%s)" % (r.status_code, r.reason))
+    # Send a key registration UPP to the key service, returns the response (None if there was none)
+    def register_key(self, upp, dev_id=None):
+        r = self.ubirch.register_key(upp, self.liveAttempts)
+
+        if ubirch_client.post_failed(r):
+            self.spoolPost("key", dev_id, None, upp)
 
-    def send_measurements(self, measurements, data_struct, uuid):
-        attempts_left = self.config["UbirchHTTPConfig"]["HTTPPostAttempts"]
+        return r
 
+    # Returns True if the data service accepted the data (or it was handed to the batching stage)
+    def send_measurements(self, measurements, data_struct, uuid, dev_id=None, decoder=None):
         # put the UUID from binary into standard str format
         uuidstr = self.uuidbin2str(uuid)
+        data = self.data_object(measurements, data_struct, uuidstr, dev_id, decoder)
+
+        # Hand the data object to the batching stage if enabled
+        if self.batcher:
+            return self.batcher.add(dev_id, uuidstr, data)
+
+        self.log.debug("[DEV:%s] sending data to UBirch", dev_id)
 
-        # create the data object
+        return self.send_result(self.ubirch.send_data(uuidstr, data, self.liveAttempts), data, uuidstr, dev_id)
+
+    # Create the data object of a measurement (as sent to the data service)
+    def data_object(self, measurements, data_struct, uuidstr, dev_id=None, decoder=None):
+        decoder = decoder or self.decoder
+
+        # create the data object and put the measurements into it
         data = {
             "uuid": uuidstr,
             "msg_type": 77,
-            "data": {},
+            "data": decoder.data_dict(measurements),
             "hash": base64.b64encode(data_struct).decode()
         }
 
-        # put measurements into the data object
-        for i in range(0, len(self.config["DataConfig"]["dataLayout"])):
-            if i >= len(measurements):
-                break
+        # the "timestamp" field is a special case
+        if decoder.timeIndex is not None:
+            data["timestamp"] = decoder.isotime(measurements)
 
-            # the "timestamp" field is a special case
-            if self.config["DataConfig"]["dataLayout"][i] == "time":
-                data["timestamp"] = datetime.datetime.utcfromtimestamp(measurements[i]).isoformat()
-            else:
-                data["data"].update({
-                    self.config["DataConfig"]["dataLayout"][i]: measurements[i]
-                })
+        self.log.debug("[DEV:%s] data object: %s", dev_id, data)
 
-        print(data)
+        return data
 
-        self.log.info("sending data to UBirch")
+    # Handle the response of the data service (the post is spooled if it failed), returns True if it accepted the data
+    def send_result(self, r, data, uuidstr, dev_id=None):
+        if ubirch_client.post_failed(r):
+            self.spoolPost("data", dev_id, uuidstr, data)
 
-        while True:
-            try:
-                passwordB64 = base64.encodebytes(bytes(self.config["UbirchHTTPConfig"]["UbirchPASS"], "UTF-8")).decode("utf-8").rstrip('\n')
-                r = requests.post((self.config["UbirchHTTPConfig"]["UbirchDATA"] % self.config["UbirchHTTPConfig"]["UbirchENV"]),
-                                    headers={"X-Ubirch-Hardware-Id": uuidstr,
-                                            "X-Ubirch-Auth-Type": "ubirch",
-                                            "X-Ubirch-Credential": passwordB64,
-                                            "Content-Type": "application/json"},
-                                    timeout=self.config["UbirchHTTPConfig"]["HTTPPostTimeout"],
-                                    json=data,
-                                    verify=False)
-            except Exception as e:
-                self.log.exception(e)
-            else:
-                # Will exit loop here when message sent
-                break
-
-            attempts_left -= 1
-
-            if attempts_left > 0:
-                self.log.error("HTTP POST request failed - trying again %d more times in %d seconds"
-                               % (attempts_left, 3))
-                time.sleep(3)
-            else:
-                self.log.error("HTTP POST request finally failed")
-                return
+        if r is None:
+            return False
+
+        if r.status_code == requests.codes.OK:
+            self.log.debug("[DEV:%s] data successfully sent to ubirch", dev_id)
+            return True
+
+        self.log.error("[DEV:%s] sending data to ubirch failed (STATUS_CODE: %d/%s)", dev_id, r.status_code, r.reason)
+        return False
+
+    # Run a blocking call (like a file write and sync) - AsyncConnector runs it in the executor instead of on the loop
+    def offload(self, fn, *args):
+        return fn(*args)
+
+    # Put a post that did not reach Ubirch into the spool (if enabled)
+    def spoolPost(self, kind, dev_id, uuidstr, body):
+        if self.spool:
+            self.spool.append(kind, dev_id, uuidstr, body)
+
+    # Replay a spooled post, returns True if Ubirch received it
+    def replaySpooled(self, kind, dev_id, uuidstr, body):
+        if kind == "niomon":
+            r = self.ubirch.verify(uuidstr, body, 1)
+        elif kind == "data":
+            r = self.ubirch.send_data(uuidstr, body, 1)
+        elif kind == "key":
+            r = self.ubirch.register_key(body, 1)
+        elif kind == "uplink":
+            return self.replayUplink(dev_id, *body)
+        else:
+            self.log.error("[DEV:%s] unknown spooled post type: %s - dropped", dev_id, kind)
+            return True
+
+        if ubirch_client.post_failed(r):
+            return False
 
         if r.status_code == requests.codes.OK:
-            self.log.debug("data successfully sent to ubirch")
+            self.log.debug("[DEV:%s] spooled %s post replayed", dev_id, kind)
+
+            # A key registration accepted late is taken for the local verification as well
+            if kind == "key" and self.verifier:
+                self.verifier.register(body, dev_id)
         else:
-            self.log.error("sending data to ubirch failed (STATUS_CODE: %d/%s)" % (r.status_code, r.reason))
+            self.log.error("[DEV:%s] spooled %s post rejected (STATUS_CODE: %d/%s)",
+                           dev_id, kind, r.status_code, r.reason)
+
+        return True
+
+    # Send a measurement uplink shed by the ingest queue (see ingest.LanePolicy) to Ubirch
+    # The device state is not updated - returns True, failed posts are spooled again (as niomon/data posts)
+    def replayUplink(self, dev_id, appID, raw_payload):
+        app = self.apps.get(appID, self.app)
+        upp = mqtt_connection.decode_payload(raw_payload)[1:]
+
+        try:
+            unpacked_upp = msgpack.unpackb(upp)
+            measurements = self.unpack_measurements(unpacked_upp, app.decoder)
+        except Exception as e:
+            self.log.exception(e)
+            measurements = None
+
+        if measurements is None:
+            self.log.error("[DEV:%s] spooled uplink does not contain a valid measurement - dropped", dev_id)
+            return True
+
+        self.verifiy_data(upp, unpacked_upp[1], dev_id)
+        self.send_measurements(measurements, unpacked_upp[4], unpacked_upp[1], dev_id, app.decoder)
+
+        self.log.debug("[DEV:%s] spooled uplink replayed", dev_id)
+        return True
 
 
 # Start it
 if __name__ == "__main__":
-    TTNConnector()
+    connector = TTNConnector()
+    signal.signal(signal.SIGTERM, lambda signum, frame: connector.scheduler.stop())
+
+    # Reload the config on SIGHUP (in a thread, the handler must not block on the reload lock)
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=connector.reloadConfig, name="config-reload", daemon=True).start())
+
+    try:
+        connector.run()
+    except KeyboardInterrupt:
+        pass
+
+    connector.stop()
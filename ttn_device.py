@@ -1,206 +1,391 @@
-import requests
+import collections.abc
+import enum
+import key_registration
 import mprotocol
 import time
 
-# helper function to assemble array of arrays into one array (ignoring the first byte of every subarray)
-def reassemble(arr):
-    if len(arr) == 0:
-        return bytes([])
-    else:
-        return arr[0][1:] + reassemble(arr[1:])
+
+# What to do when the device acknowledges a command
+class AckAction(enum.IntEnum):
+    NONE = 0
+    RESTART = 1  # the device restarts
+    RESTORE_ORIG_CONFIG = 2  # the device loaded its original config
+    SET_CFG_VAL = 3  # the device set a config value
+
+
+# Counters/deadlines of a device as returned by getStats()
+STATS_FIELDS = ("totalMeasurements", "measurementsSinceTimesync", "uplinksReceived", "downlinksSent",
+                "pendingAckT", "pendingDataResponseT", "pendingMeasurementT", "pendingRegistrationT", "inCMDMode")
+STATS_KEYS = STATS_FIELDS + ("ackAction", "lastMeasurement")
+
+# The plain values of the device state (see getState())
+STATE_FIELDS = ("totalMeasurements", "measurementsSinceTimesync", "uplinksReceived", "downlinksSent", "inCMDMode")
+DEADLINE_FIELDS = ("pendingAckT", "pendingDataResponseT", "pendingMeasurementT", "pendingRegistrationT")
+
+# The attribute holding the scheduled timeout of each deadline
+DEADLINE_TIMERS = {
+    "pendingAckT": "ackTimer",
+    "pendingDataResponseT": "dataResponseTimer",
+    "pendingMeasurementT": "measurementTimer",
+    "pendingRegistrationT": "registrationTimer"
+}
+
+
+class StatsView(collections.abc.Mapping):
+    """ A read-only dict view of the statistics of a device """
+
+    __slots__ = ("device",)
+
+    def __init__(self, device):
+        self.device = device
+
+    def __getitem__(self, key):
+        if key == "lastMeasurement":
+            return self.device.getLastMeasurement()
+
+        if key == "ackAction":
+            return self.device.ackAction.name
+
+        if key not in STATS_FIELDS:
+            raise KeyError(key)
+
+        return getattr(self.device, key)
+
+    def __iter__(self):
+        return iter(STATS_KEYS)
+
+    def __len__(self):
+        return len(STATS_KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MeasurementView(collections.abc.Mapping):
+    """ A read-only dict view of a measurement record (named by the dataLayout) """
+
+    __slots__ = ("decoder", "record")
+
+    def __init__(self, decoder, record):
+        self.decoder = decoder
+        self.record = record
+
+    def __getitem__(self, key):
+        if self.record is None:
+            raise KeyError(key)
+
+        return self.record[self.decoder.index[key]]
+
+    def __iter__(self):
+        return iter(self.decoder.index if self.record is not None else ())
+
+    def __len__(self):
+        return len(self.decoder.index) if self.record is not None else 0
+
+    def __repr__(self):
+        return repr(dict(self))
+
 
 class TTNDevice():
     """ A class storing information about a TTNDevice """
 
-    def __init__(self, context, deviceID):
+    # No __dict__ per device - there can be a lot of them
+    __slots__ = ("context", "deviceID", "app", "registration", "registration_upp",
+                 "lastMeasurement", "ackAction") + STATS_FIELDS + tuple(DEADLINE_TIMERS.values())
+
+    def __init__(self, context, deviceID, app=None):
         self.context = context
         self.deviceID = deviceID
-        self.received_registration_parts = []
+        self.app = app  # the TTNApplication the device belongs to
+        self.registration = None  # KeyReassembler, only while parts of a key registration UPP are received
         self.registration_upp = None
-        self.stats = {
-            # Number of measurements received since last timesync
-            "totalMeasurements": 0,
-            "measurementsSinceTimesync": 0,
-            "uplinksReceived": 0,  # how many messages the device sent
-            "downlinksSent": 0,  # how many messages were sent to the device
-            "pendingAckT": 0,  # When an acknowledge is awaited
-            "pendingDataResponseT": 0,  # When the next data response is awaited
-            "pendingMeasurementT": 0,  # When the next measurement is awaited
-            "execOnAck": None,  # Can hold a function to be exectured on next ack
-            "lastMeasurement": {}
-        }
-
-        return
+
+        self.totalMeasurements = 0
+        self.measurementsSinceTimesync = 0  # Number of measurements received since last timesync
+        self.uplinksReceived = 0  # how many messages the device sent
+        self.downlinksSent = 0  # how many messages were sent to the device
+        self.pendingAckT = 0  # When an acknowledge is awaited
+        self.pendingDataResponseT = 0  # When the next data response is awaited
+        self.pendingMeasurementT = 0  # When the next measurement is awaited
+        self.pendingRegistrationT = 0  # When the key registration UPP has to be complete
+        self.inCMDMode = False
+        self.ackAction = AckAction.NONE  # What to do on the next ack
+        self.lastMeasurement = None  # The last measurement record (decoded with the DataConfig)
+
+        # Scheduled timeouts of the pending* deadlines above
+        self.ackTimer = None
+        self.dataResponseTimer = None
+        self.measurementTimer = None
+        self.registrationTimer = None
 
     # To be called when the device sends a ping
     def ping(self):
-        if self.context.config["OPConfig"]["showPing"]:
-            self.context.log.debug("[DEV:%s] ping received" % self.deviceID)
+        if self.context.settings.op.showPing:
+            self.context.log.debug("[DEV:%s] ping received", self.deviceID)
 
-    # To be called on every iteration in the main loop (see ttn_connector.py)
+    # To be called after an uplink was handled (see ttn_connector.py)
+    # Timeouts are not checked here, they are fired by the scheduler
     def tick(self, noTimesync=True):
         if not noTimesync:
             self.__check_timesync()
 
-        self.__check_ack_timed_out()
-        self.__check_data_response_timed_out()
-        self.__check_measurement_timed_out()
         self.__check_registration_upp()
 
     # Functions to get values from the local stats object #
-    # Return statistics
+    # Return statistics (a read-only view)
     def getStats(self):
-        return self.stats
+        return StatsView(self)
 
-    # Returns lastMeasurement
+    # Returns lastMeasurement (a read-only view)
     def getLastMeasurement(self):
-        return self.stats["lastMeasurement"]
+        return MeasurementView(self.app.decoder, self.__record())
 
     # Return the value of pendingAckT
     def get_ack_pending_t(self):
-        return self.stats["pendingAckT"]
+        return self.pendingAckT
 
     # Return the value of pendingDataResponseT
     def get_dataresponse_pending_t(self):
-        return self.stats["pendingDataResponseT"]
+        return self.pendingDataResponseT
 
     # Return the value of pendingMeasurementT
     def get_measurement_pending_t(self):
-        return self.stats["pendingMeasurementT"]
+        return self.pendingMeasurementT
 
     # Get the allowed delay of an awaited message (based on inCMDMode)
     def __get_allowed_delay(self):
-        return self.context.config["TTNDeviceConfig"]["allowedMessageDelay"]
+        return self.context.settings.device.allowedMessageDelay
+
+    # Functions to persist the device state (see device_snapshot.py) #
+    # Return the state of the device as plain values
+    def getState(self):
+        return ([getattr(self, key) for key in STATE_FIELDS + DEADLINE_FIELDS] +
+                [int(self.ackAction),
+                 list(self.lastMeasurement) if self.lastMeasurement is not None else None,
+                 self.registration.getState() if self.registration is not None else None,
+                 self.registration_upp])
+
+    # Restore a state returned by getState() - pending deadlines are scheduled again
+    # (deadlines that passed meanwhile time out right away)
+    def setState(self, state):
+        values = dict(zip(STATE_FIELDS + DEADLINE_FIELDS, state))
+        ackAction, lastMeasurement, registration, self.registration_upp = state[len(values):]
+
+        for key in STATE_FIELDS:
+            setattr(self, key, values[key])
+
+        self.ackAction = AckAction(ackAction)
+
+        # The record is dropped if the DataConfig changed meanwhile
+        if lastMeasurement is not None and len(lastMeasurement) == self.app.decoder.count:
+            self.lastMeasurement = tuple(lastMeasurement)
+
+        if registration is not None:
+            self.registration = key_registration.KeyReassembler(self.context.settings.device.registrationMaxBytes)
+            self.registration.setState(registration)
+
+            if values["pendingRegistrationT"]:
+                self.__set_deadline("pendingRegistrationT", values["pendingRegistrationT"],
+                                    self.__on_registration_timed_out)
+
+        if values["pendingAckT"]:
+            self.__set_deadline("pendingAckT", values["pendingAckT"], self.__on_ack_timed_out)
+
+        if values["pendingDataResponseT"]:
+            self.__set_deadline("pendingDataResponseT", values["pendingDataResponseT"],
+                                self.__on_data_response_timed_out)
+
+        if values["pendingMeasurementT"]:
+            self.__set_deadline("pendingMeasurementT", values["pendingMeasurementT"],
+                                self.__on_measurement_timed_out)
+
+    # Cancel all pending deadlines (the device is removed)
+    def clearDeadlines(self):
+        for key in DEADLINE_FIELDS:
+            self.__set_deadline(key, 0)
+
+    # Set a pending* deadline (unix time) and schedule its timeout, 0 cancels it
+    def __set_deadline(self, key, deadline, onTimeout=None):
+        timerKey = DEADLINE_TIMERS[key]
+        timer = getattr(self, timerKey)
+
+        if timer:
+            timer.cancel()
+
+        setattr(self, key, deadline)
+        setattr(self, timerKey, None)
+
+        if deadline != 0:
+            setattr(self, timerKey, self.context.scheduler.call_later(deadline - time.time(), self.__on_timer,
+                                                                      onTimeout, deadline))
+
+    # Called by the scheduler when a deadline passed - the timeout is handled by the ingest worker of the device,
+    # so the deadlines and counters are not changed by two threads at once
+    def __on_timer(self, onTimeout, deadline):
+        if self.context.ingest is None:
+            onTimeout(deadline)
+        else:
+            self.context.ingest.call(self.deviceID, onTimeout, deadline)
 
     # Functions to set values in the local stats object #
     # Set the last received measurements + pendingMeasurementT will be reset
     def setMeasurement(self, measurements):
-        for i in range(0, len(self.context.config["DataConfig"]["dataLayout"])):
-            if i >= len(measurements):
-                break
-
-                self.context.log.info(self.context.config["DataConfig"]["dataLayout"][i] + ": " + str(measurements[i]))
+        if measurements is None:
+            raise ValueError("[DEV:%s] no measurement to set" % self.deviceID)
 
-            self.stats["lastMeasurement"].update({
-                self.context.config["DataConfig"]["dataLayout"][i]: measurements[i]
-            })
+        self.lastMeasurement = measurements
 
-        if self.context.config["OPConfig"]["showMeasurements"]:
-            self.context.log.info("[DEV:%s] measurements received: %s" % (self.deviceID, str(self.stats["lastMeasurement"])))
+        if self.context.settings.op.showMeasurements:
+            self.context.log.info("[DEV:%s] measurements received: %s", self.deviceID, self.getLastMeasurement())
 
-        self.stats["pendingMeasurementT"] = 0
-        self.stats["measurementsSinceTimesync"] += 1
-        self.stats["totalMeasurements"] += 1
+        self.__set_deadline("pendingMeasurementT", 0)
+        self.measurementsSinceTimesync += 1
+        self.totalMeasurements += 1
 
     # When called, pendingAckT will be reset
     def setAckReceived(self):
-        self.context.log.debug("[DEV:%s] acknowledge received" % self.deviceID)
-        self.stats["pendingAckT"] = 0
-
-        # Check if there is a function to be executed
-        if self.stats["execOnAck"]:
-            self.context.log.debug(
-                "[DEV:%s] executing registered onAck-function" % self.deviceID)
-
-            try:
-                # Call the callback
-                self.stats["execOnAck"]()
-
-                # Delete the callback
-                self.stats["execOnAck"] = None
-            except Exception as e:
-                self.context.log.exception("[DEV:%s] executing onAck callback failed: "
-                                           % self.deviceID, e)
+        self.context.log.debug("[DEV:%s] acknowledge received", self.deviceID)
+        self.__set_deadline("pendingAckT", 0)
+
+        # Check if there is an action to be executed
+        action = self.ackAction
+        self.ackAction = AckAction.NONE
+
+        if action == AckAction.RESTART:
+            self.context.log.info("[DEV:%s] device restarting", self.deviceID)
+        elif action == AckAction.RESTORE_ORIG_CONFIG:
+            self.context.log.info("[DEV:%s] original config loaded", self.deviceID)
+            self.inCMDMode = False
+        elif action == AckAction.SET_CFG_VAL:
+            self.context.log.info("[DEV:%s] cfg val set", self.deviceID)
         else:
             self.context.log.debug(
-                "[DEV:%s] no function registered for incoming acks!" % self.deviceID)
+                "[DEV:%s] no action registered for incoming acks!", self.deviceID)
 
     # When called, pendingAckT will be reset
     def setNackReceived(self):
-        self.context.log.error("[DEV:%s] NOT-acknowledge received"
-                               % self.deviceID)
+        self.context.log.error("[DEV:%s] NOT-acknowledge received",
+                               self.deviceID)
 
     # When called, pendingDataResponseT will be reset
     def setDataResponseReceived(self, response):
-        self.context.log.debug("[DEV:%s] data response received"
-                               % self.deviceID)
+        self.context.log.debug("[DEV:%s] data response received",
+                               self.deviceID)
+        self.__set_deadline("pendingDataResponseT", 0)
 
-    # Add a part to the received_registration_parts array
+    # Add a part to the key registration UPP
     def setRegistrationPartReceived(self, part):
         # check if the reset flag is set
-        if part[0] &0b01000000 != 0:
-            self.context.log.debug("[DEV:%s] received key regestration reset message"
-                                   % self.deviceID)
-
-            self.received_registration_parts = []
+        if part[0] & key_registration.FLAG_RESET != 0:
+            self.context.log.debug("[DEV:%s] received key regestration reset message",
+                                   self.deviceID)
 
-        self.context.log.debug("[DEV:%s] received key registration UPP part (part %d - %d bytes)"
-                               % (self.deviceID, len(self.received_registration_parts), len(part[1:])))
-        self.context.log.debug("%s" % str(part[1:]))
+        self.context.log.debug("[DEV:%s] received key registration UPP part (part %d - %d bytes)",
+                               self.deviceID, part[0] & key_registration.INDEX_MASK, len(part) - 1)
 
-        # add it to the array
-        self.received_registration_parts.append(part)
+        if self.registration is None:
+            self.registration = key_registration.KeyReassembler(self.context.settings.device.registrationMaxBytes)
 
-        # check if the current part has a set termination flag
-        if part[0] & 0b10000000 != 0:
-            # registration message complete
-            self.context.log.info("[DEV:%s] received complete key registration UPP"
-                                  % self.deviceID)
-            self.context.log.debug("[DEV:%s] ordering message parts (%d parts)"
-                                   % (self.deviceID, len(self.received_registration_parts)))
-
-            # sort the parts
-            ordered = sorted(self.received_registration_parts, key=lambda x: x[0] & 0b00111111)
+        result, upp = self.registration.add(part)
 
-            self.context.log.debug("[DEV:%s] putting all parts into one" % self.deviceID)
+        if result == key_registration.PART_DUPLICATE:
+            self.context.log.debug("[DEV:%s] duplicate key registration UPP part (part %d) - ignored",
+                                   self.deviceID, part[0] & key_registration.INDEX_MASK)
+        elif result in (key_registration.PART_INVALID, key_registration.PART_OVERFLOW):
+            self.context.log.error("[DEV:%s] %s key registration UPP part (part %d) - discarding all parts",
+                                   self.deviceID, result, part[0] & key_registration.INDEX_MASK)
 
-            # re-assemble the upp
-            self.registration_upp = reassemble(ordered)
-
-        return
+            self.registration = None
+            self.__set_deadline("pendingRegistrationT", 0)
+        elif result == key_registration.UPP_COMPLETE:
+            # registration message complete
+            self.context.log.info("[DEV:%s] received complete key registration UPP",
+                                  self.deviceID)
+
+            self.registration = None
+            self.registration_upp = upp
+            self.__set_deadline("pendingRegistrationT", 0)
+        elif self.pendingRegistrationT == 0:
+            # The first part - the others have to arrive in time
+            self.__set_deadline("pendingRegistrationT",
+                                time.time() + self.context.settings.device.registrationTimeout,
+                                self.__on_registration_timed_out)
 
     # Check if the devices clock is in sync
     def __check_timesync(self):
-        if "time" in self.stats["lastMeasurement"].keys():
-            if self.stats["measurementsSinceTimesync"] > 0:
-                self.context.log.debug("[DEV:%s] checking the current time of the device - %d"
-                                    % (self.deviceID, self.stats["lastMeasurement"]["time"]))
+        deviceTime = self.__device_time()
+
+        if deviceTime is not None:
+            if self.measurementsSinceTimesync > 0:
+                self.context.log.debug("[DEV:%s] checking the current time of the device - %d",
+                                    self.deviceID, deviceTime)
 
                 # Check by how much the sensors time is off
-                if abs(self.stats["lastMeasurement"]["time"] - time.time())\
-                        > self.context.config["TTNDeviceConfig"]["allowedClockOffset"]:
+                if abs(deviceTime - time.time()) > self.context.settings.device.allowedClockOffset:
                     # Time has to be synced
                     self.__timesync()
 
-    # Check if the current pending ack has timed out
-    def __check_ack_timed_out(self):
-        if self.stats["pendingAckT"] != 0:
-            if time.time() - self.stats["pendingAckT"] > 0:
-                self.context.log.warning(
-                    "[DEV:%s] acknowledge timed out" % self.deviceID)
+    # Return the "time" value of the last measurement (None if there is none)
+    def __device_time(self):
+        record = self.__record()
+
+        if record is None:
+            return None
+
+        return self.app.decoder.time(record)
+
+    # Return lastMeasurement if it fits the current DataConfig (None if a reload changed its number of values)
+    def __record(self):
+        if self.lastMeasurement is None or len(self.lastMeasurement) != self.app.decoder.count:
+            return None
+
+        return self.lastMeasurement
+
+    # Called on the worker of the device when the pending ack timed out
+    def __on_ack_timed_out(self, deadline):
+        # Ignore timers that raced with an incoming ack
+        if self.pendingAckT != deadline:
+            return
+
+        self.context.log.warning(
+            "[DEV:%s] acknowledge timed out", self.deviceID)
 
-                # Reset pendingAckT
-                self.stats["pendingAckT"] = 0
+        # Reset pendingAckT
+        self.__set_deadline("pendingAckT", 0)
 
-    # Check if the current pending data response timed out
-    def __check_data_response_timed_out(self):
-        if self.stats["pendingDataResponseT"] != 0:
-            if time.time() - self.stats["pendingDataResponseT"] > 0:
-                self.context.log.warning("[DEV:%s] data response timed out by %d seconds ..."
-                                         % (self.deviceID, time.time() - self.stats["pendingDataResponseT"]))
+    # Called on the worker of the device when the pending data response timed out
+    def __on_data_response_timed_out(self, deadline):
+        if self.pendingDataResponseT != deadline:
+            return
 
-            # Reset pendingAckT
-            self.stats["pendingAckT"] = 0
+        self.context.log.warning("[DEV:%s] data response timed out by %d seconds ...",
+                                 self.deviceID, time.time() - deadline)
 
-    # Check if the current pending measurement timed out
-    def __check_measurement_timed_out(self):
-        if self.stats["pendingMeasurementT"] != 0 and not self.stats["inCMDMode"]:
-            if time.time() - self.stats["pendingMeasurementT"] > 0:
-                self.context.log.warning("[DEV:%s] measurement timed out by %d seconds ..."
-                                         % (self.deviceID, time.time() - self.stats["pendingMeasurementT"]))
+        # Reset pendingDataResponseT
+        self.__set_deadline("pendingDataResponseT", 0)
 
-            # Reset pendingAckT
-            self.stats["pendingAckT"] = 0
+    # Called on the worker of the device when the pending measurement timed out
+    def __on_measurement_timed_out(self, deadline):
+        if self.pendingMeasurementT != deadline:
+            return
+
+        if not self.inCMDMode:
+            self.context.log.warning("[DEV:%s] measurement timed out by %d seconds ...",
+                                     self.deviceID, time.time() - deadline)
+
+        # Reset pendingMeasurementT
+        self.__set_deadline("pendingMeasurementT", 0)
+
+    # Called on the worker of the device when the key registration UPP was not completed in time
+    def __on_registration_timed_out(self, deadline):
+        if self.pendingRegistrationT != deadline or self.registration is None:
+            return
+
+        self.context.log.warning("[DEV:%s] key registration UPP incomplete (missing parts: %s) - discarded",
+                                 self.deviceID, self.registration.gaps() or "last")
+
+        self.registration = None
+        self.__set_deadline("pendingRegistrationT", 0)
 
     # check if there is a complete key registration upp available
     def __check_registration_upp(self):
@@ -210,31 +395,41 @@ class TTNDevice():
     # Functions that communicate with the device #
     # Send the device key registration upp
     def __register_device(self):
-        self.context.log.info("[DEV:%s] sending the key registration upp to Ubirch"
-                      % self.deviceID)
-
-        self.context.log.debug("[DEV:%s] registration upp: %s (%d bytes)"
-                                % (self.deviceID, str(self.registration_upp), len(self.registration_upp)))
+        self.context.log.info("[DEV:%s] sending the key registration upp to Ubirch",
+                      self.deviceID)
 
-        # send the request
-        r = requests.post((self.context.config["UbirchHTTPConfig"]["UbirchKEY"] % self.context.config["UbirchHTTPConfig"]["UbirchENV"]),
-                          headers={'Content-Type': 'application/octet-stream'},
-                          data=self.registration_upp)
+        self.context.log.debug("[DEV:%s] registration upp: %s (%d bytes)",
+                                self.deviceID, self.registration_upp, len(self.registration_upp))
 
-        # evaluate if success or not
-        if r.status_code == 200:
-            r.close()
-            self.context.log.info("[DEV:%s] registration succeeded" % self.deviceID)
-        else:
-            self.context.log.error("[DEV:%s] registration failed: %s (%d)" % (self.deviceID, r.text, r.status_code))
+        # send the request in the background (with retries) - the response is passed to setRegistrationResponse()
+        self.context.submitter.register(self, self.registration_upp)
 
         # delete the upp
         self.registration_upp = None
 
+    # Evaluate the response of the key service to the key registration UPP
+    def setRegistrationResponse(self, r, upp=None):
+        if r is None:
+            self.context.log.error("[DEV:%s] registration failed: no response", self.deviceID)
+        elif r.status_code == 200:
+            self.context.log.info("[DEV:%s] registration succeeded", self.deviceID)
+
+            # Keep the key to verify the measurements of the device locally (only once the key service accepted it)
+            if self.context.verifier and upp is not None:
+                self.context.verifier.register(upp, self.deviceID)
+        else:
+            self.context.log.error("[DEV:%s] registration failed: %s (%d)", self.deviceID, r.text, r.status_code)
+
+    # Send a message to the device
+    def __send(self, msg):
+        self.app.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
+        self.downlinksSent += 1
+        self.app.count("downlinks")
+
     # Send a timesync message to the device to set its time
     def __timesync(self):
-        self.context.log.info("[DEV:%s] the sensors clock is off by %d seconds - synchronizing"
-                              % (self.deviceID, abs(self.stats["lastMeasurement"]["time"] - time.time())))
+        self.context.log.info("[DEV:%s] the sensors clock is off by %d seconds - synchronizing",
+                              self.deviceID, abs(self.__device_time() - time.time()))
 
         # Create the timesync message
         msg = {}
@@ -243,79 +438,70 @@ class TTNDevice():
         msg["MSG_DATA"] = round(time.mktime(time.localtime())) + 2
 
         # Send the message
-        self.context.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
+        self.__send(msg)
 
-        self.context.log.debug("[DEV:%s] timesync ctrl message sent - ack pending"
-                               % self.deviceID)
+        self.context.log.debug("[DEV:%s] timesync ctrl message sent - ack pending",
+                               self.deviceID)
 
         # Set the pendingAckT to in currenttime + allowedMessageDelay
-        self.stats["pendingAckT"] = time.time()\
-            + self.__get_allowed_delay()
+        self.__set_deadline("pendingAckT", time.time() + self.__get_allowed_delay(),
+                            self.__on_ack_timed_out)
 
         # Reset measurements since timesync
-        self.stats["measurementsSinceTimesync"] = 0
+        self.measurementsSinceTimesync = 0
 
     # Send a restart message to the device
     def __restart_device(self):
-        self.context.log.info("[DEV:%s] sending restart command to the device"
-                              % self.deviceID)
+        self.context.log.info("[DEV:%s] sending restart command to the device",
+                              self.deviceID)
 
         # Create the restart message
         msg = {}
         msg["MSG_CTRL_B"] = mprotocol.MP_CTRL_B_TYPES["MSG_CTRL_RESTART"]
 
         # Send the message
-        self.context.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
+        self.__send(msg)
 
         # Reset all pendings
-        self.stats["pendingAckT"] = 0
-        self.stats["pendingDataResponseT"] = 0
-        self.stats["pendingMeasurementT"] = 0
+        self.__set_deadline("pendingDataResponseT", 0)
+        self.__set_deadline("pendingMeasurementT", 0)
 
         # Set pendingAckT because the device has to acknowledge the command
-        self.stats["pendingAckT"] = time.time()\
-            + self.__get_allowed_delay()
-
-        self.context.log.debug("[DEV:%s] restart ctrl message sent - ack pending"
-                               % self.deviceID)
+        self.__set_deadline("pendingAckT", time.time() + self.__get_allowed_delay(),
+                            self.__on_ack_timed_out)
 
-        # install the acknowledge callback
-        def onAck():
-            self.context.log.info("[DEV:%s] device restarting" % self.deviceID)
+        self.context.log.debug("[DEV:%s] restart ctrl message sent - ack pending",
+                               self.deviceID)
 
-        self.stats["execOnAck"] = onAck
+        # install the acknowledge action
+        self.ackAction = AckAction.RESTART
 
     # Commands the device to load its original config
     def __restore_orig_config(self):
-        self.context.log.info("[DEV:%s] sending load original config command to the device"
-                              % self.deviceID)
+        self.context.log.info("[DEV:%s] sending load original config command to the device",
+                              self.deviceID)
 
         # Create the restart message
         msg = {}
         msg["MSG_CTRL_B"] = mprotocol.MP_CTRL_B_TYPES["MSG_CTRL_RESTORE_ORIG_CONFIG"]
 
         # Send the message
-        self.context.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
+        self.__send(msg)
 
         # Set pendingAckT because the device has to acknowledge the command
-        self.stats["pendingAckT"] = time.time()\
-            + self.__get_allowed_delay()
+        self.__set_deadline("pendingAckT", time.time() + self.__get_allowed_delay(),
+                            self.__on_ack_timed_out)
 
-        self.context.log.debug("[DEV:%s] load original config ctrl message sent - ack pending"
-                               % self.deviceID)
+        self.context.log.debug("[DEV:%s] load original config ctrl message sent - ack pending",
+                               self.deviceID)
 
-        # install the acknowledge callback
-        def onAck():
-            self.context.log.info(
-                "[DEV:%s] original config loaded" % self.deviceID)
-            self.stats["inCMDMode"] = False
-
-        self.stats["execOnAck"] = onAck
+        # install the acknowledge action
+        self.ackAction = AckAction.RESTORE_ORIG_CONFIG
 
     # Commands the device to send a config value
     def __read_cfg_val(self, id):
-        self.context.log.info("[DEV:%s] sending read cfg val command to the device"
-                              % self.deviceID)
+        self.context.log.info("[DEV:%s] sending read cfg val command to the device",
+                              self.deviceID)
 
         # Create the restart message
         msg = {}
@@ -323,19 +509,19 @@ class TTNDevice():
         msg["MSG_DATA"] = id
 
         # Send the message
-        self.context.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
+        self.__send(msg)
 
-        # Set pendingAckT because the device has to acknowledge the command
-        self.stats["pendingDataResponse"] = time.time()\
-            + self.__get_allowed_delay()
+        # Set pendingDataResponseT because the device has to respond with the value
+        self.__set_deadline("pendingDataResponseT", time.time() + self.__get_allowed_delay(),
+                            self.__on_data_response_timed_out)
 
-        self.context.log.debug("[DEV:%s] read cfg val ctrl message sent - data response pending"
-                               % self.deviceID)
+        self.context.log.debug("[DEV:%s] read cfg val ctrl message sent - data response pending",
+                               self.deviceID)
 
     # Commands the device to send a config value
     def __set_cfg_val(self, id, value):
-        self.context.log.info("[DEV:%s] sending set cfg val command to the device"
-                              % self.deviceID)
+        self.context.log.info("[DEV:%s] sending set cfg val command to the device",
+                              self.deviceID)
 
         # Create the restart message
         msg = {}
@@ -343,13 +529,10 @@ class TTNDevice():
         msg["MSG_DATA"] = [id, value]
 
         # Send the message
-        self.context.mqtt.send(self.deviceID, mprotocol.mk_mp_msg(msg))
-
-        self.context.log.debug("[DEV:%s] set cfg val ctrl message sent - data response pending"
-                               % self.deviceID)
+        self.__send(msg)
 
-        # install the acknowledge callback
-        def onAck():
-            self.context.log.info("[DEV:%s] cfg val set" % self.deviceID)
+        self.context.log.debug("[DEV:%s] set cfg val ctrl message sent - data response pending",
+                               self.deviceID)
 
-        self.stats["execOnAck"] = onAck
+        # install the acknowledge action
+        self.ackAction = AckAction.SET_CFG_VAL
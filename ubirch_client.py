@@ -0,0 +1,231 @@
+import base64
+import concurrent.futures
+import functools
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import circuit_breaker
+
+
+# Max. number of devices whose UUID string/headers are cached
+UUID_CACHE_SIZE = 65536
+
+
+# from 16 byte bin to str: "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
+@functools.lru_cache(maxsize=UUID_CACHE_SIZE)
+def uuidbin2str(uuidbin):
+    if len(uuidbin) != 16:
+        raise ValueError("a UUID has 16 bytes, got %d" % len(uuidbin))
+
+    h = uuidbin.hex()
+
+    return "%s-%s-%s-%s-%s" % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+
+# Returns True if a post did not reach Ubirch or Ubirch could not handle it (worth retrying later)
+def post_failed(r):
+    return r is None or r.status_code >= 500
+
+
+class UbirchClient():
+    """ A shared HTTP client with pooled keep-alive connections for all Ubirch endpoints """
+
+    def __init__(self, context):
+        self.context = context
+
+        cfg = self.context.config["UbirchHTTPConfig"]
+
+        # URLs are only formatted once
+        self.niomonURL = cfg["UbirchNIOMON"] % cfg["UbirchENV"]
+        self.dataURL = cfg["UbirchDATA"] % cfg["UbirchENV"]
+        self.keyURL = cfg["UbirchKEY"] % cfg["UbirchENV"]
+        self.dataBulkURL = cfg["UbirchDATABulk"] % cfg["UbirchENV"] if "UbirchDATABulk" in cfg else None
+
+        # (connect, read) timeout tuple - both default to HTTPPostTimeout
+        self.timeout = (cfg.get("HTTPConnectTimeout", cfg["HTTPPostTimeout"]),
+                        cfg.get("HTTPReadTimeout", cfg["HTTPPostTimeout"]))
+        self.attempts = cfg["HTTPPostAttempts"]
+        self.retryDelay = cfg.get("HTTPRetryDelay", 3)
+        self.maxRetryDelay = cfg.get("HTTPMaxRetryDelay", 30)
+
+        # Static headers, only the hardware ID changes per device
+        passwordB64 = base64.b64encode(bytes(cfg["UbirchPASS"], "UTF-8")).decode("utf-8")
+        self.authHeaders = {
+            "X-Ubirch-Auth-Type": "ubirch",
+            "X-Ubirch-Credential": passwordB64
+        }
+
+        # The headers of a device are only built once
+        self.device_headers = functools.lru_cache(maxsize=UUID_CACHE_SIZE)(self.__device_headers)
+        self.device_json_headers = functools.lru_cache(maxsize=UUID_CACHE_SIZE)(self.__device_json_headers)
+
+        # Endpoint names used in the metrics (bulk first, it may be the same URL as data)
+        self.endpoints = {self.dataBulkURL: "data_bulk"} if self.dataBulkURL else {}
+        self.endpoints.update({
+            self.niomonURL: "niomon",
+            self.dataURL: "data",
+            self.keyURL: "key"
+        })
+
+        # A circuit breaker per endpoint (optional)
+        self.breakers = {}
+        breakerCfg = dict(cfg.get("CircuitBreaker", {}))
+
+        if breakerCfg.get("enabled", True):
+            breakerCfg.setdefault("maxConcurrency", self.concurrency())
+
+            for endpoint in set(self.endpoints.values()) | {"other"}:
+                self.breakers[endpoint] = circuit_breaker.CircuitBreaker(context, endpoint, breakerCfg)
+
+        # One session (keep-alive) with a connection pool per host
+        adapter = HTTPAdapter(pool_connections=cfg.get("HTTPPoolHosts", 4),
+                              pool_maxsize=cfg.get("HTTPPoolSize", 10))
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # The default max. concurrency limit of the circuit breakers - the requests in flight per endpoint
+    def concurrency(self):
+        return self.context.config["UbirchHTTPConfig"].get("HTTPConcurrency", 16)
+
+    # Close all pooled connections
+    def close(self):
+        self.session.close()
+
+    # Return the headers to authenticate a device at Ubirch (cached - must not be modified)
+    def __device_headers(self, uuidstr):
+        headers = dict(self.authHeaders)
+        headers["X-Ubirch-Hardware-Id"] = uuidstr
+
+        return headers
+
+    # Return the headers to send JSON data of a device to Ubirch (cached - must not be modified)
+    def __device_json_headers(self, uuidstr):
+        headers = dict(self.__device_headers(uuidstr))
+        headers["Content-Type"] = "application/json"
+
+        return headers
+
+    # Send a signed UPP to niomon for validation
+    # With an executor the request does not block a thread between its attempts - a Future is returned (see post_later)
+    def verify(self, uuidstr, upp, attempts=None, executor=None):
+        return self.__post(executor, self.niomonURL, self.device_headers(uuidstr), attempts, data=upp, verify=False)
+
+    # Send a measurement JSON object to the data service
+    def send_data(self, uuidstr, data, attempts=None, executor=None):
+        return self.__post(executor, self.dataURL, self.device_json_headers(uuidstr), attempts, json=data, verify=False)
+
+    # Send a list of measurement JSON objects (of any devices) to the data service in one request
+    def send_data_bulk(self, items, attempts=None):
+        headers = dict(self.authHeaders)
+        headers["Content-Type"] = "application/json"
+
+        return self.post(self.dataBulkURL, headers, attempts, json=items, verify=False)
+
+    # Send a key registration UPP to the key service
+    def register_key(self, upp, attempts=None, executor=None):
+        return self.__post(executor, self.keyURL, {"Content-Type": "application/octet-stream"}, attempts, data=upp)
+
+    # POST to an URL, retrying up to attempts (default HTTPPostAttempts) times
+    # Returns the response or None if all attempts failed (or the circuit of the endpoint is open)
+    def post(self, url, headers, attempts=None, **kwargs):
+        attempts_left = attempts or self.attempts
+        attempt = 0
+
+        while True:
+            done, r = self.__attempt(url, headers, kwargs)
+
+            if done:
+                return r
+
+            attempts_left -= 1
+            attempt += 1
+
+            if attempts_left > 0:
+                delay = self.retry_delay(attempt)
+                self.context.log.error("HTTP POST request failed - trying again %d more times in %.1f seconds",
+                                       attempts_left, delay)
+                time.sleep(delay)
+            else:
+                self.context.log.error("HTTP POST request finally failed")
+                return None
+
+    # Like post(), but the thread is not blocked between the attempts: the first attempt is made at once, every
+    # retry is a new job of the executor started by the scheduler after the retry delay
+    # Returns a Future of the response (None if all attempts failed)
+    def post_later(self, executor, url, headers, attempts=None, **kwargs):
+        future = concurrent.futures.Future()
+        self.__post_later(executor, future, url, headers, attempts or self.attempts, 1, kwargs)
+
+        return future
+
+    def __post(self, executor, url, headers, attempts, **kwargs):
+        if executor is None:
+            return self.post(url, headers, attempts, **kwargs)
+
+        return self.post_later(executor, url, headers, attempts, **kwargs)
+
+    def __post_later(self, executor, future, url, headers, attempts_left, attempt, kwargs):
+        try:
+            done, r = self.__attempt(url, headers, kwargs)
+        except Exception as e:
+            self.context.log.exception(e)
+            done, r = True, None
+
+        if done:
+            future.set_result(r)
+        elif attempts_left > 1:
+            delay = self.retry_delay(attempt)
+            self.context.log.error("HTTP POST request failed - trying again %d more times in %.1f seconds",
+                                   attempts_left - 1, delay)
+            self.context.scheduler.call_later(delay, self.__retry, executor, future, url, headers,
+                                              attempts_left - 1, attempt + 1, kwargs)
+        else:
+            self.context.log.error("HTTP POST request finally failed")
+            future.set_result(None)
+
+    def __retry(self, executor, future, *args):
+        try:
+            executor.submit(self.__post_later, executor, future, *args)
+        except RuntimeError:
+            # The executor was shut down
+            future.set_result(None)
+
+    # Make one attempt to POST to an URL, returns (done, response) - not done if the attempt can be retried
+    def __attempt(self, url, headers, kwargs):
+        endpoint = self.endpoints.get(url, "other")
+        breaker = self.breakers.get(endpoint)
+        admitted = breaker.acquire() if breaker else circuit_breaker.CLOSED
+
+        if admitted is None:
+            # Fail fast, the endpoint is down (or overloaded, no slot got free) - no need to wait for timeouts
+            self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", "rejected")))
+            return True, None
+
+        started = time.monotonic()
+
+        try:
+            r = self.session.post(url, headers=headers, timeout=self.timeout, **kwargs)
+        except Exception as e:
+            if breaker:
+                breaker.release(admitted, False, time.monotonic() - started)
+
+            self.context.log.exception(e)
+            self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", "error")))
+            return False, None
+
+        if breaker:
+            breaker.release(admitted, not post_failed(r), time.monotonic() - started)
+
+        self.context.metrics.observe("http_" + endpoint, started)
+        self.context.metrics.inc("http_requests_total", (("endpoint", endpoint), ("status", str(r.status_code))))
+        return True, r
+
+    # Seconds to wait before the next attempt - doubled after every failed attempt (with jitter)
+    def retry_delay(self, attempt):
+        return min(self.maxRetryDelay, self.retryDelay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    # Return the statistics of the circuit breakers (by endpoint)
+    def getBreakerStats(self):
+        return {endpoint: breaker.getStats() for endpoint, breaker in self.breakers.items()}
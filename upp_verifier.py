@@ -0,0 +1,279 @@
+import hashlib
+import os
+import random
+import threading
+import msgpack
+
+# One of the optional Ed25519 implementations is needed (pip install pynacl or pip install ed25519)
+try:
+    import nacl.exceptions
+    import nacl.signing
+except ImportError:
+    nacl = None
+
+try:
+    import ed25519
+except ImportError:
+    ed25519 = None
+
+# UPP versions (the low nibble of the first element)
+UPP_SIGNED = 0x02  # [version, uuid, type, payload, signature]
+UPP_CHAINED = 0x03  # [version, uuid, previous signature, type, payload, signature]
+
+# The type of a key registration UPP
+UPP_TYPE_KEY_REGISTRATION = 0x01
+
+# The signature is the last element of an UPP - a 64 byte bin (0xc4, length)
+SIGNATURE_BIN = b"\xc4\x40"
+
+# Results of verify()
+VALID = "valid"
+INVALID = "invalid"  # the signature does not match or the UPP is malformed
+UNKNOWN = "unknown"  # the key of the device is not known (only niomon can verify it)
+
+# When niomon gets an UPP that was verified locally
+NIOMON_POLICIES = (
+    "always",  # at once, like without local verification
+    "sample",  # at once, but only sampleRate of them
+    "defer",  # later, by the replay of the spool (at its replayRate)
+    "never"  # not at all
+)
+
+
+# Return True if the Ed25519 signature of the message is valid
+def verify_signature(pubKey, signature, message):
+    if nacl is not None:
+        try:
+            nacl.signing.VerifyKey(pubKey).verify(message, signature)
+            return True
+        except (nacl.exceptions.BadSignatureError, ValueError):
+            return False
+
+    try:
+        ed25519.VerifyingKey(pubKey).verify(signature, message)
+        return True
+    except (ed25519.BadSignatureError, AssertionError, ValueError):
+        return False
+
+
+# Return the signature of a packed UPP and the data it was created from (the SHA-512 of the UPP without it)
+# Returns (None, None) if the UPP does not end with a signature
+def signed_data(upp):
+    if len(upp) < 66 or upp[-66:-64] != SIGNATURE_BIN:
+        return None, None
+
+    return upp[-64:], hashlib.sha512(upp[:-66]).digest()
+
+
+# Get a value of a key registration payload (the keys may be unpacked as str or bytes)
+def payload_value(payload, key):
+    return payload.get(key, payload.get(key.encode()))
+
+
+class UPPVerifier():
+    """ Verifies the signatures (and the chain) of measurement UPPs with the keys of the devices' registration UPPs """
+
+    def __init__(self, context):
+        self.context = context
+
+        if nacl is None and ed25519 is None:
+            raise ImportError("local UPP verification needs pynacl or ed25519")
+
+        cfg = self.context.config.get("LocalVerifyConfig", {})
+        self.path = cfg.get("keyStore", "keys.store")
+        self.niomon = cfg.get("niomon", "always")
+        self.sampleRate = cfg.get("sampleRate", 0.1)
+        self.rejectChainBreaks = cfg.get("rejectChainBreaks", False)
+        self.saveDelay = cfg.get("saveDelay", 5)
+
+        if self.niomon not in NIOMON_POLICIES:
+            raise ValueError("unknown niomon policy: %s" % self.niomon)
+
+        if self.niomon == "defer" and not self.context.spool:
+            self.context.log.warning("niomon verification can only be deferred with the spool - sending at once")
+            self.niomon = "always"
+
+        # UUID -> [public key, signature of the last verified UPP (None until the first one), device ID]
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.saveScheduled = False
+
+        self.stats = {
+            "verified": 0,  # how many UPPs were verified locally
+            "rejected": 0,  # how many UPPs had an invalid signature (or were malformed)
+            "unknownKey": 0,  # how many UPPs were left to niomon because the key of the device is not known
+            "chainBreaks": 0,  # how many UPPs did not reference the signature of the last verified one
+            "registered": 0,  # how many keys were taken from registration UPPs
+            "keyConflicts": 0,  # how many registration UPPs named the UUID of another device (key not stored)
+            "niomonSkipped": 0,  # how many locally verified UPPs were not sent to niomon (sample/never)
+            "niomonDeferred": 0  # how many locally verified UPPs were spooled for niomon
+        }
+
+    # Load the key store (a missing or damaged store is started empty)
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                keys = msgpack.unpackb(f.read(), raw=False)
+
+            # Stores written before the keys were bound to the devices have no device ID
+            self.keys = {uuid: (list(entry) + [None])[:3] for uuid, entry in keys.items()}
+        except Exception as e:
+            self.context.log.error("loading the key store %s failed - starting without keys", self.path)
+            self.context.log.exception(e)
+            return
+
+        self.context.log.info("loaded %d device keys from %s", len(self.keys), self.path)
+
+    # Write the key store (atomically - the old store is kept until the new one is complete)
+    def save(self):
+        tmp = self.path + ".tmp"
+
+        with self.lock:
+            data = msgpack.packb(self.keys, use_bin_type=True)
+
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp, self.path)
+        except Exception as e:
+            self.context.log.error("writing the key store %s failed", self.path)
+            self.context.log.exception(e)
+
+    # Take the public key of a key registration UPP accepted by the key service (if it is signed with it)
+    # The UUID is bound to the device - returns True if the key was taken
+    def register(self, upp, dev_id=None):
+        try:
+            unpacked_upp = msgpack.unpackb(upp, raw=False)
+            uuid, upptype, payload = unpacked_upp[1], unpacked_upp[-3], unpacked_upp[-2]
+            pubKey = payload_value(payload, "pubKey")
+        except Exception as e:
+            self.context.log.error("[DEV:%s] invalid key registration UPP - key not stored", dev_id)
+            self.context.log.exception(e)
+            return False
+
+        signature, data = signed_data(upp)
+
+        if upptype != UPP_TYPE_KEY_REGISTRATION or not isinstance(pubKey, bytes) or len(pubKey) != 32 \
+                or signature is None or not verify_signature(pubKey, signature, data):
+            self.context.log.error("[DEV:%s] key registration UPP is not signed with its key - key not stored", dev_id)
+            return False
+
+        with self.lock:
+            entry = self.keys.get(uuid)
+
+            if entry is not None and entry[2] is not None and entry[2] != dev_id:
+                self.stats["keyConflicts"] += 1
+                conflict = entry[2]
+            elif entry is not None and entry[0] == pubKey:
+                entry[2] = dev_id
+                return True
+            else:
+                conflict = None
+                self.keys[uuid] = [pubKey, None, dev_id]
+                self.stats["registered"] += 1
+
+        if conflict is not None:
+            self.context.log.error("[DEV:%s] the key registration UPP names the UUID of device %s - key not stored",
+                                   dev_id, conflict)
+            return False
+
+        self.context.log.info("[DEV:%s] public key stored for local verification", dev_id)
+        self.__schedule_save()
+
+        return True
+
+    # Verify a measurement UPP (packed and unpacked), returns VALID, INVALID or UNKNOWN
+    def verify(self, unpacked_upp, upp, dev_id=None):
+        try:
+            chained = unpacked_upp[0] & 0x0f == UPP_CHAINED
+            entry = self.keys.get(unpacked_upp[1])
+        except (TypeError, IndexError, KeyError):
+            self.context.log.error("[DEV:%s] malformed UPP - rejected", dev_id)
+            self.__count("rejected")
+            return INVALID
+
+        if entry is None:
+            self.__count("unknownKey")
+            return UNKNOWN
+
+        if entry[2] is not None and dev_id is not None and entry[2] != dev_id:
+            self.context.log.error("[DEV:%s] UPP names the UUID of device %s - rejected", dev_id, entry[2])
+            self.__count("rejected")
+            return INVALID
+
+        signature, data = signed_data(upp)
+
+        if signature is None or not verify_signature(entry[0], signature, data):
+            self.context.log.error("[DEV:%s] UPP signature invalid - rejected", dev_id)
+            self.__count("rejected")
+            return INVALID
+
+        # The chain breaks whenever an uplink is lost - only rejected if configured
+        # Compared and set under the lock, the UPPs of a device may be verified by several workers
+        with self.lock:
+            broken = chained and entry[1] is not None and unpacked_upp[2] != entry[1]
+
+            if broken:
+                self.stats["chainBreaks"] += 1
+
+            if broken and self.rejectChainBreaks:
+                self.stats["rejected"] += 1
+            else:
+                entry[1] = signature
+                self.stats["verified"] += 1
+
+        if broken and self.rejectChainBreaks:
+            self.context.log.error("[DEV:%s] UPP does not continue the chain - rejected", dev_id)
+            return INVALID
+
+        if broken:
+            self.context.log.warning("[DEV:%s] UPP does not continue the chain (uplinks lost?)", dev_id)
+
+        return VALID
+
+    # Returns True if a locally verified UPP has to be sent to niomon now (it is spooled if deferred)
+    def remote(self, upp, uuidstr, dev_id=None):
+        if self.niomon == "always" or (self.niomon == "sample" and random.random() < self.sampleRate):
+            return True
+
+        if self.niomon == "defer" and self.context.spool.append("niomon", dev_id, uuidstr, upp, deferred=True):
+            self.__count("niomonDeferred")
+        else:
+            self.__count("niomonSkipped")
+
+        return False
+
+    # Return statistics
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["keys"] = len(self.keys)
+
+        return stats
+
+    # Write the key store saveDelay seconds after the first new key - the keys registered meanwhile are written with it
+    def __schedule_save(self):
+        with self.lock:
+            if self.saveScheduled:
+                return
+
+            self.saveScheduled = True
+
+        self.context.scheduler.call_soon_threadsafe(self.context.scheduler.call_later, self.saveDelay, self.__save_later)
+
+    def __save_later(self):
+        with self.lock:
+            self.saveScheduled = False
+
+        # The store is written (and synced) in the executor in asyncio mode
+        self.context.offload(self.save)
+
+    def __count(self, key):
+        with self.lock:
+            self.stats[key] += 1